@@ -0,0 +1,94 @@
+import os
+import random
+from collections import defaultdict, deque
+from threading import Lock
+from time import sleep, time
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+
+from app import ELASTIC_URL
+from app import logger
+from util import elapsed
+
+ES_CONNECTIONS_PER_NODE = int(os.getenv("ES_CONNECTIONS_PER_NODE", 16))
+ES_BULK_THREADS = int(os.getenv("ES_BULK_THREADS", 4))
+ES_BULK_CHUNK_SIZE = int(os.getenv("ES_BULK_CHUNK_SIZE", 500))
+ES_BULK_MAX_CHUNK_BYTES = int(os.getenv("ES_BULK_MAX_CHUNK_BYTES", 20 * 1024 * 1024))
+
+BULK_RETRY_STATUSES = (429, 503)
+
+_clients = {}
+_clients_lock = Lock()
+
+
+def get_es_client(url=ELASTIC_URL, timeout=30):
+    """
+    Process-wide Elasticsearch client for url. Clients are thread-safe and keep
+    their pooled connections, so callers share one instead of building their own.
+    """
+    key = (url, timeout)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = Elasticsearch(
+                    [url],
+                    request_timeout=timeout,
+                    connections_per_node=ES_CONNECTIONS_PER_NODE,
+                    retry_on_timeout=True,
+                )
+                _clients[key] = client
+    return client
+
+
+def _action_key(op_type, doc_id):
+    return op_type, str(doc_id)
+
+
+def bulk_index(
+    actions, es=None, thread_count=ES_BULK_THREADS, chunk_size=ES_BULK_CHUNK_SIZE,
+    max_chunk_bytes=ES_BULK_MAX_CHUNK_BYTES, max_retries=5, initial_backoff=1, max_backoff=30
+):
+    """
+    Send bulk actions with parallel_bulk, in requests of at most chunk_size actions
+    and max_chunk_bytes, thread_count requests at a time. Documents rejected with
+    429 or 503 are sent again with jittered exponential backoff. Transport errors
+    and failed requests still raise, so an outage fails the chunk loudly.
+    Returns a list of (ok, item) per action, like the bulk helpers do.
+    """
+    es = es or get_es_client()
+    pending = list(actions)
+    results = []
+    attempt = 0
+    start_time = time()
+
+    while pending:
+        # bulk result items don't say which action they came from, match them by op and id
+        actions_by_key = defaultdict(deque)
+        for action in pending:
+            actions_by_key[_action_key(action.get("_op_type", "index"), action["_id"])].append(action)
+
+        retry_actions = []
+        for ok, item in parallel_bulk(
+            es, pending, thread_count=thread_count, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+            raise_on_error=False, raise_on_exception=True
+        ):
+            op_type, info = next(iter(item.items()))
+            matching_actions = actions_by_key[_action_key(op_type, info.get("_id"))]
+            action = matching_actions.popleft() if matching_actions else None
+            if not ok and action and info.get("status") in BULK_RETRY_STATUSES and attempt < max_retries:
+                retry_actions.append(action)
+            else:
+                results.append((ok, item))
+
+        pending = retry_actions
+        if pending:
+            backoff = random.uniform(0, min(max_backoff, initial_backoff * 2 ** attempt))
+            logger.warn(f"retrying {len(pending)} rejected bulk actions in {round(backoff, 2)} seconds")
+            sleep(backoff)
+            attempt += 1
+
+    logger.info(f"bulk indexed {len(results)} actions in {elapsed(start_time, 2)} seconds")
+    return results
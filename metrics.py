@@ -0,0 +1,188 @@
+import bisect
+import contextvars
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import logger
+from util import elapsed
+
+# where flush() writes metrics in the Prometheus text format, e.g. for a node_exporter textfile collector
+METRICS_FILE = os.getenv("METRICS_FILE")
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram, in seconds, with approximate percentiles."""
+    bucket_bounds = (
+        0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 0.75,
+        1, 1.5, 2, 3, 5, 7.5, 10, 15, 30, 60
+    )
+
+    def __init__(self):
+        self._lock = Lock()
+        self.bucket_counts = [0] * (len(self.bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        with self._lock:
+            self.bucket_counts[bisect.bisect_left(self.bucket_bounds, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        with self._lock:
+            if not self.count:
+                return None
+            rank = p / 100 * self.count
+            seen = 0
+            for i, bucket_count in enumerate(self.bucket_counts):
+                seen += bucket_count
+                if seen >= rank:
+                    return self.bucket_bounds[i] if i < len(self.bucket_bounds) else float('inf')
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 4) if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class StepMetrics:
+    """
+    Per-step latency histograms plus DB query and HTTP call counts, shared by all
+    threads in the process. Steps are recorded with timed_step; queries and calls
+    count toward the innermost step of the calling context. Pool tasks started
+    with submit() run in a copy of the submitter's context, so they count toward
+    its steps too. DB queries are only counted after enable_db_query_counts().
+
+    Totals are kept for the life of the process (for flush), and a second set is
+    reset by each chunk_summary so workers can log what one chunk cost.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._steps = contextvars.ContextVar('steps', default=())
+        self.db_query_counts_enabled = False
+        self.latency = defaultdict(LatencyHistogram)
+        self.db_queries = defaultdict(int)
+        self.http_calls = defaultdict(int)
+        self.chunk_latency = defaultdict(LatencyHistogram)
+        self.chunk_db_queries = defaultdict(int)
+        self.chunk_http_calls = defaultdict(int)
+
+    def enable_db_query_counts(self):
+        if not self.db_query_counts_enabled:
+            event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+            self.db_query_counts_enabled = True
+
+    def disable_db_query_counts(self):
+        if self.db_query_counts_enabled:
+            event.remove(Engine, "before_cursor_execute", self._before_cursor_execute)
+            self.db_query_counts_enabled = False
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count_db_query()
+
+    def current_step(self):
+        steps = self._steps.get()
+        return steps[-1] if steps else None
+
+    def submit(self, executor, fn, *args, **kwargs):
+        # each task needs its own copy, a context can't be entered by two threads at once
+        return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+    @contextmanager
+    def step(self, name, log=True):
+        token = self._steps.set(self._steps.get() + (name,))
+        start_time = time()
+        try:
+            yield
+        finally:
+            seconds = time() - start_time
+            self._steps.reset(token)
+            with self._lock:
+                histograms = (self.latency[name], self.chunk_latency[name])
+            for histogram in histograms:
+                histogram.observe(seconds)
+            if log:
+                logger.info(f'{name} took {elapsed(start_time, 2)} seconds')
+
+    def count_db_query(self):
+        if name := self.current_step():
+            with self._lock:
+                self.db_queries[name] += 1
+                self.chunk_db_queries[name] += 1
+
+    def count_http_call(self):
+        if name := self.current_step():
+            with self._lock:
+                self.http_calls[name] += 1
+                self.chunk_http_calls[name] += 1
+
+    def chunk_summary(self):
+        """Per-step stats since the last chunk_summary, slowest total first."""
+        with self._lock:
+            latency, self.chunk_latency = self.chunk_latency, defaultdict(LatencyHistogram)
+            db_queries, self.chunk_db_queries = self.chunk_db_queries, defaultdict(int)
+            http_calls, self.chunk_http_calls = self.chunk_http_calls, defaultdict(int)
+
+        summary = {}
+        for name, histogram in sorted(latency.items(), key=lambda item: -item[1].total):
+            summary[name] = dict(
+                histogram.summary(),
+                total=round(histogram.total, 4),
+                db_queries=db_queries.get(name, 0) if self.db_query_counts_enabled else None,
+                http_calls=http_calls.get(name, 0),
+            )
+        return summary
+
+    def prometheus_text(self):
+        lines = [
+            '# TYPE openalex_step_seconds histogram',
+        ]
+        with self._lock:
+            latency = dict(self.latency)
+            db_queries = dict(self.db_queries)
+            http_calls = dict(self.http_calls)
+
+        for name, histogram in sorted(latency.items()):
+            with histogram._lock:
+                bucket_counts = list(histogram.bucket_counts)
+                count, total = histogram.count, histogram.total
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.bucket_bounds, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'openalex_step_seconds_bucket{{step="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'openalex_step_seconds_bucket{{step="{name}",le="+Inf"}} {count}')
+            lines.append(f'openalex_step_seconds_sum{{step="{name}"}} {total}')
+            lines.append(f'openalex_step_seconds_count{{step="{name}"}} {count}')
+
+        lines.append('# TYPE openalex_step_db_queries_total counter')
+        for name, count in sorted(db_queries.items()):
+            lines.append(f'openalex_step_db_queries_total{{step="{name}"}} {count}')
+        lines.append('# TYPE openalex_step_http_calls_total counter')
+        for name, count in sorted(http_calls.items()):
+            lines.append(f'openalex_step_http_calls_total{{step="{name}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def flush(self, path=METRICS_FILE):
+        if not path:
+            return
+        # write and rename so readers never see a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+step_metrics = StepMetrics()
+timed_step = step_metrics.step
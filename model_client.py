@@ -0,0 +1,176 @@
+import os
+import random
+from threading import BoundedSemaphore, Lock
+from time import sleep, time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import logger
+from metrics import LatencyHistogram, step_metrics
+
+CONCEPT_TAGGER_URL = "https://l7a8sw8o2a.execute-api.us-east-1.amazonaws.com/api/"  # for version with abstracts
+TOPIC_CLASSIFIER_URL = "https://5gl84dua69.execute-api.us-east-1.amazonaws.com/api/"
+INSTITUTION_MATCHER_URL = "https://ybb43coxn4.execute-api.us-east-1.amazonaws.com/api/"  # institution lookup endpoint
+
+
+class StubResponse:
+    """The parts of requests.Response the model callers use."""
+    def __init__(self, status_code, json_data=None, text='', reason=''):
+        self.status_code = status_code
+        self._json_data = json_data
+        self.text = text
+        self.reason = reason
+
+    def json(self):
+        return self._json_data
+
+    def __repr__(self):
+        return f"<StubResponse [{self.status_code}]>"
+
+
+class RequestsTransport:
+    """Posts with a keep-alive session, so calls reuse pooled TLS connections."""
+    def __init__(self, pool_size):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def __call__(self, url, json_body, headers, timeout):
+        return self.session.post(url, json=json_body, headers=headers, timeout=timeout)
+
+
+class StubTransport:
+    """
+    Local transport for tests and offline runs. handler gets the json body and
+    returns a StubResponse, or a (status_code, json_data) tuple.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = []
+
+    def __call__(self, url, json_body, headers, timeout):
+        self.calls.append(json_body)
+        response = self.handler(json_body)
+        if isinstance(response, tuple):
+            response = StubResponse(*response)
+        return response
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after max_failures consecutive failed calls, then lets a trial call
+    through after reset_seconds. A call counts once, after its retries run out.
+    """
+    def __init__(self, max_failures, reset_seconds):
+        self.max_failures = max_failures
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time() - self.opened_at >= self.reset_seconds:
+                # half open: one call decides whether we close again
+                self.opened_at = time()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.opened_at = time()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class ModelEndpoint:
+    """
+    Client for one model API endpoint: pooled connections, at most max_concurrency
+    calls in flight, jittered exponential backoff on retryable statuses and
+    connection errors, latency histogram and a circuit breaker.
+
+    post() returns the last response, so callers keep checking status_code. The
+    breaker is checked once per call and only calls that run out of retries count
+    as failures. While it is open post() raises CircuitOpenError without calling
+    the endpoint, so the chunk fails and is retried instead of being stored
+    without results.
+    """
+    retry_statuses = (500, 502, 503, 504)
+
+    def __init__(
+        self, name, url, max_concurrency=8, timeout=60, max_retries=10,
+        backoff_base=0.5, backoff_max=8, breaker_failures=20, breaker_reset_seconds=30, transport=None
+    ):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.transport = transport or RequestsTransport(pool_size=max_concurrency)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset_seconds)
+        self.latency = LatencyHistogram()
+        self._slots = BoundedSemaphore(max_concurrency)
+
+    def headers(self):
+        return {"X-API-Key": os.getenv("SAGEMAKER_API_KEY")}
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def post(self, json_body, max_retries=None):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} model endpoint circuit is open, not calling {self.url}")
+
+        attempt = 0
+        while True:
+            start_time = time()
+            step_metrics.count_http_call()
+            try:
+                with self._slots:
+                    r = self.transport(self.url, json_body, self.headers(), self.timeout)
+            except requests.exceptions.RequestException as e:
+                self.latency.observe(time() - start_time)
+                if attempt >= max_retries:
+                    self.breaker.record_failure()
+                    raise
+                logger.error(f"{self.name} model endpoint error on try #{attempt}, now trying again: {e}")
+            else:
+                self.latency.observe(time() - start_time)
+                if r.status_code not in self.retry_statuses:
+                    self.breaker.record_success()
+                    return r
+
+                if attempt >= max_retries:
+                    self.breaker.record_failure()
+                    return r
+                logger.error(f"Error on try #{attempt}, now trying again: Error back from API endpoint: {r} {r.status_code}")
+
+            sleep(self.backoff(attempt))
+            attempt += 1
+
+    def stats(self):
+        return {'latency': self.latency.summary(), 'circuit_open': self.breaker.is_open}
+
+
+concept_tagger = ModelEndpoint('concept tagger', CONCEPT_TAGGER_URL)
+topic_classifier = ModelEndpoint('topic classifier', TOPIC_CLASSIFIER_URL)
+institution_matcher = ModelEndpoint('institution matcher', INSTITUTION_MATCHER_URL)
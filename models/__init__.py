@@ -1,4 +1,4 @@
-from sqlalchemy import and_, or_, orm, func
+from sqlalchemy import and_, or_, orm, func, event
 from sqlalchemy.orm import foreign, remote, selectinload
 
 from app import db
@@ -13,7 +13,7 @@ from models.citation import Citation, CitationUnmatched
 from models.concept import Concept
 from models.concept_ancestor import ConceptAncestor
 from models.counts import AuthorCountsByYearPapers, AuthorCountsByYearCitations
-from models.counts import CitationPercentilesByYear
+from models.counts import CitationPercentilesByYear, citation_percentile_table
 from models.counts import ConceptCountsByYear
 from models.counts import InstitutionCountsByYearPapers, InstitutionCountsByYearCitations
 from models.counts import SourceCountsByYearPapers, SourceCountsByYearCitations
@@ -59,13 +59,14 @@ from models.source_topic import SourceTopic
 from models.work_type import WorkType
 from models.work_related_version import WorkRelatedVersion
 from models.unpaywall import Unpaywall
-from models.work import Work
+from models.work import Work, invalidate_record_index
 from models.work_keyword import WorkKeyword
 from models.work_concept import WorkConcept
 from models.work_topic import WorkTopic
 from models.work_extra_id import WorkExtraIds
 from models.work_related_work import WorkRelatedWork
 from models.work_fwci import WorkFWCI
+from models.work_store_fingerprint import WorkStoreFingerprint
 from models.work_citations_normalized_percentile import WorkCitationNormPer
 from util import normalize
 
@@ -82,6 +83,8 @@ Work.journal = db.relationship("Source", lazy='selectin', backref="work", uselis
 Work.extra_ids = db.relationship("WorkExtraIds", lazy='selectin', backref="work", cascade="all, delete-orphan")
 Work.related_works = db.relationship("WorkRelatedWork", lazy='selectin', backref="work", cascade="all, delete-orphan")
 Work.records = db.relationship("Record", lazy='selectin', backref="work")  # normally don't get, just for add_everything
+for record_event in ('append', 'remove', 'bulk_replace'):
+    event.listen(Work.records, record_event, invalidate_record_index)
 WorkFunder.funder = db.relationship("Funder", lazy='selectin', uselist=False)
 Work.openapc = db.relationship("WorkOpenAPC", uselist=False)
 Work.embeddings = db.relationship("WorkEmbedding", uselist=False)
@@ -89,6 +92,7 @@ Work.sdg = db.relationship("WorkSDG", uselist=False)
 Work.doi_ra = db.relationship("DOIRegistrationAgency", lazy='selectin', uselist=False)
 Work.retraction_watch = db.relationship("RetractionWatch", lazy='selectin', uselist=False)
 Work.work_fwci = db.relationship("WorkFWCI", lazy='selectin', uselist=False)
+Work.store_fingerprint = db.relationship("WorkStoreFingerprint", uselist=False, passive_deletes='all')
 Work.work_citations_norm_percentile = db.relationship("WorkCitationNormPer", lazy='selectin', uselist=False)
 Work.institution_assertions = db.relationship("InstitutionAssertions", lazy='selectin', cascade="all, delete-orphan")
 InstitutionAssertions.institution = db.relationship("Institution", lazy='selectin', uselist=False)
@@ -1,5 +1,6 @@
 from app import db
 from models.institution import DELETED_INSTITUTION_ID
+from models.minimum_dict_cache import minimum_dict_cache
 
 
 class Affiliation(db.Model):
@@ -22,7 +23,17 @@ class Affiliation(db.Model):
     def update(self):
         pass
 
-    def to_dict(self, return_level="full"):
+    @staticmethod
+    def minimum_dict(obj, nested_dicts=None):
+        # authors are too many for minimum_dict_cache, callers serializing many
+        # affiliations at once can pass nested_dicts to memoize them per call
+        if nested_dicts is None:
+            return obj.to_dict(return_level="minimum")
+        if id(obj) not in nested_dicts:
+            nested_dicts[id(obj)] = obj.to_dict(return_level="minimum")
+        return nested_dicts[id(obj)]
+
+    def to_dict(self, return_level="full", nested_dicts=None):
         response = {}
 
         # author_position set in works
@@ -39,9 +50,9 @@ class Affiliation(db.Model):
 
         # overwrite display name with better ones from these dicts if we have them
         if self.author:
-            response["author"].update(self.author.to_dict(return_level="minimum"))
+            response["author"].update(self.minimum_dict(self.author, nested_dicts))
         if self.institution and self.institution.affiliation_id != DELETED_INSTITUTION_ID:
-            response["institution"].update(self.institution.to_dict(return_level="minimum"))
+            response["institution"].update(minimum_dict_cache.get(self.institution))
 
         response["author_sequence_number"] = self.author_sequence_number
         response["raw_author_name"] = self.original_author
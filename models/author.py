@@ -9,6 +9,7 @@ from app import MAX_MAG_ID
 from app import db
 from app import get_apiurl_from_openalex_url
 from app import logger
+from models.minimum_dict_cache import minimum_dict_cache
 from util import entity_md5
 from util import truncate_on_word_break
 
@@ -268,7 +269,7 @@ class Author(db.Model):
             if dt == max_dt and affil.affiliation_id not in last_affil_ids:
                 last_affil_ids.add(affil.affiliation_id)
                 if affil.institution:
-                    last_known_institutions.append(affil.institution.to_dict("minimum"))
+                    last_known_institutions.append(minimum_dict_cache.get(affil.institution))
             else:
                 break
         return last_known_institutions
@@ -301,7 +302,7 @@ class Author(db.Model):
         for institution, years in sorted_institutions:
             formatted_affiliations.append(
                 {
-                    "institution": institution.to_dict("minimum"),
+                    "institution": minimum_dict_cache.get(institution),
                     "years": sorted(years, reverse=True)[:max_years]
                 }
             )
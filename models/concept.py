@@ -1,10 +1,10 @@
 import datetime
 import json
 import urllib.parse
+from collections import namedtuple
 
 import requests
 from cached_property import cached_property
-from sqlalchemy import orm
 from sqlalchemy import text
 
 from app import CONCEPTS_INDEX
@@ -541,13 +541,31 @@ class Concept(db.Model):
         return "<Concept ( {} ) {} {}>".format(self.openalex_api_url, self.id, self.display_name)
 
 
-logger.info(f"loading valid concept IDs")
-_valid_concepts = db.session.query(Concept.field_of_study_id).options(orm.Load(Concept).raiseload('*')).all()
-_valid_concept_ids = set([c.field_of_study_id for c in _valid_concepts])
+# the concept fields work tagging needs, so it doesn't load a Concept per tag
+ConceptMetadata = namedtuple('ConceptMetadata', ['keyword_id', 'use_as_keyword', 'level'])
+
+logger.info(f"loading concept metadata")
+_concept_metadata_rows = db.session.query(
+    Concept.field_of_study_id, Concept.keyword_id, Concept.use_as_keyword, Concept.level
+).all()
+_concept_metadata = {
+    row.field_of_study_id: ConceptMetadata(
+        keyword_id=row.keyword_id,
+        use_as_keyword=bool(row.use_as_keyword),
+        level=int(row.level) if row.level is not None else None
+    )
+    for row in _concept_metadata_rows
+}
+del _concept_metadata_rows
 
 
 def is_valid_concept_id(concept_id):
-    return concept_id and concept_id in _valid_concept_ids
+    return concept_id and concept_id in _concept_metadata
+
+
+def get_concept_metadata(concept_id):
+    """Returns the ConceptMetadata for a valid concept id, otherwise None."""
+    return _concept_metadata.get(concept_id) if concept_id else None
 
 
 class ConceptJsonEntityHash(db.Model):
@@ -0,0 +1,75 @@
+import re
+
+from app import COUNTRIES
+
+# aliases are used as regexes, not literals ("U.K.", "Virgin Islands (U.S.)"),
+# so the anchor is the longest run of plain characters any match has to contain
+_regex_metachars = re.compile(r"[.()]")
+_unanchorable = re.compile(r"[\^$*+?{}\[\]\\|]")
+
+
+def _anchor(pattern):
+    if _unanchorable.search(pattern):
+        return None
+    return max(_regex_metachars.split(pattern), key=len) or None
+
+
+class CountryMatcher:
+    """
+    Country codes named in a raw affiliation string, matched the same way as
+    the original per-alias re.search passes: whole words, then whole words with
+    dots removed from the string, then anywhere, then whole words lowercased.
+    The first pass that finds a country wins.
+
+    Alias regexes are compiled once per pass. Each one only runs when its
+    anchor substring is in the string, which rules out almost all of them with
+    a plain `in` check.
+    """
+    def __init__(self, countries):
+        self.word_aliases = self.compile(countries, word_boundaries=True)
+        self.substring_aliases = self.compile(countries, word_boundaries=False)
+        self.lower_word_aliases = self.compile(countries, word_boundaries=True, lower=True)
+
+    @staticmethod
+    def compile(countries, word_boundaries, lower=False):
+        aliases = []
+        for code, names in countries.items():
+            for name in names:
+                if lower:
+                    name = name.lower()
+                pattern = re.compile(fr"\b{name}\b" if word_boundaries else fr"{name}")
+                aliases.append((code, _anchor(name), pattern))
+        return aliases
+
+    @staticmethod
+    def search(aliases, text):
+        found = set()
+        for code, anchor, pattern in aliases:
+            if code in found or (anchor is not None and anchor not in text):
+                continue
+            if pattern.search(text):
+                found.add(code)
+        return found
+
+    def countries(self, raw_affiliation):
+        found = self.search(self.word_aliases, raw_affiliation)
+        if not found:
+            # Replace '.' to see if match can be found
+            found = self.search(self.word_aliases, raw_affiliation.replace(".", ""))
+        if not found:
+            # Remove word boundary requirement
+            found = self.search(self.substring_aliases, raw_affiliation)
+        if not found:
+            # Lowercase all text to catch weird capitalizations
+            found = self.search(self.lower_word_aliases, raw_affiliation.lower())
+
+        final_countries = sorted(found)
+
+        # If we match to Georgia countries GE or GS, remove US match that came from short state string
+        if ("GE" in final_countries or "GS" in final_countries) and "US" in final_countries:
+            final_countries.remove("US")
+
+        return final_countries
+
+
+country_matcher = CountryMatcher(COUNTRIES)
@@ -1,10 +1,17 @@
-from elasticsearch import Elasticsearch
+from collections import defaultdict
+from threading import Lock
+from time import time
+
+import numpy as np
 from elasticsearch_dsl import Search
 from redis import Redis
 from requests_cache import CachedSession, RedisCache
 from sqlalchemy import PrimaryKeyConstraint
 
-from app import db, ELASTIC_URL, REDIS_URL, WORKS_INDEX
+from app import db, REDIS_URL, WORKS_INDEX
+from app import logger
+from es_client import get_es_client
+from util import elapsed
 
 
 class AuthorCounts(db.Model):
@@ -534,6 +541,96 @@ class CitationPercentilesByYear(db.Model):
         )
 
 
+class CitationPercentileTable:
+    """
+    citation_percentiles_by_year_mv held in memory as per-year arrays sorted by
+    citation_count, so a work's percentile range is a bisect instead of three queries.
+
+    Percentiles are stored as int(round(percentile * 100)), computed from the
+    database values, so results match the query-based lookup exactly.
+    Loaded on first use and reloaded after refresh_seconds, or by calling refresh().
+    """
+    def __init__(self, refresh_seconds=24 * 60 * 60):
+        self.refresh_seconds = refresh_seconds
+        self.years = None  # year -> (sorted citation counts, percents)
+        self.loaded_at = None
+        self._lock = Lock()
+
+    def load(self):
+        logger.info("loading citation percentiles by year")
+        start_time = time()
+        rows = db.session.query(
+            CitationPercentilesByYear.year,
+            CitationPercentilesByYear.citation_count,
+            CitationPercentilesByYear.percentile
+        ).all()
+
+        by_year = defaultdict(list)
+        for year, citation_count, percentile in rows:
+            by_year[int(year)].append((float(citation_count), int(round(percentile * 100))))
+
+        years = {}
+        for year, year_rows in by_year.items():
+            year_rows.sort()
+            years[year] = (
+                np.array([r[0] for r in year_rows], dtype=np.float64),
+                np.array([r[1] for r in year_rows], dtype=np.int16)
+            )
+
+        self.years = years
+        self.loaded_at = time()
+        logger.info(f"loaded {len(rows)} citation percentiles in {elapsed(start_time, 2)} seconds")
+
+    def refresh(self):
+        with self._lock:
+            self.load()
+
+    def refresh_if_stale(self):
+        if self.years is not None and time() - self.loaded_at < self.refresh_seconds:
+            return
+
+        # one thread reloads, the others keep using the current table
+        if self._lock.acquire(blocking=self.years is None):
+            try:
+                if self.years is None or time() - self.loaded_at >= self.refresh_seconds:
+                    self.load()
+            finally:
+                self._lock.release()
+
+    def lookup(self, year, citation_count):
+        """
+        Returns (lower percent, higher percent) for a work with citation_count
+        citations published in year (already clamped by the caller), or None.
+
+        Same rules as the old queries: an exact row pairs with the next higher
+        row, otherwise the closest lower and higher rows are used, and the
+        highest row stands in for the higher row when the count is above
+        every row in the table.
+        """
+        self.refresh_if_stale()
+        if (year_table := self.years.get(int(year))) is None:
+            return None
+
+        counts, percents = year_table
+        citation_count = float(citation_count)
+        i = int(np.searchsorted(counts, citation_count, side='left'))
+        exact = i < len(counts) and counts[i] == citation_count
+        higher_i = i + 1 if exact else i
+        if higher_i >= len(counts):
+            higher_i = len(counts) - 1
+
+        if exact:
+            return int(percents[i]), int(percents[higher_i])
+
+        if i == 0:
+            # nothing lower
+            return None
+        return int(percents[i - 1]), int(percents[higher_i])
+
+
+citation_percentile_table = CitationPercentileTable()
+
+
 class TopicCounts(db.Model):
     __table_args__ = {"schema": "mid"}
     __tablename__ = "citation_topics_mv"
@@ -625,8 +722,7 @@ def works_count_from_api(group_by_key, id):
 
 
 def fetch_citation_sum(key, id):
-    es = Elasticsearch([ELASTIC_URL], timeout=30)
-    s = Search(using=es, index=WORKS_INDEX)
+    s = Search(using=get_es_client(), index=WORKS_INDEX)
     s = s.query("term", **{key: id})
     s.aggs.bucket("citation_count", "sum", field="cited_by_count")
     response = s.execute()
@@ -652,8 +748,7 @@ def citation_count_from_elastic(key, id):
 
 
 def fetch_works_count(key, id):
-    es = Elasticsearch([ELASTIC_URL], timeout=30)
-    s = Search(using=es, index=WORKS_INDEX).query("term", **{key: id})
+    s = Search(using=get_es_client(), index=WORKS_INDEX).query("term", **{key: id})
     return s.count()
 
 
@@ -2,14 +2,17 @@ import datetime
 import json
 import os
 import urllib.parse
-from time import sleep
+from threading import Lock
 
 import requests
 from cached_property import cached_property
+from cachetools import TTLCache
+from sqlalchemy import event
 from sqlalchemy import orm
 from sqlalchemy import text
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import selectinload
 
 from app import COUNTRIES_ENDPOINT_PREFIX
@@ -20,6 +23,9 @@ from app import db
 from app import get_apiurl_from_openalex_url
 from app import logger
 from const import SUPER_SYSTEM_INSTITUTIONS
+from model_client import institution_matcher
+from models.merge_resolver import MergeResolver
+from models.minimum_dict_cache import minimum_dict_cache
 from util import entity_md5
 
 DELETED_INSTITUTION_ID = 4389424196
@@ -30,11 +36,117 @@ def as_institution_openalex_id(id):
     return f"{API_HOST}/I{id}"
 
 def follow_merged_into_id(lookup_institution_id):
-    if not lookup_institution_id:
-        return lookup_institution_id
-    global merged_into_institutions_dict
-    merged_id = merged_into_institutions_dict.get(lookup_institution_id, lookup_institution_id)
-    return merged_id
+    return institution_merge_resolver.resolve(lookup_institution_id)
+
+
+class AffiliationStringCache:
+    """
+    Process-wide LRU of affiliation string -> resolved institution ids, so strings
+    seen recently skip the AffiliationString query. Entries expire after ttl
+    seconds, so changes to affiliation_ids_override are picked up eventually.
+
+    Strings resolved inside a transaction are held on its session by
+    set_after_commit and only cached once it commits. Ids whose AffiliationString
+    insert was rolled back would otherwise keep later works from inserting it.
+    """
+    pending_key = 'pending_affiliation_strings'
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, original_affiliation):
+        with self._lock:
+            institution_ids = self._cache.get(original_affiliation)
+            if institution_ids is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(institution_ids)
+
+    def set(self, original_affiliation, institution_ids):
+        with self._lock:
+            self._cache[original_affiliation] = tuple(institution_ids)
+
+    def set_after_commit(self, session, original_affiliation, institution_ids):
+        session.info.setdefault(self.pending_key, {})[original_affiliation] = tuple(institution_ids)
+
+    def commit_pending(self, session):
+        if pending := session.info.pop(self.pending_key, None):
+            with self._lock:
+                self._cache.update(pending)
+
+    def discard_pending(self, session):
+        session.info.pop(self.pending_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+affiliation_string_cache = AffiliationStringCache(
+    maxsize=int(os.getenv('AFFILIATION_STRING_CACHE_SIZE', 200000)),
+    ttl=int(os.getenv('AFFILIATION_STRING_CACHE_TTL', 3600))
+)
+
+
+class InsertClaims:
+    """
+    Keys of unique-indexed rows (affiliation strings) that an open transaction
+    in this process is inserting. A second session inserting the same key
+    would wait on the first one's uncommitted index entry, even with
+    on_conflict_do_nothing, so it skips the insert and leaves the row to the
+    session that claimed it. Claims are released when that transaction ends.
+    """
+    def __init__(self, name):
+        self.name = name
+        self._owners = {}
+        self._lock = Lock()
+
+    def claim(self, session, key):
+        with self._lock:
+            owner = self._owners.setdefault(key, session.hash_key)
+        if owner != session.hash_key:
+            return False
+        session.info.setdefault(self.name, set()).add(key)
+        return True
+
+    def release(self, session):
+        keys = session.info.pop(self.name, ())
+        with self._lock:
+            for key in keys:
+                if self._owners.get(key) == session.hash_key:
+                    del self._owners[key]
+
+
+affiliation_string_inserts = InsertClaims('claimed_affiliation_strings')
+ror_affiliation_string_inserts = InsertClaims('claimed_ror_affiliation_strings')
+
+
+@event.listens_for(Session, "after_commit")
+def cache_committed_affiliation_strings(session):
+    affiliation_string_cache.commit_pending(session)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def end_affiliation_string_transaction(session, transaction):
+    # rollback or close without a commit, after_commit has already taken committed ones
+    if transaction.parent is None:
+        affiliation_string_cache.discard_pending(session)
+        affiliation_string_inserts.release(session)
+        ror_affiliation_string_inserts.release(session)
 
 
 class Institution(db.Model):
@@ -441,9 +553,6 @@ class Institution(db.Model):
             return [], False
 
         name_to_ids_dict = dict([(n, [None]) for n in institution_names])
-        known_names = AffiliationString.query.filter(
-            AffiliationString.original_affiliation.in_(institution_names)
-        ).all()
 
         is_curation_request = False
 
@@ -459,6 +568,18 @@ class Institution(db.Model):
                     else:
                         aff_change_dict[curation_request.original_affiliation] = {'add': add_affs, 'remove': remove_affs}
 
+        # strings with curation requests always go to the database and are never cached
+        lookup_names = []
+        for name in name_to_ids_dict.keys():
+            if name not in aff_change_dict and (cached_ids := affiliation_string_cache.get(name)) is not None:
+                name_to_ids_dict[name] = cached_ids
+            else:
+                lookup_names.append(name)
+
+        known_names = AffiliationString.query.filter(
+            AffiliationString.original_affiliation.in_(lookup_names)
+        ).all() if lookup_names else []
+
         for known_name in known_names:
             known_ids = known_name.affiliation_ids_override or known_name.affiliation_ids
             if known_name.original_affiliation in aff_change_dict.keys():
@@ -466,73 +587,61 @@ class Institution(db.Model):
                 known_ids = [i for i in known_ids + aff_change_dict[known_name.original_affiliation]['add'] 
                              if i not in aff_change_dict[known_name.original_affiliation]['remove']]
             name_to_ids_dict[known_name.original_affiliation] = [follow_merged_into_id(k) for k in known_ids]
+            if known_name.original_affiliation not in aff_change_dict:
+                affiliation_string_cache.set_after_commit(
+                    db.session(), known_name.original_affiliation, name_to_ids_dict[known_name.original_affiliation])
 
-        unknown_names = [
-            name for name in name_to_ids_dict.keys()
-            if name not in
-            [k.original_affiliation for k in known_names]
-        ]
+        known_name_strings = set(k.original_affiliation for k in known_names)
+        unknown_names = [name for name in lookup_names if name not in known_name_strings]
 
         if unknown_names:
-            api_key = os.getenv("SAGEMAKER_API_KEY")
             data = [{"affiliation_string": unknown_name} for unknown_name in unknown_names]
-            headers = {"X-API-Key": api_key}
-            api_url = "https://ybb43coxn4.execute-api.us-east-1.amazonaws.com/api/" # institution lookup endpoint
-
-            number_tries = 0
-            keep_calling = True
-            while keep_calling:
-                r = requests.post(api_url, json=json.dumps(data), headers=headers)
-
-                if r.status_code == 200:
-                    try:
-                        response_json = r.json()
-                        institution_id_lists = [my_dict["affiliation_id"] for my_dict in response_json]
-                        # now replace any that have been merged with what they have been merged into
-                        institution_id_lists = [
-                            [follow_merged_into_id(inst_id) for inst_id in id_list]
-                            for id_list in institution_id_lists
-                        ]
-
-                        for i, institution_ids in enumerate(institution_id_lists):
-                            unknown_name = unknown_names[i]
-
-                            if institution_ids == [-1] or institution_ids == []:
-                                institution_ids = [None]
-                            else:
-                                if ror_match and ror_match not in institution_ids:
-                                    institution_ids.append(follow_merged_into_id(ror_match))
-
-                            name_to_ids_dict[unknown_name] = institution_ids
-
-                            if len(unknown_names[i].encode('utf-8')) > 2700:
-                                # postgres limit for b-tree indices
-                                continue
-
-                            db.session.execute(
-                                insert(AffiliationString).values(
-                                    original_affiliation=unknown_name,
-                                    affiliation_ids=institution_ids
-                                ).on_conflict_do_nothing(index_elements=['original_affiliation'])
-                            )
-
-                        break
-
-                    except Exception as e:
-                        logger.error(f"Error, not retrying: {e} in get_institution_ids_from_strings with {cls.id}, response {r}, called with {api_url} data: {data} headers: {headers}")
-                        break
-
-                elif r.status_code == 500:
-                    logger.error(f"Error on try #{number_tries}, now trying again: Error back from API endpoint: {r} {r.status_code}")
-                    number_tries += 1
-                    if number_tries > retry_attempts:
-                        keep_calling = False
-                    else:
-                        sleep(1)
 
-                else:
-                    logger.error(f"Error, not retrying: Error back from API endpoint: {r} {r.status_code} {r.text} for input {data}")
-                    keep_calling = False
+            r = institution_matcher.post(json.dumps(data), max_retries=retry_attempts)
+
+            if r.status_code == 200:
+                try:
+                    response_json = r.json()
+                    institution_id_lists = [my_dict["affiliation_id"] for my_dict in response_json]
+                    # now replace any that have been merged with what they have been merged into
+                    institution_id_lists = [
+                        [follow_merged_into_id(inst_id) for inst_id in id_list]
+                        for id_list in institution_id_lists
+                    ]
+
+                    for i, institution_ids in enumerate(institution_id_lists):
+                        unknown_name = unknown_names[i]
+
+                        if institution_ids == [-1] or institution_ids == []:
+                            institution_ids = [None]
+                        else:
+                            if ror_match and ror_match not in institution_ids:
+                                institution_ids.append(follow_merged_into_id(ror_match))
+
+                        name_to_ids_dict[unknown_name] = institution_ids
+
+                        if len(unknown_names[i].encode('utf-8')) > 2700:
+                            # postgres limit for b-tree indices
+                            continue
+
+                        if not affiliation_string_inserts.claim(db.session(), unknown_name):
+                            # another session in this process is inserting it, don't wait on its row
+                            continue
+
+                        db.session.execute(
+                            insert(AffiliationString).values(
+                                original_affiliation=unknown_name,
+                                affiliation_ids=institution_ids
+                            ).on_conflict_do_nothing(index_elements=['original_affiliation'])
+                        )
+                        if unknown_name not in aff_change_dict:
+                            affiliation_string_cache.set_after_commit(db.session(), unknown_name, institution_ids)
+
+                except Exception as e:
+                    logger.error(f"Error, not retrying: {e} in get_institution_ids_from_strings, response {r}, called with {institution_matcher.url} data: {data}")
+
+            else:
+                logger.error(f"Error, not retrying: Error back from API endpoint: {r} {r.status_code} {r.text} for input {data}")
 
         final_name_to_ids_dict = dict()
 
@@ -604,7 +713,7 @@ class Institution(db.Model):
                     "mag": self.affiliation_id if self.affiliation_id < MAX_MAG_ID else None
                 },
                 "roles": self.roles,
-                "repositories": [s.to_dict(return_level="minimum") for s in self.repositories if s.merge_into_id is None],
+                "repositories": [minimum_dict_cache.get(s) for s in self.repositories if s.merge_into_id is None],
                 "geo": {
                     "city": self.city,
                     "geonames_city_id": self.geonames_city_id,
@@ -636,9 +745,8 @@ class Institution(db.Model):
         return "<Institution ( {} ) {} {}>".format(self.openalex_api_url, self.id, self.display_name)
 
 
-logger.info(f"loading merged_into_institutions_dict")
-merged_into_institutions = db.session.query(Institution).options(orm.Load(Institution).raiseload('*')).filter(Institution.merge_into_id != None).all()
-merged_into_institutions_dict = dict((inst.affiliation_id, inst.merge_into_id) for inst in merged_into_institutions)
+institution_merge_resolver = MergeResolver(Institution.affiliation_id, Institution.merge_into_id)
+institution_merge_resolver.load()
 
 
 class AffiliationString(db.Model):
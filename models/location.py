@@ -1,6 +1,7 @@
 import json
 
 from app import db
+from models.minimum_dict_cache import minimum_dict_cache
 
 
 def get_repository_institution_from_source_url(source_url):
@@ -206,7 +207,7 @@ class Location(db.Model):
 
     def to_locations_dict(self):
         return {
-            'source': self.journal and self.journal.to_dict(return_level='minimum'),
+            'source': self.journal and minimum_dict_cache.get(self.journal),
             'pdf_url': self.url_for_pdf,
             'landing_page_url': self.url_for_landing_page or self.source_url,
             'is_oa': self.is_oa,
@@ -0,0 +1,85 @@
+from threading import Lock
+from time import time
+
+from app import db
+from app import logger
+from util import elapsed
+
+
+class MergeResolver:
+    """
+    In-memory map from merged entity ids to the id at the end of their merge chain.
+
+    The map is loaded with one query, chains are followed once at load time so a
+    lookup is a single dict get, and it's reloaded every refresh_seconds.
+    Works for any model with an id column and a merge_into_id column, e.g.
+    MergeResolver(Source.journal_id, Source.merge_into_id).
+    """
+    def __init__(self, id_column, merge_into_column, refresh_seconds=3600):
+        self.id_column = id_column
+        self.merge_into_column = merge_into_column
+        self.refresh_seconds = refresh_seconds
+        self.name = str(id_column)
+        self.merged_into = None
+        self.loaded_at = None
+        self._lock = Lock()
+
+    def load(self):
+        logger.info(f"loading merged ids for {self.name}")
+        start_time = time()
+        rows = db.session.query(self.id_column, self.merge_into_column).filter(
+            self.merge_into_column != None
+        ).all()
+        self.merged_into = self.resolve_chains(dict(rows))
+        self.loaded_at = time()
+        logger.info(f"loaded {len(self.merged_into)} merged ids for {self.name} in {elapsed(start_time, 2)} seconds")
+
+    def refresh_if_stale(self):
+        if self.merged_into is not None and time() - self.loaded_at < self.refresh_seconds:
+            return
+
+        # one thread reloads, the others keep using the current map
+        if self._lock.acquire(blocking=self.merged_into is None):
+            try:
+                if self.merged_into is None or time() - self.loaded_at >= self.refresh_seconds:
+                    self.load()
+            finally:
+                self._lock.release()
+
+    def resolve(self, entity_id):
+        if not entity_id:
+            return entity_id
+        self.refresh_if_stale()
+        return self.merged_into.get(entity_id, entity_id)
+
+    @staticmethod
+    def resolve_chains(merge_into):
+        """
+        Map every id in merge_into to the last id of its chain. Ids that are part of
+        a merge cycle aren't followed, they resolve to themselves.
+        """
+        resolved = {}
+        for start_id in merge_into:
+            if start_id in resolved:
+                continue
+
+            path = []
+            on_path = set()
+            current_id = start_id
+            while current_id in merge_into and current_id not in resolved and current_id not in on_path:
+                path.append(current_id)
+                on_path.add(current_id)
+                current_id = merge_into[current_id]
+
+            if current_id in on_path:
+                cycle = path[path.index(current_id):]
+                logger.warn(f"merge cycle, not following: {cycle}")
+                for cycle_id in cycle:
+                    resolved[cycle_id] = cycle_id
+                path = path[:path.index(current_id)]
+
+            target_id = resolved.get(current_id, current_id)
+            for path_id in path:
+                resolved[path_id] = target_id
+
+        return {entity_id: target_id for entity_id, target_id in resolved.items() if entity_id != target_id}
@@ -31,7 +31,8 @@ def normalized_authors_has_affiliations(normalized_authors):
 def clone_record(record):
     from models import Record
     exclude_attrs = {'_sa_instance_state',
-                     'insert_dict'}
+                     'insert_dict',
+                     '_json_views'}
     parent_record_d = {k: v for k, v in record.__dict__.items() if
                        k not in exclude_attrs}
     cloned = Record(**parent_record_d)
@@ -0,0 +1,87 @@
+import os
+from threading import Lock
+
+from cachetools import TTLCache
+
+
+class FrozenDict(dict):
+    """
+    A dict that raises on every in-place change. Still a dict, so json.dumps,
+    entity hashing and isinstance checks treat it like any other.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f"{type(self).__name__} is shared and can't be changed, copy it first")
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return value if isinstance(value, FrozenDict) else FrozenDict({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class MinimumDictCache:
+    """
+    Process-wide LRU of to_dict("minimum") for sources and institutions, which
+    get embedded in thousands of works and authors per chunk. Entries are keyed
+    by entity id and updated_date and expire after ttl seconds, so changes to
+    related rows (publishers, ancestors) are picked up eventually.
+
+    Values are frozen snapshots shared by every caller: copy before changing.
+    """
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, entity):
+        # embedded related institutions carry a per-object relationship_status
+        if hasattr(entity, "relationship_status"):
+            return entity.to_dict(return_level="minimum")
+
+        key = (type(entity).__name__, entity.id, entity.updated_date)
+        with self._lock:
+            minimum_dict = self._cache.get(key)
+            if minimum_dict is not None:
+                self.hits += 1
+                return minimum_dict
+            self.misses += 1
+
+        minimum_dict = freeze(entity.to_dict(return_level="minimum"))
+        with self._lock:
+            self._cache[key] = minimum_dict
+        return minimum_dict
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+            }
+
+
+minimum_dict_cache = MinimumDictCache(
+    maxsize=int(os.getenv('MINIMUM_DICT_CACHE_SIZE', 50000)),
+    ttl=int(os.getenv('MINIMUM_DICT_CACHE_TTL', 600))
+)
@@ -14,6 +14,36 @@ from models.merge_utils import merge_primary_with_parsed
 from util import normalize_title_like_sql
 
 
+def clean_authors_json(authors):
+    j = json.loads(authors or '[]')
+    for author in j:
+        if 'affiliations' in author and 'affiliation' not in author:
+            author['affiliation'] = author['affiliations']
+            del author['affiliations']
+        final_affs = []
+        if len(author.get("affiliation", [])) > MAX_AFFILIATIONS_PER_AUTHOR:
+            author['affiliation'] = final_affs
+            continue
+        for aff in author.get('affiliation', []):
+            if (isinstance(aff, dict) and len(aff.get('name', '') or '') >= MIN_CHARACTERS_PER_AFFILIATION) or (isinstance(aff, str) and len(aff) >= MIN_CHARACTERS_PER_AFFILIATION):
+                final_affs.append(aff)
+        author['affiliation'] = final_affs
+    return j
+
+
+def copy_authors(authors):
+    if not isinstance(authors, list):
+        return authors
+    copied = []
+    for author in authors:
+        if isinstance(author, dict):
+            author = dict(author)
+            if isinstance(author.get('affiliation'), list):
+                author['affiliation'] = list(author['affiliation'])
+        copied.append(author)
+    return copied
+
+
 class Record(db.Model):
     __table_args__ = {'schema': 'ins'}
     __tablename__ = "recordthresher_record"
@@ -77,57 +107,69 @@ class Record(db.Model):
     # relationship to works is set in Work
     work_id = db.Column(db.BigInteger, db.ForeignKey("mid.work.paper_id"))
 
+    # parsed json columns and counts derived from them, keyed by view name to
+    # (raw column value, view). a view is rebuilt when its column is reassigned
+    _json_views = None
+
+    def _json_view(self, name, column, build):
+        raw = getattr(self, column)
+        if self._json_views is None:
+            self._json_views = {}
+        view = self._json_views.get(name)
+        if view is None or view[0] is not raw:
+            view = self._json_views[name] = (raw, build(raw))
+        return view[1]
+
+    def _parsed_authors(self):
+        return self._json_view('authors', 'authors', lambda raw: json.loads(raw or '[]'))
+
+    def _parsed_cleaned_authors(self):
+        return self._json_view('cleaned_authors', 'authors', clean_authors_json)
+
+    def _parsed_citations(self):
+        return self._json_view('citations', 'citations', lambda raw: json.loads(raw or '[]'))
+
     @property
     def has_affiliations(self):
         return self.cleaned_affiliations_count > 0
 
     @property
     def cleaned_affiliations_count(self):
-        count = 0
-        for author in self.cleaned_authors_json:
-            count += len(author.get("affiliation", []))
-        return count
+        return self._json_view(
+            'cleaned_affiliations_count', 'authors',
+            lambda raw: sum(len(author.get("affiliation", [])) for author in self._parsed_cleaned_authors())
+        )
 
     @property
     def affiliations_count(self):
-        count = 0
-        for author in self.authors_json:
-            count += len(author.get("affiliation", []))
-        return count
+        return self._json_view(
+            'affiliations_count', 'authors',
+            lambda raw: sum(len(author.get("affiliation", [])) for author in self._parsed_authors())
+        )
 
     @property
     def has_citations(self):
-        return bool(self.citations_json)
+        return bool(self._parsed_citations())
+
+    # the json properties return fresh author dicts and affiliation lists, so
+    # callers can set keys on them. anything nested deeper is shared with the cache
 
     @property
     def cleaned_authors_json(self):
-        j = json.loads(self.authors or '[]')
-        for author in j:
-            if 'affiliations' in author and 'affiliation' not in author:
-                author['affiliation'] = author['affiliations']
-                del author['affiliations']
-            final_affs = []
-            if len(author.get("affiliation", [])) > MAX_AFFILIATIONS_PER_AUTHOR:
-                author['affiliation'] = final_affs
-                continue
-            for aff in author.get('affiliation', []):
-                if (isinstance(aff, dict) and len(aff.get('name', '') or '') >= MIN_CHARACTERS_PER_AFFILIATION) or (isinstance(aff, str) and len(aff) >= MIN_CHARACTERS_PER_AFFILIATION):
-                    final_affs.append(aff)
-            author['affiliation'] = final_affs
-        return j
+        return copy_authors(self._parsed_cleaned_authors())
 
     @property
     def authors_json(self):
-        return json.loads(self.authors or '[]')
+        return copy_authors(self._parsed_authors())
 
     @property
     def affiliations_per_author(self):
         return self.cleaned_affiliations_count / len(
-            self.authors_json)
+            self._parsed_authors())
 
     @property
     def clean_affiliations_per_author(self):
-        return self.cleaned_affiliations_count / len(self.cleaned_authors_json)
+        return self.cleaned_affiliations_count / len(self._parsed_cleaned_authors())
 
     @property
     def affiliations_probably_invalid(self):
@@ -135,7 +177,10 @@ class Record(db.Model):
 
     @property
     def citations_json(self):
-        return json.loads(self.citations or '[]')
+        citations = self._parsed_citations()
+        if not isinstance(citations, list):
+            return citations
+        return [dict(citation) if isinstance(citation, dict) else citation for citation in citations]
 
     @property
     def is_hal_record(self):
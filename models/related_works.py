@@ -0,0 +1,364 @@
+import datetime
+import json
+import os
+import shutil
+from threading import Lock
+from time import time
+
+import numpy as np
+from redis import Redis
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import REDIS_QUEUE_URL
+from app import get_db_cursor
+from app import logger
+from util import elapsed
+
+RELATED_WORKS_INDEX_PATH = os.getenv("RELATED_WORKS_INDEX_PATH")
+
+_concepts_sql = """
+    select field_of_study_id, num_papers
+    from mid.concept_api_mv
+    join mid.num_papers_by_concept_mv
+    on concept_api_mv.field_of_study_id = num_papers_by_concept_mv.field_of_study
+    order by field_of_study_id
+"""
+
+_postings_sql = """
+    select fos.field_of_study_id, papers_by_fos.paper_id, papers_by_fos.score
+    from unnest(%s::bigint[]) fos(field_of_study_id)
+    cross join lateral (
+        select paper_id, score
+        from mid.work_concept wc
+        where wc.field_of_study = fos.field_of_study_id
+        and wc.score > %s order by score desc limit %s
+    ) papers_by_fos
+    order by fos.field_of_study_id, papers_by_fos.score desc
+"""
+
+# concept id -> highest new work_concept score since the refresher last took it.
+# bounded by the number of concepts however many works are tagged
+CHANGED_CONCEPTS_KEY = 'related_works:changed_concepts'
+# concept id -> packed postings the refresher fetched after the last build
+PUBLISHED_POSTINGS_KEY = 'related_works:postings'
+# concept id -> time its postings were published
+PUBLISHED_AT_KEY = 'related_works:published_at'
+
+_redis = Redis.from_url(REDIS_QUEUE_URL) if REDIS_QUEUE_URL else None
+
+
+def pack_posting(paper_ids, scores):
+    return np.asarray(paper_ids, dtype=np.int64).tobytes() + np.asarray(scores, dtype=np.float32).tobytes()
+
+
+def unpack_posting(packed):
+    n = len(packed) // 12
+    return np.frombuffer(packed[:8 * n], dtype=np.int64), np.frombuffer(packed[8 * n:], dtype=np.float32)
+
+
+class RelatedWorksIndex:
+    """
+    Per-concept posting lists of the top_k highest scoring papers, kept in
+    memory-mapped .npy files so the worker processes sharing a disk share one
+    copy. Only used where RELATED_WORKS_INDEX_PATH points at a disk the workers
+    and the refresher job share; everywhere else (Heroku dynos) workers keep
+    using the Work.add_related_works query and write no changelog.
+
+    Related works for a set of concepts are the same as the Work.add_related_works
+    query: take the 5 concepts with the fewest papers, merge their postings and
+    rank papers by total score.
+
+    The files are written by build() (see scripts/build_related_works_index.py).
+    Between builds, workers never query work_concept for changes:
+
+    - add_work_concepts records the concepts it scored in a redis changelog
+      once its transaction commits (record_changed_concepts)
+    - one refresher job (build_related_works_index --refresh) takes the
+      changelog, re-fetches the postings of concepts whose new score is high
+      enough to enter their top_k and publishes them to redis
+      (publish_changed_concepts)
+    - refresh_if_stale() in each worker picks up what was published since its
+      build or last refresh, a couple of redis reads
+
+    Scores that drop or concepts that are removed from a work wait for the next
+    build.
+
+    Layout under path: CURRENT names the build directory, which holds
+    concept_ids (sorted), num_papers, offsets, paper_ids, scores and meta.json.
+    """
+    arrays = ('concept_ids', 'num_papers', 'offsets', 'paper_ids', 'scores')
+
+    def __init__(self, path, top_k=1000, min_score=0.3, refresh_seconds=600):
+        self.path = path
+        self.top_k = top_k
+        self.min_score = min_score
+        self.refresh_seconds = refresh_seconds
+        self.version = None
+        self.loaded_at = None
+        self.built_at = None
+        self.published_through = None
+        self.overlay = {}
+        self._lock = Lock()
+
+    def current_version(self):
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def available(self):
+        if not self.path:
+            return False
+        self.refresh_if_stale()
+        return self.version is not None
+
+    def load(self, version):
+        start_time = time()
+        version_path = os.path.join(self.path, version)
+        for name in self.arrays:
+            setattr(self, name, np.load(os.path.join(version_path, f'{name}.npy'), mmap_mode='r'))
+        with open(os.path.join(version_path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        self.overlay = {}
+        self.built_at = datetime.datetime.fromisoformat(meta['built_at']).replace(tzinfo=datetime.timezone.utc).timestamp()
+        # postings published before this build was taken are older than it
+        self.published_through = self.built_at
+        self.version = version
+        self.loaded_at = time()
+        logger.info(
+            f'loaded related works index {version} with {len(self.concept_ids)} concepts and '
+            f'{len(self.paper_ids)} postings in {elapsed(start_time, 2)} seconds')
+
+    def refresh_if_stale(self):
+        if self.version is not None and time() - self.loaded_at < self.refresh_seconds:
+            return
+
+        # one thread refreshes, the others keep using the current postings
+        if self._lock.acquire(blocking=self.version is None):
+            try:
+                if self.version is None or time() - self.loaded_at >= self.refresh_seconds:
+                    version = self.current_version()
+                    if version and version != self.version:
+                        self.load(version)
+                    elif self.version is not None:
+                        self.apply_published_postings()
+                        self.loaded_at = time()
+            finally:
+                self._lock.release()
+
+    def concept_positions(self, concept_ids):
+        concept_ids = np.unique(np.asarray(concept_ids, dtype=np.int64))
+        positions = np.searchsorted(self.concept_ids, concept_ids)
+        found = positions < len(self.concept_ids)
+        found[found] = self.concept_ids[positions[found]] == concept_ids[found]
+        return concept_ids[found], positions[found]
+
+    def posting(self, concept_id, position):
+        if concept_id in self.overlay:
+            return self.overlay[concept_id]
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.paper_ids[start:end], self.scores[start:end]
+
+    def record_changed_concepts(self, session, concept_scores):
+        """Note {concept id: score} for the changelog, sent when session commits."""
+        if not self.path:
+            return
+        pending = session.info.setdefault('related_works_changed_concepts', {})
+        for concept_id, score in concept_scores.items():
+            pending[concept_id] = max(score, pending.get(concept_id, score))
+
+    def apply_published_postings(self):
+        if _redis is None:
+            return
+        start_time = time()
+        try:
+            published = _redis.zrangebyscore(PUBLISHED_AT_KEY, f'({self.published_through}', '+inf', withscores=True)
+            packed_postings = _redis.hmget(PUBLISHED_POSTINGS_KEY, [concept_id for concept_id, _ in published]) if published else []
+        except Exception as e:
+            logger.exception(f'failed to read published related works postings, keeping the current ones: {e}')
+            return
+
+        for (concept_id, published_at), packed in zip(published, packed_postings):
+            if packed is not None:
+                self.overlay[int(concept_id)] = unpack_posting(packed)
+            self.published_through = max(self.published_through, published_at)
+        logger.info(
+            f'applied {len(published)} published concept postings to related works index, '
+            f'took {elapsed(start_time, 2)} seconds')
+
+    def publish_changed_concepts(self):
+        """
+        For the single refresher job: take the changelog, re-fetch the postings
+        of concepts whose new best score could enter their top_k and publish them
+        for the workers. Returns how many concepts were published.
+        """
+        start_time = time()
+        with _redis.pipeline() as pipe:
+            pipe.zrange(CHANGED_CONCEPTS_KEY, 0, -1, withscores=True)
+            pipe.delete(CHANGED_CONCEPTS_KEY)
+            changed, _ = pipe.execute()
+
+        max_scores = {int(concept_id): max_score for concept_id, max_score in changed}
+        concept_ids, positions = self.concept_positions(list(max_scores))
+        stale_concept_ids = []
+        for concept_id, position in zip(concept_ids.tolist(), positions):
+            paper_ids, scores = self.posting(concept_id, position)
+            if len(paper_ids) < self.top_k or max_scores[concept_id] >= scores[-1]:
+                stale_concept_ids.append(concept_id)
+
+        published_at = time()
+        postings = {}
+        try:
+            for concept_id, paper_ids, scores in fetch_postings(stale_concept_ids, self.top_k, self.min_score):
+                postings[concept_id] = (paper_ids, scores)
+
+            if postings:
+                with _redis.pipeline() as pipe:
+                    pipe.hset(PUBLISHED_POSTINGS_KEY, mapping={
+                        concept_id: pack_posting(*posting) for concept_id, posting in postings.items()
+                    })
+                    pipe.zadd(PUBLISHED_AT_KEY, {concept_id: published_at for concept_id in postings})
+                    pipe.execute()
+        except Exception:
+            # put the changelog back for the next run
+            if max_scores:
+                _redis.zadd(CHANGED_CONCEPTS_KEY, max_scores, gt=True)
+            raise
+
+        self.overlay.update(postings)
+
+        logger.info(
+            f'published {len(postings)} of {len(changed)} changed concepts to related works index, '
+            f'took {elapsed(start_time, 2)} seconds')
+        return len(postings)
+
+    def drop_published_before_build(self):
+        """Published postings older than the loaded build are superseded by it."""
+        superseded = _redis.zrangebyscore(PUBLISHED_AT_KEY, '-inf', self.built_at)
+        if superseded:
+            with _redis.pipeline() as pipe:
+                pipe.hdel(PUBLISHED_POSTINGS_KEY, *superseded)
+                pipe.zrem(PUBLISHED_AT_KEY, *superseded)
+                pipe.execute()
+
+    def related_works(self, concept_ids, limit=10, num_rare_concepts=5):
+        """
+        Returns [(paper_id, average_score, total_score)] for the top papers by
+        total score over the postings of the rarest concepts.
+        """
+        concept_ids, positions = self.concept_positions(concept_ids)
+        if not len(concept_ids):
+            return []
+
+        rare = np.lexsort((concept_ids, self.num_papers[positions]))[:num_rare_concepts]
+        postings = [self.posting(int(concept_ids[i]), positions[i]) for i in rare]
+        paper_ids = np.concatenate([posting[0] for posting in postings])
+        if not len(paper_ids):
+            return []
+        scores = np.concatenate([posting[1] for posting in postings]).astype(np.float64)
+
+        unique_paper_ids, inverse = np.unique(paper_ids, return_inverse=True)
+        total_scores = np.bincount(inverse, weights=scores)
+        average_scores = total_scores / np.bincount(inverse)
+        top = np.lexsort((unique_paper_ids, -total_scores))[:limit]
+        return [
+            (int(unique_paper_ids[i]), float(average_scores[i]), float(total_scores[i]))
+            for i in top
+        ]
+
+    def build(self, batch_size=500, keep_versions=2):
+        """Write a new build from mid.work_concept and point CURRENT at it."""
+        start_time = time()
+        built_at = datetime.datetime.utcnow()
+        version = built_at.strftime('%Y%m%d%H%M%S')
+        version_path = os.path.join(self.path, version)
+        os.makedirs(version_path)
+
+        with get_db_cursor() as cur:
+            cur.execute(_concepts_sql)
+            concept_rows = cur.fetchall()
+        concept_ids = np.array([row['field_of_study_id'] for row in concept_rows], dtype=np.int64)
+        num_papers = np.array([row['num_papers'] or 0 for row in concept_rows], dtype=np.int64)
+        logger.info(f'building related works postings for {len(concept_ids)} concepts')
+
+        counts = np.zeros(len(concept_ids), dtype=np.int64)
+        paper_id_chunks = []
+        score_chunks = []
+        for i in range(0, len(concept_ids), batch_size):
+            batch = concept_ids[i:i + batch_size].tolist()
+            for concept_id, paper_ids, scores in fetch_postings(batch, self.top_k, self.min_score):
+                counts[np.searchsorted(concept_ids, concept_id)] = len(paper_ids)
+                paper_id_chunks.append(paper_ids)
+                score_chunks.append(scores)
+            logger.info(f'fetched postings for {min(i + batch_size, len(concept_ids))} concepts')
+
+        offsets = np.zeros(len(concept_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        built = {
+            'concept_ids': concept_ids,
+            'num_papers': num_papers,
+            'offsets': offsets,
+            'paper_ids': np.concatenate(paper_id_chunks) if paper_id_chunks else np.array([], dtype=np.int64),
+            'scores': np.concatenate(score_chunks) if score_chunks else np.array([], dtype=np.float32),
+        }
+        for name in self.arrays:
+            np.save(os.path.join(version_path, f'{name}.npy'), built[name])
+        with open(os.path.join(version_path, 'meta.json'), 'w') as f:
+            json.dump({'built_at': built_at.isoformat(), 'top_k': self.top_k, 'min_score': self.min_score}, f)
+
+        current_tmp_path = os.path.join(self.path, 'CURRENT.tmp')
+        with open(current_tmp_path, 'w') as f:
+            f.write(version)
+        os.replace(current_tmp_path, os.path.join(self.path, 'CURRENT'))
+
+        # processes still mapping an old build keep their open files
+        versions = sorted(d for d in os.listdir(self.path) if d.isdigit())
+        for old_version in versions[:-keep_versions]:
+            shutil.rmtree(os.path.join(self.path, old_version), ignore_errors=True)
+
+        logger.info(f'built related works index {version} with {offsets[-1]} postings in {elapsed(start_time, 2)} seconds')
+        return version
+
+
+def fetch_postings(concept_ids, top_k, min_score):
+    """Yields (concept_id, paper_ids, scores) with scores descending, for concepts that have papers."""
+    if not concept_ids:
+        return
+
+    with get_db_cursor() as cur:
+        cur.execute(_postings_sql, (list(concept_ids), min_score, top_k))
+        rows = cur.fetchall()
+
+    if not rows:
+        return
+
+    row_concept_ids = np.array([row['field_of_study_id'] for row in rows], dtype=np.int64)
+    paper_ids = np.array([row['paper_id'] for row in rows], dtype=np.int64)
+    scores = np.array([row['score'] for row in rows], dtype=np.float32)
+    starts = np.flatnonzero(np.r_[True, row_concept_ids[1:] != row_concept_ids[:-1]])
+    ends = np.r_[starts[1:], len(rows)]
+    for start, end in zip(starts, ends):
+        yield int(row_concept_ids[start]), paper_ids[start:end], scores[start:end]
+
+
+related_works_index = RelatedWorksIndex(RELATED_WORKS_INDEX_PATH)
+
+
+@event.listens_for(Session, "after_commit")
+def send_changed_concepts(session):
+    if not (pending := session.info.pop('related_works_changed_concepts', None)) or _redis is None:
+        return
+    try:
+        # gt keeps the highest score seen until the refresher takes the changelog
+        _redis.zadd(CHANGED_CONCEPTS_KEY, pending, gt=True)
+    except Exception as e:
+        logger.exception(f'failed to record {len(pending)} changed concepts for the related works index: {e}')
+
+
+@event.listens_for(Session, "after_transaction_end")
+def discard_uncommitted_changed_concepts(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('related_works_changed_concepts', None)
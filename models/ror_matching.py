@@ -1,11 +1,17 @@
 import re
 import unidecode
 import unicodedata
-from collections import namedtuple
-from rapidfuzz import fuzz
+from collections import defaultdict, namedtuple
+from functools import cache, lru_cache
+
+import numpy as np
+from rapidfuzz import fuzz, process
 
 from app import db
+from app import logger
 from const import ROR_COUNTRIES_LIST
+from es_client import get_es_client
+from models.institution import RORAffiliationString
 
 class RORGapInstitution(db.Model):
     __table_args__ = {'schema': 'ins'}
@@ -15,6 +21,116 @@ class RORGapInstitution(db.Model):
     ror_id = db.Column(db.Text)
     display_name = db.Column(db.Text)
 
+class CountryNameIndex:
+    """
+    Precomputed lookup for RORStrategy.get_country_codes. Gives the same codes as
+    scoring every country name against every token, but avoids most of the scoring:
+
+    two-letter names only score >= 90 on an identical token, so they are a dict lookup
+    single-word names need a token of similar length; scores are memoized per token
+    multi-word names are scored in one rapidfuzz cdist call, after dropping names
+    with too many characters that don't occur in the string at all
+    """
+    min_score = 90
+    token_cache_size = 200000
+
+    def __init__(self, countries):
+        self.short_names = defaultdict(set)  # uppercase 2-letter name -> codes
+        self.word_names = defaultdict(set)  # name -> codes
+        self.word_names_by_length = defaultdict(list)
+        phrases = defaultdict(set)
+
+        for code, name in countries:
+            if re.search("[^a-z]", name):
+                phrases[name].add(code.upper())
+            elif len(name) == 2:
+                self.short_names[name.upper()].add(code.upper())
+            else:
+                self.word_names[name].add(code.upper())
+
+        for name in self.word_names:
+            self.word_names_by_length[len(name)].append(name)
+
+        self.phrase_names = list(phrases.keys())
+        self.phrase_codes_list = [phrases[name] for name in self.phrase_names]
+        self.phrase_char_sets = [set(name) for name in self.phrase_names]
+        self.word_codes = lru_cache(maxsize=self.token_cache_size)(self._word_codes)
+
+    def _word_codes(self, token):
+        if token in self.word_names:
+            return frozenset(self.word_names[token])
+
+        # fuzz.ratio is 2 * matches / total length, so lengths must be within ~20%
+        codes = set()
+        n = len(token)
+        for m in range((9 * n) // 11, (11 * n) // 9 + 2):
+            for name in self.word_names_by_length.get(m, []):
+                if fuzz.ratio(name, token) >= self.min_score:
+                    codes |= self.word_names[name]
+        return frozenset(codes)
+
+    def _phrase_candidates(self, lower):
+        # every distinct character missing from the string costs the name at least one
+        # match; a >= 90 partial_ratio alignment can't miss more than ~18% of the name
+        chars = set(lower)
+        return [
+            i for i, name in enumerate(self.phrase_names)
+            if len(lower) < len(name) or len(self.phrase_char_sets[i] - chars) <= 0.2 * len(name)
+        ]
+
+    def _normalize(self, string):
+        string = unidecode.unidecode(string).strip()
+        lower = re.sub(r"\s+", " ", string.lower())
+        lower_alpha = re.sub(r"\s+", " ", re.sub("[^a-z]", " ", string.lower()))
+        alpha = re.sub(r"\s+", " ", re.sub("[^a-zA-Z]", " ", string))
+        return lower, lower_alpha, alpha
+
+    def _token_codes(self, lower_alpha, alpha):
+        codes = set()
+        for token in alpha.split():
+            codes |= self.short_names.get(token, set())
+        for token in lower_alpha.split():
+            codes |= self.word_codes(token)
+        return codes
+
+    def get_country_codes(self, string):
+        lower, lower_alpha, alpha = self._normalize(string)
+        codes = self._token_codes(lower_alpha, alpha)
+        for i in self._phrase_candidates(lower):
+            if not self.phrase_codes_list[i] <= codes:
+                if fuzz.partial_ratio(self.phrase_names[i], lower) >= self.min_score:
+                    codes |= self.phrase_codes_list[i]
+        return list(codes)
+
+    def get_country_codes_batch(self, strings):
+        normalized = [self._normalize(s) for s in strings]
+        results = [self._token_codes(lower_alpha, alpha) for lower, lower_alpha, alpha in normalized]
+
+        candidates = set()
+        for lower, lower_alpha, alpha in normalized:
+            candidates.update(self._phrase_candidates(lower))
+        candidates = sorted(candidates)
+
+        if candidates and strings:
+            scores = process.cdist(
+                [self.phrase_names[i] for i in candidates],
+                [lower for lower, lower_alpha, alpha in normalized],
+                scorer=fuzz.partial_ratio,
+                score_cutoff=self.min_score,
+                workers=-1
+            )
+            for row, i in enumerate(candidates):
+                for col in np.nonzero(scores[row])[0]:
+                    results[col] |= self.phrase_codes_list[i]
+
+        return [list(codes) for codes in results]
+
+
+@cache
+def country_name_index():
+    return CountryNameIndex(ROR_COUNTRIES_LIST)
+
+
 class RORStrategy:
     strategy = "affiliation-single-search"
     task = "affiliation-matching"
@@ -27,9 +143,11 @@ class RORStrategy:
 
     def __init__(self):
         self.countries = ROR_COUNTRIES_LIST
+        self.country_index = country_name_index()
 
-    def match(self, input_data, candidates):
-        aff_countries = self.get_countries(input_data)
+    def match(self, input_data, candidates, aff_countries=None):
+        if aff_countries is None:
+            aff_countries = self.get_countries(input_data)
         candidates = [c for c in candidates if c["_source"]["status"] == "active"]
 
         candidates = [self.score(input_data, c) for c in candidates]
@@ -205,22 +323,106 @@ class RORStrategy:
         }.get(c, c)
 
     def get_country_codes(self, string):
-        string = unidecode.unidecode(string).strip()
-        lower = re.sub(r"\s+", " ", string.lower())
-        lower_alpha = re.sub(r"\s+", " ", re.sub("[^a-z]", " ", string.lower()))
-        alpha = re.sub(r"\s+", " ", re.sub("[^a-zA-Z]", " ", string))
-        codes = []
-        for code, name in self.countries:
-            if re.search("[^a-z]", name):
-                score = fuzz.partial_ratio(name, lower)
-            elif len(name) == 2:
-                score = max([fuzz.ratio(name.upper(), t) for t in alpha.split()] + [0])
-            else:
-                score = max([fuzz.ratio(name, t) for t in lower_alpha.split()] + [0])
-            if score >= 90:
-                codes.append(code.upper())
-        return list(set(codes))
+        return self.country_index.get_country_codes(string)
+
+    def get_country_codes_batch(self, strings):
+        return self.country_index.get_country_codes_batch(strings)
 
     def get_countries(self, string):
         codes = self.get_country_codes(string)
         return [self.to_region(c) for c in codes]
+
+
+ROR_MSEARCH_BATCH_SIZE = 100
+
+
+def ror_search_body(raw_affiliation_string):
+    return {
+        "size": 150,
+        "query": {
+            "nested": {
+                "path": "names",
+                "score_mode": "max",
+                "query": {"match": {"names.name": {"query": raw_affiliation_string}}},
+            }
+        },
+    }
+
+
+def search_ror_candidates(raw_affiliation_strings, ror_search_index_name=RORStrategy.index):
+    """
+    Run the ROR candidate search for many strings with _msearch.
+    Returns {string: hits}.
+    """
+    es = get_es_client()
+    candidates = {}
+
+    for i in range(0, len(raw_affiliation_strings), ROR_MSEARCH_BATCH_SIZE):
+        batch = raw_affiliation_strings[i:i + ROR_MSEARCH_BATCH_SIZE]
+        searches = []
+        for raw_affiliation_string in batch:
+            searches.append({"index": ror_search_index_name})
+            searches.append(ror_search_body(raw_affiliation_string))
+
+        responses = es.msearch(searches=searches)["responses"]
+        for raw_affiliation_string, response in zip(batch, responses):
+            if "error" in response:
+                # retry on its own so a failure raises like a plain search would
+                logger.warn(f"ror msearch failed for {raw_affiliation_string}: {response['error']}")
+                response = es.search(body=ror_search_body(raw_affiliation_string), index=ror_search_index_name)
+            candidates[raw_affiliation_string] = response["hits"]["hits"]
+
+    return candidates
+
+
+def match_affiliation_strings_to_ror(raw_affiliation_strings, ror_search_index_name=RORStrategy.index):
+    """
+    Find the ROR-matched institution for each affiliation string, with one query for
+    known strings, one _msearch for the rest and one query for their gap institutions.
+    Returns {string: {'aff_id': affiliation_id or None, 'new_string': bool}},
+    new strings should be saved to RORAffiliationString by the caller.
+    """
+    raw_affiliation_strings = list(dict.fromkeys(s for s in raw_affiliation_strings if s))
+    if not raw_affiliation_strings:
+        return {}
+
+    aff_string_to_ror = {}
+    known_strings = RORAffiliationString.query.filter(
+        RORAffiliationString.original_affiliation.in_(raw_affiliation_strings)
+    ).all()
+    for ror_string_match in known_strings:
+        aff_string_to_ror[ror_string_match.original_affiliation] = {
+            'aff_id': ror_string_match.affiliation_id, 'new_string': False
+        }
+
+    new_strings = [s for s in raw_affiliation_strings if s not in aff_string_to_ror]
+    if not new_strings:
+        return aff_string_to_ror
+
+    strategy = RORStrategy()
+    candidates = search_ror_candidates(new_strings, ror_search_index_name)
+    countries = [
+        [strategy.to_region(c) for c in codes]
+        for codes in strategy.get_country_codes_batch(new_strings)
+    ]
+
+    matched_ror_ids = {}
+    for raw_affiliation_string, aff_countries in zip(new_strings, countries):
+        matched_candidate = strategy.match(raw_affiliation_string, candidates[raw_affiliation_string], aff_countries)
+        if matched_candidate:
+            matched_ror_ids[raw_affiliation_string] = matched_candidate[0]['id'].split("/")[-1]
+
+    gap_institutions = {}
+    if matched_ror_ids:
+        for gap_institution in RORGapInstitution.query.filter(
+            RORGapInstitution.ror_id.in_(set(matched_ror_ids.values()))
+        ).all():
+            gap_institutions.setdefault(gap_institution.ror_id, gap_institution.affiliation_id)
+
+    for raw_affiliation_string in new_strings:
+        aff_string_to_ror[raw_affiliation_string] = {
+            'aff_id': gap_institutions.get(matched_ror_ids.get(raw_affiliation_string)),
+            'new_string': True
+        }
+
+    return aff_string_to_ror
@@ -1,23 +1,20 @@
 import datetime
 import hashlib
 import json
-import os
 import re
 import random
 from collections import defaultdict
 import stat
-from elasticsearch import Elasticsearch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import IntEnum
 from functools import cache
-from time import sleep
 from time import time
 from typing import List
 
-import requests
 from cached_property import cached_property
 from humanfriendly import format_timespan
 import sentry_sdk
-from sqlalchemy import event, orm, text, and_, desc
+from sqlalchemy import event, inspect, orm, text, and_, desc
 from sqlalchemy.orm import selectinload
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm.attributes import get_history
@@ -26,21 +23,28 @@ from sqlalchemy.types import ARRAY
 import models
 from app import WORKS_INDEX_PREFIX
 from app import COUNTRIES_ENDPOINT_PREFIX
-from app import COUNTRIES
 from app import MAX_MAG_ID
 from app import db
 from app import get_apiurl_from_openalex_url
 from app import get_db_cursor
 from app import logger
-from app import ELASTIC_URL
 from const import PREPRINT_JOURNAL_IDS, REVIEW_JOURNAL_IDS, \
     MAX_AFFILIATIONS_PER_AUTHOR
-from models.concept import is_valid_concept_id
+from models.concept import get_concept_metadata
+from models.country_matching import country_matcher
+from models.minimum_dict_cache import minimum_dict_cache
 from models.topic import is_valid_topic_id
 from models.keyword import is_valid_keyword_id
 from models.work_sdg import get_and_save_sdgs
-from models.institution import as_institution_openalex_id, RORAffiliationString
-from models.ror_matching import RORGapInstitution, RORStrategy
+from models.institution import as_institution_openalex_id, RORAffiliationString, ror_affiliation_string_inserts
+from models.related_works import related_works_index
+from models.work_metrics import WorkMetrics, work_metrics_from_relationships
+from models.work_store_fingerprint import WORK_STORE_FINGERPRINTS, WorkStoreFingerprint, work_store_fingerprint
+from model_client import concept_tagger, topic_classifier
+from es_client import get_es_client
+from metrics import step_metrics, timed_step
+from models.ror_matching import RORGapInstitution, RORStrategy, \
+    match_affiliation_strings_to_ror, ror_search_body
 from util import clean_doi, entity_md5, normalize_title_like_sql, \
     matching_author_strings, get_crossref_json_from_unpaywall, \
     words_within_distance, TOP_TITLES
@@ -107,11 +111,7 @@ def call_sagemaker_bulk_lookup_new_work_concepts(rows):
     class ConceptLookupResponse:
         pass
 
-    api_key = os.getenv("SAGEMAKER_API_KEY")
-    headers = {"X-API-Key": api_key}
-    # api_url = "https://4rwjth9jek.execute-api.us-east-1.amazonaws.com/api/" #for version without abstracts
-    api_url = "https://l7a8sw8o2a.execute-api.us-east-1.amazonaws.com/api/"  # for version with abstracts
-    r = requests.post(api_url, json=json.dumps(data_list), headers=headers)
+    r = concept_tagger.post(json.dumps(data_list))
     if r.status_code != 200:
         logger.error(
             f"error in call_sagemaker_bulk_lookup_new_work_concepts: status code {r} reason {r.reason}")
@@ -135,6 +135,87 @@ def call_sagemaker_bulk_lookup_new_work_concepts(rows):
     return [response]
 
 
+MODEL_BATCH_SIZE = 25
+MODEL_BATCH_CONCURRENCY = 4
+
+
+def call_model_endpoint(endpoint, input_data_list, require_all_results=False):
+    """
+    Post a list of inputs to a model endpoint. Returns a (succeeded, result) tuple for
+    each input: succeeded is False if the call failed, result is None if the response
+    couldn't be read. With require_all_results, returns None unless there is exactly
+    one result per input.
+    """
+    r = endpoint.post(json.dumps(input_data_list, sort_keys=True))
+    if r.status_code != 200:
+        logger.error(
+            f"Error, not retrying: Error back from API endpoint: {r} {r.status_code} {r.text} for input {input_data_list}")
+        return None if require_all_results else [(False, None)] * len(input_data_list)
+
+    try:
+        response_json = r.json()
+        if len(response_json) < len(input_data_list) or (require_all_results and len(response_json) != len(input_data_list)):
+            raise ValueError(f"expected {len(input_data_list)} results, got {len(response_json)}")
+        return [(True, result) for result in response_json[:len(input_data_list)]]
+    except Exception as e:
+        logger.error(f"error {e} reading {endpoint.name} response {r}, called with {endpoint.url} data: {input_data_list}")
+        return None if require_all_results else [(True, None)] * len(input_data_list)
+
+
+def prefetch_work_tags(works, batch_size=MODEL_BATCH_SIZE, max_workers=MODEL_BATCH_CONCURRENCY):
+    """
+    Chunk-level pre-pass for add_work_concepts and add_work_topics. Sends the inputs
+    of every work whose concept or topic input hash changed to the model endpoints
+    in batches, a few batches at a time.
+    Returns {paper_id: {'concept_result': ..., 'topic_result': ...}} to pass to
+    add_concepts_topics_and_related_works. Works missing from a failed batch are
+    left out and tag themselves one at a time as before.
+    """
+    concept_inputs = [
+        (work.paper_id, work.concept_api_input_data()) for work in works
+        if work.concepts_input_hash != work.get_concepts_input_hash()
+    ]
+    topic_inputs = [
+        (work.paper_id, work.topic_api_input_data()) for work in works
+        if work.topics_input_hash not in ('-1', work.get_topics_input_hash())
+    ]
+
+    batches = []
+    for endpoint, result_key, inputs in [
+        (concept_tagger, 'concept_result', concept_inputs),
+        (topic_classifier, 'topic_result', topic_inputs),
+    ]:
+        for i in range(0, len(inputs), batch_size):
+            batches.append((endpoint, result_key, inputs[i:i + batch_size]))
+
+    prefetched = defaultdict(dict)
+    if not batches:
+        return prefetched
+
+    start_time = time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        future_to_batch = {
+            step_metrics.submit(executor, call_model_endpoint, endpoint, [data for _, data in batch], True): (endpoint, result_key, batch)
+            for endpoint, result_key, batch in batches
+        }
+        for future in as_completed(future_to_batch):
+            endpoint, result_key, batch = future_to_batch[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error(f"{endpoint.name} batch of {len(batch)} failed: {e}")
+                continue
+            if results is None:
+                continue
+            for (paper_id, _), result in zip(batch, results):
+                prefetched[paper_id][result_key] = result
+
+    logger.info(
+        f'prefetched {len(concept_inputs)} concept and {len(topic_inputs)} topic inputs '
+        f'in {len(batches)} batches, took {elapsed(start_time, 2)} seconds')
+    return prefetched
+
+
 @cache
 def pubmed_json():
     return models.source.Source.query.options(
@@ -226,6 +307,36 @@ def oa_status_from_location(loc, type_crossref):
         return 'bronze'
 
 
+class RecordIndex:
+    """
+    Views of a work's records, built on first use and kept until Work.records
+    changes (see invalidate_record_index): merged records, primary records by
+    score, the same grouped by record type, and the records authorships use.
+    """
+    def __init__(self, records):
+        self.merged = [r.with_parsed_data for r in records or [] if r.with_parsed_data]
+        self.sorted = sorted(
+            [r for r in self.merged if r.is_primary_record()],
+            key=lambda x: x.score, reverse=True
+        )
+
+        self.by_type = {}
+        for record in self.sorted:
+            self.by_type.setdefault(record.record_type, []).append(record)
+
+        affiliation_records = [record for record in self.sorted if record.has_affiliations]
+        if not affiliation_records:
+            affiliation_records = [record for record in self.sorted if record.cleaned_authors_json]
+        self.affiliation_sorted = sorted(
+            affiliation_records,
+            key=lambda record: (record.score, record.cleaned_affiliations_count), reverse=True
+        )
+
+    def first_of_type(self, record_type):
+        records = self.by_type.get(record_type)
+        return records[0] if records else None
+
+
 class Work(db.Model):
     __table_args__ = {'schema': 'mid'}
     __tablename__ = "work"
@@ -276,6 +387,11 @@ class Work(db.Model):
     json_entity_hash = db.Column(db.Text)
     arxiv_id = db.Column(db.Text)
 
+    # WorkMetricValues set by attach_work_metrics for works loaded in a chunk
+    side_loaded_metrics = None
+
+    _record_index = None
+
     def __init__(self, **kwargs):
         super(Work, self).__init__(**kwargs)
 
@@ -283,6 +399,16 @@ class Work(db.Model):
     def id(self):
         return self.paper_id
 
+    @property
+    def citation_metrics(self):
+        if self.side_loaded_metrics is None:
+            metric_relationships = ('counts', 'citation_count_2year', 'work_fwci', 'work_citations_norm_percentile')
+            if inspect(self).unloaded.isdisjoint(metric_relationships):
+                self.side_loaded_metrics = work_metrics_from_relationships(self)
+            else:
+                self.side_loaded_metrics = WorkMetrics.fetch([self.paper_id]).get(self.paper_id)
+        return self.side_loaded_metrics
+
     @property
     def cited_by_api_url(self):
         return f"https://api.openalex.org/works?filter=cites:{self.openalex_id_short}"
@@ -530,7 +656,7 @@ class Work(db.Model):
                 'utf-8')
         ).hexdigest()
 
-    def add_work_topics(self):
+    def add_work_topics(self, topic_result=None):
         current_topics_input_hash = self.get_topics_input_hash()
         if self.topics_input_hash == '-1':
             logger.info(
@@ -544,53 +670,24 @@ class Work(db.Model):
 
         self.full_updated_date = datetime.datetime.utcnow().isoformat()
 
-        data = self.topic_api_input_data()
-        api_key = os.getenv("SAGEMAKER_API_KEY")
-
-        headers = {"X-API-Key": api_key}
-        api_url = "https://5gl84dua69.execute-api.us-east-1.amazonaws.com/api/"
+        if topic_result is None:
+            topic_result = call_model_endpoint(topic_classifier, [self.topic_api_input_data()])[0]
+        succeeded, resp_data = topic_result
 
-        number_tries = 0
-        keep_calling = True
         topic_ids = None
         topic_scores = None
-        response_json = None
-        # r = None
-
-        while keep_calling:
-            r = requests.post(api_url, json=json.dumps([data], sort_keys=True),
-                              headers=headers)
-
-            if r.status_code == 200:
-                try:
-                    response_json = r.json()
-                    resp_data = response_json[0]
-                    topic_ids = [i['topic_id'] for i in resp_data]
-                    topic_scores = [i['topic_score'] for i in resp_data]
-                    keep_calling = False
-                except Exception as e:
-                    logger.error(
-                        f"error {e} in add_work_topics with {self.id}, response {r}, called with {api_url} data: {data}")
-                    topic_ids = None
-                    topic_scores = None
-                    keep_calling = False
 
-            elif r.status_code == 500:
-                logger.error(
-                    f"Error on try #{number_tries}, now trying again: Error back from API endpoint: {r} {r.status_code}")
-                sleep(0.5)
-                number_tries += 1
-                if number_tries > 60:
-                    keep_calling = False
-
-            else:
+        if succeeded and resp_data is not None:
+            try:
+                topic_ids = [i['topic_id'] for i in resp_data]
+                topic_scores = [i['topic_score'] for i in resp_data]
+            except Exception as e:
                 logger.error(
-                    f"Error, not retrying: Error back from API endpoint: {r} {r.status_code} {r.text} for input {data}")
+                    f"error {e} in add_work_topics with {self.id}, result {resp_data}")
                 topic_ids = None
                 topic_scores = None
-                keep_calling = False
 
-        if r.status_code == 200:
+        if succeeded:
             self.topics = []
             if topic_ids and topic_scores:
                 new_topic_ids = [x for y, x in
@@ -616,7 +713,7 @@ class Work(db.Model):
 
             self.topics_input_hash = current_topics_input_hash
 
-    def add_work_concepts(self):
+    def add_work_concepts(self, concept_result=None):
         current_concepts_input_hash = self.get_concepts_input_hash()
 
         if self.concepts_input_hash == current_concepts_input_hash:
@@ -626,48 +723,21 @@ class Work(db.Model):
 
         self.full_updated_date = datetime.datetime.utcnow().isoformat()
 
-        data = self.concept_api_input_data()
-        api_key = os.getenv("SAGEMAKER_API_KEY")
-
-        headers = {"X-API-Key": api_key}
-        api_url = "https://l7a8sw8o2a.execute-api.us-east-1.amazonaws.com/api/"  # for vesion with abstracts
+        if concept_result is None:
+            concept_result = call_model_endpoint(concept_tagger, [self.concept_api_input_data()])[0]
+        succeeded, resp_data = concept_result
 
-        number_tries = 0
-        keep_calling = True
         concept_names = None
-        response_json = None
-        r = None
-
-        while keep_calling:
-            r = requests.post(api_url, json=json.dumps([data], sort_keys=True),
-                              headers=headers)
-
-            if r.status_code == 200:
-                try:
-                    response_json = r.json()
-                    concept_names = response_json[0]["tags"]
-                    keep_calling = False
-                except Exception as e:
-                    logger.error(
-                        f"error {e} in add_work_concepts with {self.id}, response {r}, called with {api_url} data: {data} headers: {headers}")
-                    concept_names = None
-                    keep_calling = False
 
-            elif r.status_code == 500:
-                logger.error(
-                    f"Error on try #{number_tries}, now trying again: Error back from API endpoint: {r} {r.status_code}")
-                sleep(1)
-                number_tries += 1
-                if number_tries > 60:
-                    keep_calling = False
-
-            else:
+        if succeeded and resp_data is not None:
+            try:
+                concept_names = resp_data["tags"]
+            except Exception as e:
                 logger.error(
-                    f"Error, not retrying: Error back from API endpoint: {r} {r.status_code} {r.text} for input {data}")
+                    f"error {e} in add_work_concepts with {self.id}, result {resp_data}")
                 concept_names = None
-                keep_calling = False
 
-        if r.status_code == 200:
+        if succeeded:
             self.concepts = []
             self.keywords = []
             self.concepts_for_related_works = []
@@ -675,10 +745,11 @@ class Work(db.Model):
             if concept_names:
                 keyword_ids_used = []
                 for i, concept_name in enumerate(concept_names):
-                    score = response_json[0]["scores"][i]
-                    field_of_study = response_json[0]["tag_ids"][i]
+                    score = resp_data["scores"][i]
+                    field_of_study = resp_data["tag_ids"][i]
 
-                    if field_of_study and is_valid_concept_id(field_of_study):
+                    concept = get_concept_metadata(field_of_study)
+                    if concept:
                         new_work_concept = models.WorkConcept(
                             paper_id=self.paper_id,
                             field_of_study=field_of_study,
@@ -694,10 +765,9 @@ class Work(db.Model):
                             self.concepts_for_related_works.append(
                                 field_of_study)
                             
-                        concept = models.Concept.query.get(field_of_study).to_dict("keyword")
-                        keyword_id = concept.get('keyword_id')
-                        if concept.get('use_as_keyword') and keyword_id and is_valid_keyword_id(keyword_id):
-                            if concept.get('keyword_id') not in keyword_ids_used and score > 0.4:
+                        keyword_id = concept.keyword_id
+                        if concept.use_as_keyword and keyword_id and is_valid_keyword_id(keyword_id):
+                            if keyword_id not in keyword_ids_used and score > 0.4:
                                 new_work_keyword = models.WorkKeyword(
                                     paper_id=self.paper_id,
                                     keyword_id=keyword_id,
@@ -710,9 +780,27 @@ class Work(db.Model):
                                 self.keywords.append(new_work_keyword)
                                 keyword_ids_used.append(keyword_id)
 
+            # changelog for the related works index refresher, sent on commit
+            related_works_index.record_changed_concepts(db.session(), {
+                c.field_of_study: c.score for c in self.concepts if c.score > related_works_index.min_score
+            })
+
             self.concepts_input_hash = current_concepts_input_hash
 
     def add_everything(self, skip_concepts_and_related_works=False):
+        if not self.add_everything_before_tagging():
+            return
+
+        if not skip_concepts_and_related_works:
+            self.add_concepts_topics_and_related_works()
+
+        self.add_everything_after_tagging()
+
+    def add_everything_before_tagging(self):
+        """
+        The add_everything steps that concept and topic tagging depend on.
+        Returns False if the rest of add_everything should be skipped.
+        """
         self.delete_dict = defaultdict(list)
         self.insert_dicts = []
 
@@ -720,7 +808,7 @@ class Work(db.Model):
             # don't add relation table entries for merged works
             logger.info(
                 f"not updating W{self.paper_id} because it was merged into W{self.merge_into_id}")
-            return
+            return False
 
         if not self.records_sorted:
             # not associated with a record, update institutions only
@@ -734,87 +822,68 @@ class Work(db.Model):
                     update_institutions = True
                     break
             if update_institutions:
-                start_time = time()
-                self.update_institutions()
-                logger.info(
-                    f'update_institutions took {elapsed(start_time, 2)} seconds')
-            return
+                with timed_step('update_institutions'):
+                    self.update_institutions()
+            return False
 
-        start_time = time()
-        self.set_fields_from_all_records()
-        logger.info(
-            f'set_fields_from_all_records took {elapsed(start_time, 2)} seconds')
+        with timed_step('set_fields_from_all_records'):
+            self.set_fields_from_all_records()
 
-        start_time = time()
-        self.add_abstract()  # must be before work_concepts
-        logger.info(f'add_abstract took {elapsed(start_time, 2)} seconds')
+        with timed_step('add_abstract'):
+            self.add_abstract()  # must be before work_concepts
 
-        start_time = time()
-        self.add_mesh()
-        logger.info(f'add_mesh took {elapsed(start_time, 2)} seconds')
+        with timed_step('add_mesh'):
+            self.add_mesh()
 
-        start_time = time()
-        self.add_ids()
-        logger.info(f'add_ids took {elapsed(start_time, 2)} seconds')
+        with timed_step('add_ids'):
+            self.add_ids()
 
-        start_time = time()
-        self.add_locations()
-        logger.info(f'add_locations took {elapsed(start_time, 2)} seconds')
+        with timed_step('add_locations'):
+            self.add_locations()
 
-        start_time = time()
-        self.add_references()  # must be before affiliations
-        logger.info(f'add_references took {elapsed(start_time, 2)} seconds')
-        if not skip_concepts_and_related_works:
-            start_time = time()
-            self.add_work_concepts()
-            logger.info(
-                f'add_work_concepts took {elapsed(start_time, 2)} seconds')
+        with timed_step('add_references'):
+            self.add_references()  # must be before affiliations
+        return True
 
-            # After initial burst, need to move this here becauase topics is slow
-            start_time = time()
-            self.add_work_topics()
-            logger.info(
-                f'add_work_topics took {elapsed(start_time, 2)} seconds')
+    def add_concepts_topics_and_related_works(self, concept_result=None, topic_result=None):
+        # results can be prefetched for a whole chunk with prefetch_work_tags
+        with timed_step('add_work_concepts'):
+            self.add_work_concepts(concept_result)
 
-            start_time = time()
+        # After initial burst, need to move this here becauase topics is slow
+        with timed_step('add_work_topics'):
+            self.add_work_topics(topic_result)
+
+        with timed_step('add_related_works'):
             self.add_related_works()  # must be after work_concepts
-            logger.info(
-                f'add_related_works took {elapsed(start_time, 2)} seconds')
 
-        start_time = time()
-        self.add_funders()
-        logger.info(f'add_funders took {elapsed(start_time, 2)} seconds')
+    def add_everything_after_tagging(self):
+        with timed_step('add_funders'):
+            self.add_funders()
 
-        start_time = time()
-        self.add_sdgs()
-        logger.info(f'add_sdgs took {elapsed(start_time, 2)} seconds')
+        with timed_step('add_sdgs'):
+            self.add_sdgs()
 
         # for now, only add/update affiliations if they aren't there, or if too many affiliations per author (probably bad data)
-        start_time = time()
         if not self.affiliations:
             logger.info("adding affiliations because work didn't have any yet")
-            self.add_affiliations()
+            with timed_step('add_affiliations'):
+                self.add_affiliations()
             non_null_affs = [aff for aff in self.affiliations if aff.affiliation_id is not None]
             logger.info(f'[AFFILIATION UPDATE] GAINED {len(non_null_affs)} ON WORK ID (0 before): {self.work_id} ({self.doi})')
-            logger.info(
-                f'add_affiliations took {elapsed(start_time, 2)} seconds')
         else:
             logger.info(
                 "updating affiliations because work already has some set, and updating institutions")
-            self.update_institutions()
-            logger.info(
-                f'update_institutions took {elapsed(start_time, 2)} seconds')
-            start_time = time()
-            self.update_affiliations()
-            logger.info(
-                f'update_affiliations took {elapsed(start_time, 2)} seconds')
+            with timed_step('update_institutions'):
+                self.update_institutions()
+            with timed_step('update_affiliations'):
+                self.update_affiliations()
             logger.info("updating orcid")
-            self.update_orcid()
-            logger.info(f'update_orcid took {elapsed(start_time, 2)} seconds')
+            with timed_step('update_orcid'):
+                self.update_orcid()
 
-        start_time = time()
-        self.add_related_versions()
-        logger.info(f'add_versions took {elapsed(start_time, 2)} seconds')
+        with timed_step('add_related_versions'):
+            self.add_related_versions()
 
     def add_funders(self):
         self.full_updated_date = datetime.datetime.utcnow().isoformat()
@@ -926,6 +995,23 @@ class Work(db.Model):
 
         self.full_updated_date = datetime.datetime.utcnow().isoformat()
 
+        if related_works_index.available():
+            related_papers = related_works_index.related_works(self.concepts_for_related_works)
+        else:
+            related_papers = self.fetch_related_papers(self.concepts_for_related_works)
+
+        self.related_works = [
+            models.WorkRelatedWork(
+                paper_id=self.paper_id,
+                recommended_paper_id=related_paper_id,
+                score=average_related_score * average_related_score,
+                updated=datetime.datetime.utcnow().isoformat()
+            )
+            for related_paper_id, average_related_score, total_score in related_papers
+        ]
+
+    @staticmethod
+    def fetch_related_papers(concept_ids):
         matching_papers_sql = """
         with fos as (
             select
@@ -954,20 +1040,13 @@ class Work(db.Model):
         """
 
         with get_db_cursor() as cur:
-            cur.execute(matching_papers_sql,
-                        (tuple(self.concepts_for_related_works),))
+            cur.execute(matching_papers_sql, (tuple(concept_ids),))
             rows = cur.fetchall()
 
-            self.related_works = [
-                models.WorkRelatedWork(
-                    paper_id=self.paper_id,
-                    recommended_paper_id=row["related_paper_id"],
-                    score=row["average_related_score"] * row[
-                        "average_related_score"],
-                    updated=datetime.datetime.utcnow().isoformat()
-                )
-                for row in rows
-            ]
+        return [
+            (row["related_paper_id"], row["average_related_score"], row["total_score"])
+            for row in rows
+        ]
 
     def add_abstract(self):
         self.abstract_indexed_abstract = None
@@ -1337,9 +1416,13 @@ class Work(db.Model):
 
             record = self.affiliation_records_sorted[0]
 
+            authors_json = record.cleaned_authors_json
+            aff_string_to_ror, string_institutions, is_curation_request = self.match_affiliation_institutions(
+                authors_json, curation_requests, affiliation_retry_attempts
+            )
+
             author_sequence_order = 1
-            aff_string_to_ror = {}
-            for author_dict in record.cleaned_authors_json:
+            for author_dict in authors_json:
                 original_name = author_dict["raw"]
                 if author_dict.get("family"):
                     original_name = "{} {}".format(author_dict["given"],
@@ -1372,39 +1455,7 @@ class Work(db.Model):
                         my_institutions = []
 
                         if raw_affiliation_string:
-                            # The following code takes the raw affiliation string and tries to match it with a ROR ID (based on ROR matching algorithm)
-                            if raw_affiliation_string not in aff_string_to_ror:
-                                ror_string_match = RORAffiliationString.query.filter(RORAffiliationString.original_affiliation.in_([raw_affiliation_string])).first()
-                                if ror_string_match:
-                                    aff_string_to_ror[raw_affiliation_string] = {'aff_id': ror_string_match.affiliation_id, 'new_string': False}
-                                else:
-                                    ror_match = self.search_affiliation(raw_affiliation_string, 'search-ror-institutions-v2')
-                                    if ror_match['matched_candidate']:
-                                        ror_id = ror_match['matched_candidate'][0]['id'].split("/")[-1]
-                                        ror_matched_affiliation_id = models.RORGapInstitution.query.filter_by(ror_id=ror_id).first()
-                                        if ror_matched_affiliation_id:
-                                            aff_string_to_ror[raw_affiliation_string] = {'aff_id': ror_matched_affiliation_id.affiliation_id, 'new_string': True}
-                                        else:
-                                            aff_string_to_ror[raw_affiliation_string] = {'aff_id': None, 'new_string': True}
-                                    else:
-                                        aff_string_to_ror[raw_affiliation_string] = {'aff_id': None, 'new_string': True}
-                            
-                            institution_id_matches, is_curation_request_temp = models.Institution.get_institution_ids_from_strings(
-                                [raw_affiliation_string],
-                                curation_requests,
-                                aff_string_to_ror[raw_affiliation_string]['aff_id'],
-                                retry_attempts=affiliation_retry_attempts
-                            )
-                            if is_curation_request_temp:
-                                is_curation_request = True
-                            for institution_id_match in [m for m in
-                                                         institution_id_matches[
-                                                             0] if m]:
-                                my_institution = models.Institution.query.options(
-                                    orm.Load(models.Institution).raiseload('*')
-                                ).get(institution_id_match)
-
-                                my_institutions.append(my_institution)
+                            my_institutions = string_institutions[raw_affiliation_string]
 
                         my_institutions = my_institutions or [None]
 
@@ -1431,7 +1482,7 @@ class Work(db.Model):
                                 affiliation_sequence_order += 1
                     author_sequence_order += 1
             for k, v in aff_string_to_ror.items():
-                if v['new_string']:
+                if v['new_string'] and ror_affiliation_string_inserts.claim(db.session(), k):
                     db.session.execute(
                         insert(RORAffiliationString).values(
                             original_affiliation=k,
@@ -1462,21 +1513,70 @@ class Work(db.Model):
             
     def search_affiliation(self, raw_affiliation_string, ror_search_index_name):
 
-        es = Elasticsearch([ELASTIC_URL], timeout=30)
-        resp = {'elastic_response':es.search(body={
-                    "size": 150,
-                    "query": {
-                        "nested": {
-                            "path": "names",
-                            "score_mode": "max",
-                            "query": {"match": {"names.name": {"query": raw_affiliation_string}}},
-                        }
-                    },
-                }, index=ror_search_index_name)["hits"]["hits"]}
+        resp = {'elastic_response': get_es_client().search(
+            body=ror_search_body(raw_affiliation_string), index=ror_search_index_name
+        )["hits"]["hits"]}
 
         single_search_strategy = RORStrategy()
         return {'matched_candidate': single_search_strategy.match(raw_affiliation_string, resp['elastic_response'])}
 
+    @staticmethod
+    def affiliation_strings_to_match(authors_json):
+        # the cleaned affiliation strings add_affiliations and update_affiliations look up
+        raw_affiliation_strings = []
+        for author_dict in authors_json:
+            original_name = author_dict["raw"]
+            if author_dict.get("family"):
+                original_name = "{} {}".format(author_dict["given"],
+                                               author_dict["family"])
+            if not original_name:
+                continue
+
+            for affiliation_dict in author_dict.get("affiliation") or []:
+                if raw_affiliation_string := clean_html(affiliation_dict.get('name')):
+                    raw_affiliation_strings.append(raw_affiliation_string)
+
+        return list(dict.fromkeys(raw_affiliation_strings))
+
+    def match_affiliation_institutions(self, authors_json, curation_requests, affiliation_retry_attempts=30):
+        """
+        Match all of a record's affiliation strings at once: ROR lookups are batched,
+        each distinct string is resolved once and all matched institutions are
+        fetched in one query.
+        Returns (aff_string_to_ror, {string: [Institution]}, is_curation_request).
+        """
+        raw_affiliation_strings = self.affiliation_strings_to_match(authors_json)
+        aff_string_to_ror = match_affiliation_strings_to_ror(raw_affiliation_strings, 'search-ror-institutions-v2')
+
+        is_curation_request = False
+        string_institution_ids = {}
+        for raw_affiliation_string in raw_affiliation_strings:
+            institution_id_matches, is_curation_request_temp = models.Institution.get_institution_ids_from_strings(
+                [raw_affiliation_string],
+                curation_requests,
+                aff_string_to_ror[raw_affiliation_string]['aff_id'],
+                retry_attempts=affiliation_retry_attempts
+            )
+            if is_curation_request_temp:
+                is_curation_request = True
+            string_institution_ids[raw_affiliation_string] = [m for m in institution_id_matches[0] if m]
+
+        institution_ids = set(i for ids in string_institution_ids.values() for i in ids)
+        institutions = {}
+        if institution_ids:
+            institutions = {
+                institution.affiliation_id: institution for institution in
+                models.Institution.query.options(
+                    orm.Load(models.Institution).raiseload('*')
+                ).filter(models.Institution.affiliation_id.in_(institution_ids)).all()
+            }
+
+        string_institutions = {
+            raw_affiliation_string: [institutions.get(i) for i in ids]
+            for raw_affiliation_string, ids in string_institution_ids.items()
+        }
+        return aff_string_to_ror, string_institutions, is_curation_request
+
     def add_affiliations(self, affiliation_retry_attempts=30):
         self.affiliations = []
         self.full_updated_date = datetime.datetime.utcnow().isoformat()
@@ -1489,9 +1589,13 @@ class Work(db.Model):
 
         curation_requests = self.institution_curation_requests
 
+        authors_json = record.cleaned_authors_json
+        aff_string_to_ror, string_institutions, _ = self.match_affiliation_institutions(
+            authors_json, curation_requests, affiliation_retry_attempts
+        )
+
         author_sequence_order = 1
-        aff_string_to_ror = {}
-        for author_dict in record.cleaned_authors_json:
+        for author_dict in authors_json:
             original_name = author_dict["raw"]
             if author_dict.get("family"):
                 original_name = "{} {}".format(author_dict["given"],
@@ -1510,39 +1614,7 @@ class Work(db.Model):
                     my_institutions = []
 
                     if raw_affiliation_string:
-                        # The following code takes the raw affiliation string and tries to match it with a ROR ID (based on ROR matching algorithm)
-                        if raw_affiliation_string not in aff_string_to_ror:
-                            ror_string_match = RORAffiliationString.query.filter(RORAffiliationString.original_affiliation.in_([raw_affiliation_string])).first()
-                            if ror_string_match:
-                                # ror_matched_affiliation_id = models.RORGapInstitution.query.filter_by(ror_id=ror_string_match[0].ror_id).first()
-                                aff_string_to_ror[raw_affiliation_string] = {'aff_id': ror_string_match.affiliation_id, 'new_string': False}
-                            else:
-                                ror_match = self.search_affiliation(raw_affiliation_string, 'search-ror-institutions-v2')
-                                if ror_match['matched_candidate']:
-                                    ror_id = ror_match['matched_candidate'][0]['id'].split("/")[-1]
-                                    ror_matched_affiliation_id = models.RORGapInstitution.query.filter_by(ror_id=ror_id).first()
-                                    if ror_matched_affiliation_id:
-                                        aff_string_to_ror[raw_affiliation_string] = {'aff_id': ror_matched_affiliation_id.affiliation_id, 'new_string': True}
-                                    else:
-                                        aff_string_to_ror[raw_affiliation_string] = {'aff_id': None, 'new_string': True}
-                                else:
-                                    aff_string_to_ror[raw_affiliation_string] = {'aff_id': None, 'new_string': True}
-                        
-                        institution_id_matches, _ = models.Institution.get_institution_ids_from_strings(
-                            [raw_affiliation_string],
-                            curation_requests,
-                            aff_string_to_ror[raw_affiliation_string]['aff_id'],
-                            retry_attempts=affiliation_retry_attempts
-                        )
-                        
-                        for institution_id_match in [m for m in
-                                                     institution_id_matches[0]
-                                                     if m]:
-                            my_institution = models.Institution.query.options(
-                                orm.Load(models.Institution).raiseload('*')
-                            ).get(institution_id_match)
-
-                            my_institutions.append(my_institution)
+                        my_institutions = string_institutions[raw_affiliation_string]
 
                     my_institutions = my_institutions or [None]
 
@@ -1568,7 +1640,7 @@ class Work(db.Model):
                             affiliation_sequence_order += 1
                 author_sequence_order += 1
         for k, v in aff_string_to_ror.items():
-            if v['new_string']:
+            if v['new_string'] and ror_affiliation_string_inserts.claim(db.session(), k):
                 db.session.execute(
                     insert(RORAffiliationString).values(
                         original_affiliation=k,
@@ -1706,14 +1778,14 @@ class Work(db.Model):
                 setattr(self, work_field, override_val)
 
     @property
-    def records_sorted(self):
-        if not self.records_merged:
-            return []
+    def record_index(self):
+        if self._record_index is None:
+            self._record_index = RecordIndex(self.records)
+        return self._record_index
 
-        return sorted([
-            r for r in self.records_merged if r.is_primary_record()],
-            key=lambda x: x.score, reverse=True
-        ) or []
+    @property
+    def records_sorted(self):
+        return self.record_index.sorted
 
     @property
     def crossref_record(self):
@@ -1730,26 +1802,15 @@ class Work(db.Model):
 
     @property
     def records_merged(self):
-        return [r.with_parsed_data for r in self.records or [] if
-                r.with_parsed_data]
+        return self.record_index.merged
 
     @property
     def affiliation_records_sorted(self):
-        records = [record for record in self.records_sorted if
-                                     record.has_affiliations]
-        if not records:
-            records = [record for record in
-                       self.records_sorted if
-                       record.cleaned_authors_json]
-
-        return sorted(records, key=lambda record: (record.score, record.cleaned_affiliations_count), reverse=True)
+        return self.record_index.affiliation_sorted
 
     @property
     def override_record(self):
-        for record in self.records_sorted:
-            if record.record_type == 'override':
-                return record
-        return None
+        return self.record_index.first_of_type('override')
 
     @property
     def only_mag_records(self):
@@ -1821,15 +1882,16 @@ class Work(db.Model):
 
     @cached_property
     def affiliations_list(self):
-        affiliations = [affiliation for affiliation in self.affiliations_sorted]
+        affiliations = self.affiliations_sorted
         if not affiliations:
             return []
 
         # it seems like sometimes there are 0s and sometimes 1st, so figure out the minimum
-        first_author_sequence_number = min(
-            [affil.author_sequence_number for affil in affiliations])
-        last_author_sequence_number = max(
-            [affil.author_sequence_number for affil in affiliations])
+        first_author_sequence_number = affiliations[0].author_sequence_number
+        last_author_sequence_number = affiliations[-1].author_sequence_number
+
+        # authors and institutions repeat across rows, serialize each once
+        nested_dicts = {}
         affiliation_dict = defaultdict(list)
         for affil in affiliations:
             affil.author_position = "middle"
@@ -1837,16 +1899,28 @@ class Work(db.Model):
                 affil.author_position = "first"
             elif affil.author_sequence_number == last_author_sequence_number:
                 affil.author_position = "last"
-            affiliation_dict[affil.author_sequence_number] += [
-                affil.to_dict("minimum")]
+            affiliation_dict[affil.author_sequence_number].append(
+                affil.to_dict("minimum", nested_dicts=nested_dicts))
+
+        countries_by_raw_affiliation_string = {}
         response = []
         for seq, affil_list in affiliation_dict.items():
-            institution_list = [a["institution"] for a in affil_list if
-                                a["institution"].get("id") is not None]
             # De-dupe by institution["id"]
-            institution_list = list({i['id']: i for i in institution_list}.values())
-            if institution_list == [{}]:
-                institution_list = []
+            institutions_by_id = {}
+            raw_affiliation_strings = set()
+            institution_countries = set()
+            for a in affil_list:
+                institution = a["institution"]
+                if institution.get("id") is not None:
+                    institutions_by_id[institution["id"]] = institution
+                if a.get("raw_affiliation_string"):
+                    raw_affiliation_strings.add(a["raw_affiliation_string"])
+                if institution.get("country_code") is not None:
+                    institution_countries.add(institution["country_code"])
+            institution_list = list(institutions_by_id.values())
+            raw_affiliation_strings = sorted(raw_affiliation_strings)
+            raw_affiliation_string = '; '.join(raw_affiliation_strings)
+
             if len(affiliation_dict) == 1:
                 # override - single author is always corresponding
                 is_corresponding = True
@@ -1854,23 +1928,14 @@ class Work(db.Model):
                 is_corresponding = affil_list[0].get('is_corresponding_author',
                                                      False)
 
-            raw_affiliation_strings = sorted(list(set([
-                a.get("raw_affiliation_string") for a in affil_list
-                if a.get("raw_affiliation_string")
-            ])))
-            raw_affiliation_string = '; '.join(sorted(list(set([
-                a.get("raw_affiliation_string") for a in affil_list
-                if a.get("raw_affiliation_string")
-            ]))))
             # add countries
             if institution_list:
-                countries_list = [a["institution"]["country_code"] for a in
-                                  affil_list if a["institution"].get(
-                        "country_code") is not None]
-                countries = sorted(list(set(countries_list)))
-            elif not institution_list and raw_affiliation_string:
-                countries = self.get_countries_from_raw_affiliation(
-                    raw_affiliation_string)
+                countries = sorted(institution_countries)
+            elif raw_affiliation_string:
+                if raw_affiliation_string not in countries_by_raw_affiliation_string:
+                    countries_by_raw_affiliation_string[raw_affiliation_string] = \
+                        self.get_countries_from_raw_affiliation(raw_affiliation_string)
+                countries = list(countries_by_raw_affiliation_string[raw_affiliation_string])
             else:
                 countries = []
 
@@ -1894,38 +1959,28 @@ class Work(db.Model):
         """
         Affiliations that are displayed within authorships in to_dict().
         """
-        affiliations = []
+        # entries keyed by author_position and raw_affiliation_string, in first seen order
+        affiliations = {}
 
         for affil in affil_list:
             author_position = affil.get("author_position")
             institution_id = affil.get("institution", {}).get("id")
             raw_affiliation_string = affil.get("raw_affiliation_string")
+            if not raw_affiliation_string:
+                continue
 
-            # find an existing entry with the same author_position and raw_affiliation_string
-            found = False
-            for affiliation in affiliations:
-                if (affiliation["author_position"] == author_position and
-                        affiliation[
-                            "raw_affiliation_string"] == raw_affiliation_string):
-                    if institution_id:
-                        affiliation["institution_ids"].append(institution_id)
-                    found = True
-                    break
-
-            # if no such entry exists, create a new one
-            if not found and raw_affiliation_string:
-                affiliations.append({
-                    "author_position": author_position,
+            key = (author_position, raw_affiliation_string)
+            if key in affiliations:
+                if institution_id:
+                    affiliations[key]["institution_ids"].append(institution_id)
+            else:
+                affiliations[key] = {
                     "raw_affiliation_string": raw_affiliation_string,
                     "institution_ids": [
                         institution_id] if institution_id else []
-                })
-
-        # remove author_position, no longer needed
-        for affiliation in affiliations:
-            del affiliation["author_position"]
+                }
 
-        return affiliations
+        return list(affiliations.values())
 
     @cached_property
     def institutions_distinct(self):
@@ -1947,7 +2002,7 @@ class Work(db.Model):
                                                 if as_institution_openalex_id(x.institution_id) 
                                                 not in distinct_authorship_institutions]
             if institution_assertions_short_ids:
-                return [x.institution.to_dict('minimum') for x in institution_assertions_short_ids]
+                return [minimum_dict_cache.get(x.institution) for x in institution_assertions_short_ids]
             else:
                 return []
         else:
@@ -2090,8 +2145,8 @@ class Work(db.Model):
 
     @property
     def is_manual_closed(self):
-        for record in self.records_sorted:
-            if record.record_type == 'override' and not record.is_oa:
+        for record in self.record_index.by_type.get('override', []):
+            if not record.is_oa:
                 return True
         return False
 
@@ -2112,9 +2167,7 @@ class Work(db.Model):
         return detective.type_crossref_calculated
 
     def get_record(self, record_type):
-        for record in self.records_sorted:
-            if record.record_type == record_type:
-                return record
+        return self.record_index.first_of_type(record_type)
 
     @cached_property
     def type_calculated(self):
@@ -2227,47 +2280,22 @@ class Work(db.Model):
             return None
 
         year = max(self.year, 1920)
-        citation_count = self.counts.citation_count if self.counts else 0
-
-        base_query = models.CitationPercentilesByYear.query.filter_by(year=year)
-
-        exact_row = base_query.filter_by(citation_count=citation_count).first()
-        higher_row = base_query.filter(
-            models.CitationPercentilesByYear.citation_count > citation_count) \
-            .order_by(models.CitationPercentilesByYear.citation_count.asc()) \
-            .first()
-
-        # sometimes cited_by_count is higher than the highest row in the table. In that case return highest row in table.
-        if higher_row is None:
-            higher_row = base_query.order_by(
-                models.CitationPercentilesByYear.citation_count.desc()) \
-                .first()
-            if higher_row and higher_row.citation_count > citation_count:
-                higher_row = None
-
-        if exact_row:
-            return self.format_percentiles(exact_row.percentile,
-                                           higher_row.percentile if higher_row else exact_row.percentile)
-
-        # try closest lower row
-        lower_row = base_query.filter(
-            models.CitationPercentilesByYear.citation_count < citation_count) \
-            .order_by(models.CitationPercentilesByYear.citation_count.desc()) \
-            .first()
-
-        if not lower_row or not higher_row:
+        citation_count = self.citation_metrics.citation_count
+
+        percents = models.citation_percentile_table.lookup(year, citation_count)
+        if not percents:
             logger.info(
                 f"no percentiles for {self.paper_id} {self.year} {citation_count}")
             return None
 
-        return self.format_percentiles(lower_row.percentile,
-                                       higher_row.percentile)
+        return self.format_percent_range(*percents)
 
     @staticmethod
     def format_percentiles(min_perc, max_perc):
-        min_percentile = int(round(min_perc * 100))
-        max_percentile = int(round(max_perc * 100))
+        return Work.format_percent_range(int(round(min_perc * 100)), int(round(max_perc * 100)))
 
+    @staticmethod
+    def format_percent_range(min_percentile, max_percentile):
         # override for max value
         if min_percentile == 100:
             min_percentile = 99
@@ -2343,6 +2371,20 @@ class Work(db.Model):
     def handle_indexing(self, index_suffix):
         bulk_actions = []
 
+        store_fingerprint = None
+        if WORK_STORE_FINGERPRINTS and 'store_fingerprint' not in inspect(self).unloaded:
+            start_time = time()
+            store_fingerprint = work_store_fingerprint(self)
+            logger.info(f'store fingerprint took {elapsed(start_time, 4)} seconds')
+            if (
+                self.store_fingerprint
+                and self.store_fingerprint.fingerprint == store_fingerprint
+                and self.json_entity_hash
+                and self.store_fingerprint.json_entity_hash == self.json_entity_hash
+            ):
+                logger.info(f"store inputs not changed, don't save again {self.openalex_id}")
+                return bulk_actions
+
         my_dict = self.to_dict("full")
         my_dict['updated'] = my_dict.get('updated_date')
         my_dict['@timestamp'] = datetime.datetime.utcnow().isoformat()
@@ -2391,6 +2433,8 @@ class Work(db.Model):
             """
             db.session.execute(text(sq), {"work_id": self.paper_id,
                                           "now": datetime.datetime.utcnow().isoformat()})
+            # keep retrying these until the author ids are fixed
+            store_fingerprint = None
         elif entity_hash != self.json_entity_hash:
             logger.info(
                 f"dictionary for {self.openalex_id} new or changed, so save again")
@@ -2433,8 +2477,18 @@ class Work(db.Model):
 
         self.json_entity_hash = entity_hash
         self.updated_date = my_dict.get('updated_date')
+
+        if store_fingerprint:
+            self.save_store_fingerprint(store_fingerprint, entity_hash)
         return bulk_actions
 
+    def save_store_fingerprint(self, fingerprint, entity_hash):
+        if not self.store_fingerprint:
+            self.store_fingerprint = WorkStoreFingerprint(paper_id=self.paper_id)
+        self.store_fingerprint.fingerprint = fingerprint
+        self.store_fingerprint.json_entity_hash = entity_hash
+        self.store_fingerprint.updated = datetime.datetime.utcnow().isoformat()
+
     @cached_property
     def display_counts_by_year(self):
         response_dict = {}
@@ -2486,8 +2540,7 @@ class Work(db.Model):
             if r.record_type == 'crossref_doi' or r.record_type == 'datacite_doi':
                 doi_url = f'https://doi.org/{r.doi}'
                 doi_location = {
-                    'source': r.journal and r.journal.to_dict(
-                        return_level='minimum'),
+                    'source': r.journal and minimum_dict_cache.get(r.journal),
                     'pdf_url': r.work_pdf_url,
                     'landing_page_url': r.record_webpage_url,
                     'is_oa': r.is_oa,
@@ -2536,8 +2589,7 @@ class Work(db.Model):
                     doi_url = None
 
                 pmh_location = {
-                    'source': r.journal and r.journal.to_dict(
-                        return_level='minimum'),
+                    'source': r.journal and minimum_dict_cache.get(r.journal),
                     'pdf_url': r.work_pdf_url,
                     'landing_page_url': r.record_webpage_url,
                     'is_oa': r.is_oa,
@@ -2603,8 +2655,7 @@ class Work(db.Model):
                 if (
                         not self.records_merged or self.only_mag_records) and self.journal:
                     # mag location, assume it came from the work's mag journal
-                    other_location_dict['source'] = self.journal.to_dict(
-                        return_level='minimum')
+                    other_location_dict['source'] = minimum_dict_cache.get(self.journal)
 
                 locations.append(other_location_dict)
 
@@ -2638,7 +2689,7 @@ class Work(db.Model):
             if r.record_type == 'datacite_doi':
                 datacite_source = models.Source.query.get(4393179698)
                 datacite_location = {
-                    'source': datacite_source.to_dict(return_level='minimum'),
+                    'source': minimum_dict_cache.get(datacite_source),
                     'pdf_url': None,
                     'landing_page_url': f'https://api.datacite.org/dois/{r.doi}',
                     'is_oa': None,
@@ -2673,8 +2724,7 @@ class Work(db.Model):
 
         if (r := self.override_location_record) and (r.work_pdf_url not in seen_urls and r.record_webpage_url not in seen_urls):
             override_location = {
-                'source': r.journal and r.journal.to_dict(
-                        return_level='minimum'),
+                'source': r.journal and minimum_dict_cache.get(r.journal),
                 'pdf_url': r.work_pdf_url,
                 'landing_page_url': r.record_webpage_url,
                 'version': r.open_version,
@@ -2704,8 +2754,7 @@ class Work(db.Model):
         source_match_exceptions = ['Zoonoses']
         if locations and locations[0][
             'source'] is None and self.safety_journals:
-            source_match = self.safety_journals[0].to_dict(
-                return_level='minimum')
+            source_match = minimum_dict_cache.get(self.safety_journals[0])
             if source_match and source_match[
                 'display_name'] not in source_match_exceptions:
                 locations[0]['source'] = source_match
@@ -2748,39 +2797,7 @@ class Work(db.Model):
 
     @staticmethod
     def get_countries_from_raw_affiliation(raw_affiliation):
-        countries_in_string = []
-        # Hopeful first match
-        _ = [countries_in_string.append(x) for x, y in COUNTRIES.items() if
-             max([1 if re.search(fr"\b{i}\b", raw_affiliation) else 0 for i in
-                  y]) > 0]
-        if not countries_in_string:
-            # Replace '.' to see if match can be found
-            _ = [countries_in_string.append(x) for x, y in COUNTRIES.items() if
-                 max([1 if re.search(fr"\b{i}\b",
-                                     raw_affiliation.replace(".", "")) else 0
-                      for i in y]) > 0]
-            if not countries_in_string:
-                # Remove word boundary requirement
-                _ = [countries_in_string.append(x) for x, y in COUNTRIES.items()
-                     if
-                     max([1 if re.search(fr"{i}", raw_affiliation) else 0 for i
-                          in y]) > 0]
-                if not countries_in_string:
-                    # Lowercase all text to catch weird capitalizations
-                    _ = [countries_in_string.append(x) for x, y in
-                         COUNTRIES.items() if
-                         max([1 if re.search(fr"\b{i.lower()}\b",
-                                             raw_affiliation.lower()) else 0 for
-                              i in y]) > 0]
-
-        final_countries = sorted(list(set(countries_in_string)))
-
-        # If we match to Georgia countries GE or GS, remove US match that came from short state string
-        if (
-                "GE" in final_countries or "GS" in final_countries) and "US" in final_countries:
-            final_countries.remove("US")
-
-        return final_countries
+        return country_matcher.countries(raw_affiliation)
 
     @cached_property
     def countries_distinct_count(self):
@@ -2817,10 +2834,8 @@ class Work(db.Model):
     
     @property
     def citations_normalized_percentile(self):
-        normalized_citation_percentile = round(self.work_citations_norm_percentile.normalized_citation_percentile, 6) \
-              if (self.work_citations_norm_percentile) \
-              and (self.work_citations_norm_percentile.normalized_citation_percentile or 
-                   (self.work_citations_norm_percentile.normalized_citation_percentile == 0.0)) else None
+        normalized_citation_percentile = round(self.citation_metrics.normalized_citation_percentile, 6) \
+              if self.citation_metrics.normalized_citation_percentile is not None else None
         return {"value": normalized_citation_percentile, 
                 "is_in_top_1_percent": normalized_citation_percentile >= 0.99, 
                 "is_in_top_10_percent": normalized_citation_percentile >= 0.90} if (normalized_citation_percentile or 
@@ -2946,12 +2961,10 @@ class Work(db.Model):
 
             response.update({
                 # "doc_type": self.doc_type,
-                "cited_by_count": self.counts.citation_count if self.counts else 0,
+                "cited_by_count": self.citation_metrics.citation_count,
                 "summary_stats": {
-                    "cited_by_count": int(
-                        self.counts.citation_count or 0) if self.counts else 0,
-                    "2yr_cited_by_count": int(
-                        self.citation_count_2year.count or 0) if self.citation_count_2year else 0
+                    "cited_by_count": int(self.citation_metrics.citation_count or 0),
+                    "2yr_cited_by_count": self.citation_metrics.citation_count_2year
                 },
                 "biblio": {
                     "volume": self.volume,
@@ -2969,8 +2982,7 @@ class Work(db.Model):
                 "primary_topic": [topic.to_dict("minimum") for topic in
                                   self.topics_sorted[:1]][
                     0] if self.topics_sorted else None,
-                "fwci": round(self.work_fwci.fwci, 3) if (self.work_fwci) and (
-                    self.work_fwci.fwci or (self.work_fwci.fwci == 0.0)) else None,
+                "fwci": round(self.citation_metrics.fwci, 3) if self.citation_metrics.fwci is not None else None,
                 "citation_normalized_percentile": self.citations_normalized_percentile,
                 "mesh": [mesh.to_dict("minimum") for mesh in self.mesh_sorted],
                 "locations_count": self.locations_count(),
@@ -3051,6 +3063,24 @@ def on_year_change(mapper, connection, target):
 event.listen(Work, 'before_update', on_year_change)
 
 
+def invalidate_record_index(target, *args):
+    # attribute events on Work.records are registered in models/__init__.py, after the relationship exists
+    target._record_index = None
+
+
+def invalidate_record_index_on_expire(target, attrs):
+    if attrs is None or 'records' in attrs:
+        target._record_index = None
+
+
+def invalidate_record_index_on_refresh(target, context, attrs):
+    invalidate_record_index_on_expire(target, attrs)
+
+
+event.listen(Work, 'expire', invalidate_record_index_on_expire)
+event.listen(Work, 'refresh', invalidate_record_index_on_refresh)
+
+
 class WorkFulltext(db.Model):
     __table_args__ = {'schema': 'mid'}
     __tablename__ = "work_fulltext"
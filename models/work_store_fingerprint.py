@@ -0,0 +1,131 @@
+import datetime
+import hashlib
+import os
+
+from sqlalchemy.orm.attributes import instance_state
+
+from app import db
+
+# skip Work.handle_indexing serialization when the store inputs haven't changed.
+# needs the mid.work_store_fingerprint table from sql/work_store_fingerprint.sql
+WORK_STORE_FINGERPRINTS = os.getenv("WORK_STORE_FINGERPRINTS", "False") == "True"
+
+# bump to invalidate all stored fingerprints, e.g. when to_dict changes
+WORK_STORE_FINGERPRINT_VERSION = 3
+
+
+class WorkStoreFingerprint(db.Model):
+    __table_args__ = {'schema': 'mid'}
+    __tablename__ = "work_store_fingerprint"
+
+    paper_id = db.Column(db.BigInteger, db.ForeignKey("mid.work.paper_id"), primary_key=True)
+    fingerprint = db.Column(db.Text)
+    json_entity_hash = db.Column(db.Text)
+    updated = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<WorkStoreFingerprint ( {} ) {}>".format(self.paper_id, self.fingerprint)
+
+
+# columns bumped whenever a row changes. Related rows that have one are hashed by
+# it instead of by all their columns (record authors json, affiliation strings)
+VERSION_COLUMNS = ('updated_date', 'updated')
+
+_mapper_plans = {}
+
+
+def _mapper_plan(mapper):
+    # (column keys, version column keys, relationships) per mapped class, worked out once
+    if (plan := _mapper_plans.get(mapper)) is None:
+        column_keys = [attr.key for attr in mapper.column_attrs]
+        plan = _mapper_plans[mapper] = (
+            column_keys,
+            [key for key in VERSION_COLUMNS if key in column_keys],
+            [(r.key, r.uselist) for r in mapper.relationships],
+        )
+    return plan
+
+
+def _encode_value(value):
+    if isinstance(value, str):
+        encoded = value.encode('utf-8', 'surrogatepass')
+        return b'%d:%s' % (len(encoded), encoded)
+    return repr(value).encode('utf-8')
+
+
+def loaded_state_fingerprint(obj, exclude=()):
+    """
+    Hash of obj and every object reachable from it through relationships that
+    are already loaded. Nothing is lazy loaded. obj is hashed by its column
+    values, other objects by their identity and row version (see
+    VERSION_COLUMNS), or by their columns if their table has no version.
+    Relationships are hashed as the identities they point to, so each object
+    is encoded on its own and the sorted encodings don't depend on load or
+    traversal order. exclude names attributes of obj itself to leave out.
+    """
+    identities = {}
+
+    def identity(o):
+        if (key := identities.get(id(o))) is None:
+            state = instance_state(o)
+            # not yet persisted objects never match a stored fingerprint
+            key = identities[id(o)] = f'{type(o).__name__}{state.identity or ("transient", id(o))}'.encode('utf-8')
+        return key
+
+    entries = []
+    seen = set()
+    to_visit = [obj]
+
+    while to_visit:
+        o = to_visit.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+
+        state = instance_state(o)
+        loaded = state.dict
+        column_keys, version_keys, relationships = _mapper_plan(state.mapper)
+        parts = [identity(o)]
+
+        if o is obj:
+            column_keys = [key for key in column_keys if key not in exclude]
+        else:
+            column_keys = [key for key in version_keys if loaded.get(key) is not None][:1] or column_keys
+        for key in column_keys:
+            if key in loaded:
+                parts.append(key.encode('utf-8'))
+                parts.append(_encode_value(loaded[key]))
+
+        for key, uselist in relationships:
+            if key not in loaded or (o is obj and key in exclude):
+                continue
+            value = loaded[key]
+            parts.append(key.encode('utf-8'))
+            if value is None:
+                parts.append(b'-')
+            elif uselist:
+                parts.append(b'%d[' % len(value))
+                parts.extend(sorted(identity(member) for member in value))
+                to_visit.extend(value)
+            else:
+                parts.append(identity(value))
+                to_visit.append(value)
+
+        entries.append(b'\x1f'.join(parts))
+
+    h = hashlib.blake2b(digest_size=16)
+    for entry in sorted(entries):
+        h.update(b'%d:' % len(entry))
+        h.update(entry)
+    return h.hexdigest()
+
+
+def work_store_fingerprint(work):
+    # the date is part of the fingerprint because to_dict also reads in-memory
+    # tables (citation percentiles, merged ids) that refresh up to daily.
+    # citation metrics are side-loaded rather than relationships, so add them explicitly
+    return hashlib.blake2b(
+        f'{WORK_STORE_FINGERPRINT_VERSION}:{datetime.datetime.utcnow().date()}:{tuple(work.citation_metrics)!r}:'.encode('utf-8')
+        + loaded_state_fingerprint(work, exclude=('json_entity_hash', 'updated_date', 'store_fingerprint')).encode('utf-8'),
+        digest_size=16
+    ).hexdigest()
@@ -0,0 +1,170 @@
+import json
+import os
+import re
+import threading
+import traceback
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import logger
+
+_repo_root = os.path.dirname(os.path.abspath(__file__))
+
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r"\b\d+(?:\.\d+)?\b")
+_in_list = re.compile(r"\bIN\s*\((?:\s*(?:\?|%\(\w+\)s|%s|\[POSTCOMPILE_\w+\]|__\[POSTCOMPILE_\w+\])\s*,?)+\)", re.IGNORECASE)
+_whitespace = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """Statement shape with literals and IN lists replaced, so repeats group together."""
+    statement = _string_literal.sub("?", statement)
+    statement = _number_literal.sub("?", statement)
+    statement = _in_list.sub("IN (...)", statement)
+    return _whitespace.sub(" ", statement).strip()
+
+
+def _caller():
+    # innermost frame in our code that isn't this module or sqlalchemy
+    for frame in reversed(traceback.extract_stack()[:-1]):
+        if frame.filename.startswith(_repo_root) and frame.filename != __file__:
+            return f"{os.path.relpath(frame.filename, _repo_root)}:{frame.lineno} in {frame.name}"
+    return None
+
+
+class QueryProfile:
+    """Statements counted for one chunk, by method and normalized SQL."""
+    def __init__(self, min_objects):
+        self.min_objects = min_objects
+        self._lock = Lock()
+        self.objects = defaultdict(set)  # method -> profiled object labels
+        self.shapes = defaultdict(lambda: {'count': 0, 'objects': defaultdict(int), 'caller': None})
+
+    def add_object(self, method, label):
+        with self._lock:
+            self.objects[method].add(label)
+
+    def count(self, method, label, statement):
+        shape = normalize_sql(statement)
+        with self._lock:
+            stats = self.shapes[(method, shape)]
+            stats['count'] += 1
+            stats['objects'][label] += 1
+            new_shape = stats['caller'] is None
+        if new_shape:
+            stats['caller'] = _caller()
+
+    def report(self):
+        with self._lock:
+            shapes = list(self.shapes.items())
+            objects = {method: len(labels) for method, labels in self.objects.items()}
+
+        methods = {}
+        for (method, shape), stats in shapes:
+            num_objects = len(stats['objects'])
+            max_per_object = max(stats['objects'].values())
+            method_report = methods.setdefault(method, {
+                'objects': objects.get(method, 0),
+                'statements': 0,
+                'shapes': [],
+            })
+            method_report['statements'] += stats['count']
+            method_report['shapes'].append({
+                'sql': shape,
+                'count': stats['count'],
+                'objects': num_objects,
+                'max_per_object': max_per_object,
+                'caller': stats['caller'],
+                'suspected_n_plus_one': num_objects >= self.min_objects or max_per_object > 1,
+            })
+
+        for method_report in methods.values():
+            method_report['statements_per_object'] = round(
+                method_report['statements'] / method_report['objects'], 2
+            ) if method_report['objects'] else None
+            method_report['shapes'].sort(key=lambda s: (not s['suspected_n_plus_one'], -s['count']))
+
+        return methods
+
+    def write_report(self, path):
+        report = self.report()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, path)
+
+        for method, method_report in report.items():
+            suspects = [s for s in method_report['shapes'] if s['suspected_n_plus_one']]
+            logger.info(
+                f"query profile for {method}: {method_report['statements']} statements over "
+                f"{method_report['objects']} objects, {len(suspects)} suspected N+1 shapes")
+            for suspect in suspects[:5]:
+                logger.info(f"  {suspect['count']}x over {suspect['objects']} objects from {suspect['caller']}: {suspect['sql'][:200]}")
+
+
+class QueryProfiler:
+    """
+    Opt-in statement counter for the store and add_everything paths.
+
+    Wrap per-object work in profile(obj, method). Every statement executed on
+    that thread is counted under the method and its normalized SQL, along with
+    the object that ran it and the first place in our code it came from.
+
+    Counts go to the QueryProfile that was current when profile() was entered.
+    take() swaps in a fresh one and returns the finished chunk's, so a chunk's
+    report never picks up statements from the next chunk, whichever thread
+    writes it. Its report() flags shapes that look like N+1 loads: run for
+    many objects of a chunk, or run more than once for the same object.
+    """
+    def __init__(self, min_objects=3):
+        self.min_objects = min_objects
+        self.enabled = False
+        self._lock = Lock()
+        self._local = threading.local()
+        self._current = QueryProfile(min_objects)
+
+    def take(self):
+        with self._lock:
+            chunk_profile, self._current = self._current, QueryProfile(self.min_objects)
+        return chunk_profile
+
+    def enable(self):
+        if not self.enabled:
+            event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+            self.enabled = True
+
+    def disable(self):
+        if self.enabled:
+            event.remove(Engine, "before_cursor_execute", self._before_cursor_execute)
+            self.enabled = False
+
+    @contextmanager
+    def profile(self, obj, method):
+        if not self.enabled:
+            yield
+            return
+
+        label = str(obj)
+        with self._lock:
+            chunk_profile = self._current
+        chunk_profile.add_object(method, label)
+        previous = getattr(self._local, 'context', None)
+        self._local.context = (chunk_profile, label, method)
+        try:
+            yield
+        finally:
+            self._local.context = previous
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not (current := getattr(self._local, 'context', None)):
+            return
+
+        chunk_profile, label, method = current
+        chunk_profile.count(method, label, statement)
+
+
+query_profiler = QueryProfiler()
@@ -0,0 +1,281 @@
+import argparse
+import datetime
+import gc
+import json
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from time import perf_counter
+
+import models
+from app import db, logger
+from models.work_metrics import attach_work_metrics
+from models.work_store_fingerprint import work_store_fingerprint
+from model_client import StubTransport, concept_tagger, topic_classifier, institution_matcher
+from scripts.works_query import base_fast_queue_works_query
+
+# Benchmark for the work store hot path: base_fast_queue_works_query, the store
+# fingerprint, Work.store() and serializing the bulk actions the way the ES client would.
+#
+# Needs POSTGRES_URL to point at a scratch database with the openalex schema
+# (a schema-only dump is enough). SQLite can't stand in: the models use
+# postgres schemas, ARRAY columns and postgres-only inserts.
+# Fixture works are inserted in a transaction that is rolled back at the end.
+# Elasticsearch and redis aren't touched, and model endpoints are stubbed.
+#
+#   python -m scripts.benchmark_work_store --rounds 5 --output bench.json
+#   python -m scripts.benchmark_work_store --baseline bench.json --max-regression 0.15
+#
+# Authorship assembly should stay linear in the number of authors, so the store
+# time per author for authors_5000 is checked against authors_1000 every run.
+
+FIXTURE_PAPER_ID_START = 9_900_000_000
+
+# kind -> (number of works, authors per work, locations per work, references per work, abstract words)
+FIXTURE_KINDS = {
+    'small': (50, 1, 1, 0, 0),
+    'median': (50, 6, 2, 35, 200),
+    'authors_1000': (5, 1000, 1, 40, 250),
+    'authors_5000': (2, 5000, 1, 40, 250),
+    'locations_500': (5, 4, 500, 20, 150),
+}
+
+
+def fixture_work(paper_id, num_authors, num_locations, num_references, abstract_words):
+    now = datetime.datetime.utcnow()
+    doi = f'10.9999/benchmark.{paper_id}'
+    authors_json = [
+        {
+            'raw': f'Author {i} Benchmark',
+            'given': f'Author{i}',
+            'family': 'Benchmark',
+            'sequence': 'first' if i == 0 else 'additional',
+            'affiliation': [{'name': f'Department {i % 7}, Benchmark University {i % 13}, Springfield, USA'}],
+        }
+        for i in range(num_authors)
+    ]
+
+    work = models.Work(
+        paper_id=paper_id,
+        doi=doi,
+        doi_lower=doi,
+        paper_title=f'Benchmark work {paper_id} on the throughput of storing works',
+        original_title=f'Benchmark work {paper_id} on the throughput of storing works',
+        year=2023,
+        publication_date=datetime.datetime(2023, 5, 17),
+        created_date=now,
+        updated_date=now,
+        full_updated_date=now,
+        genre='journal-article',
+        type='article',
+        type_crossref='journal-article',
+        language='en',
+        oa_status='closed',
+    )
+    work.records = [models.Record(
+        id=f'benchmark-{paper_id}',
+        record_type='crossref_doi',
+        doi=doi,
+        title=work.paper_title,
+        published_date=work.publication_date,
+        genre='journal-article',
+        authors=json.dumps(authors_json),
+        updated=now,
+    )]
+    work.affiliations = [
+        models.Affiliation(
+            author=models.Author(
+                author_id=paper_id * 10_000 + i,
+                display_name=author['raw'],
+                created_date=now,
+                updated_date=now,
+            ),
+            author_sequence_number=i + 1,
+            affiliation_sequence_number=1,
+            original_author=author['raw'],
+            original_affiliation=author['affiliation'][0]['name'],
+            updated_date=now,
+        )
+        for i, author in enumerate(authors_json)
+    ]
+    work.locations = [
+        models.Location(
+            source_url=f'https://example.org/benchmark/{paper_id}/{i}',
+            url=f'https://example.org/benchmark/{paper_id}/{i}',
+            url_for_landing_page=f'https://example.org/benchmark/{paper_id}/{i}',
+            host_type='repository' if i else 'publisher',
+            version='publishedVersion',
+            is_best=i == 0,
+            evidence='benchmark',
+        )
+        for i in range(num_locations)
+    ]
+    work.references = [
+        models.Citation(paper_reference_id=FIXTURE_PAPER_ID_START - 1 - j)
+        for j in range(num_references)
+    ]
+    if abstract_words:
+        words = [f'word{k % 97}' for k in range(abstract_words)]
+        inverted_index = {}
+        for position, word in enumerate(words):
+            inverted_index.setdefault(word, []).append(position)
+        work.abstract = models.Abstract(
+            abstract=' '.join(words),
+            indexed_abstract=json.dumps({'IndexLength': len(words), 'InvertedIndex': inverted_index}),
+        )
+    return work
+
+
+def insert_fixtures():
+    ids_by_kind = {}
+    paper_id = FIXTURE_PAPER_ID_START
+    for kind, (num_works, num_authors, num_locations, num_references, abstract_words) in FIXTURE_KINDS.items():
+        ids_by_kind[kind] = []
+        for _ in range(num_works):
+            db.session.add(fixture_work(paper_id, num_authors, num_locations, num_references, abstract_words))
+            ids_by_kind[kind].append(paper_id)
+            paper_id += 1
+    db.session.flush()
+    db.session.expunge_all()
+    return ids_by_kind
+
+
+@contextmanager
+def phase(timings, name, trace_allocations):
+    gc.collect()
+    if trace_allocations:
+        tracemalloc.start()
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + perf_counter() - start_time
+        if trace_allocations:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            timings[f'{name}_peak_bytes'] = max(timings.get(f'{name}_peak_bytes', 0), peak)
+
+
+def run_round(ids_by_kind, trace_allocations):
+    results = {}
+    for kind, paper_ids in ids_by_kind.items():
+        timings = {}
+        db.session.expunge_all()
+
+        with phase(timings, 'load', trace_allocations):
+            works = base_fast_queue_works_query().filter(models.Work.paper_id.in_(paper_ids)).all()
+            attach_work_metrics(works)
+
+        # what store() spends to find out it can skip serializing, compare with store
+        with phase(timings, 'fingerprint', trace_allocations):
+            for work in works:
+                work_store_fingerprint(work)
+
+        bulk_actions = []
+        with phase(timings, 'store', trace_allocations):
+            for work in works:
+                # force the full serialize path every round
+                work.json_entity_hash = None
+                bulk_actions += [action for action in work.store() if action]
+
+        with phase(timings, 'serialize_actions', trace_allocations):
+            num_bytes = sum(len(json.dumps(action.get('_source', {}))) for action in bulk_actions)
+
+        timings['works'] = len(works)
+        timings['bulk_actions'] = len(bulk_actions)
+        timings['bulk_bytes'] = num_bytes
+        results[kind] = timings
+    return results
+
+
+def summarize(rounds):
+    summary = {}
+    for kind in rounds[0]:
+        works = rounds[0][kind]['works']
+        kind_summary = {'works': works, 'bulk_bytes_per_work': rounds[0][kind]['bulk_bytes'] // max(works, 1)}
+        for phase_name in ('load', 'fingerprint', 'store', 'serialize_actions'):
+            # best round, the others mostly measure noise on shared machines
+            seconds = min(r[kind][phase_name] for r in rounds)
+            kind_summary[f'{phase_name}_works_per_second'] = round(works / seconds, 2) if seconds else None
+            kind_summary[f'{phase_name}_ms_per_work'] = round(seconds * 1000 / max(works, 1), 3)
+            if f'{phase_name}_peak_bytes' in rounds[0][kind]:
+                kind_summary[f'{phase_name}_peak_bytes'] = max(r[kind][f'{phase_name}_peak_bytes'] for r in rounds)
+        summary[kind] = kind_summary
+    return summary
+
+
+def regressions(summary, baseline, max_regression):
+    found = []
+    for kind, kind_summary in summary.items():
+        for key, value in kind_summary.items():
+            if not key.endswith('_works_per_second') or kind not in baseline:
+                continue
+            baseline_value = baseline[kind].get(key)
+            if baseline_value and value is not None and value < baseline_value * (1 - max_regression):
+                found.append(f'{kind} {key}: {value} vs baseline {baseline_value}')
+    return found
+
+
+def author_scaling(summary, small_kind='authors_1000', large_kind='authors_5000'):
+    # store ms per author of the large fixture over the small one, ~1 when linear
+    def ms_per_author(kind):
+        return summary[kind]['store_ms_per_work'] / FIXTURE_KINDS[kind][1]
+
+    if small_kind not in summary or large_kind not in summary or not ms_per_author(small_kind):
+        return None
+    return round(ms_per_author(large_kind) / ms_per_author(small_kind), 3)
+
+
+def stub_model_endpoints():
+    # store() shouldn't call any model, fail loudly in the log if it starts to
+    def handler(json_body):
+        logger.error('model endpoint called during the store benchmark')
+        return 503, None
+
+    for endpoint in (concept_tagger, topic_classifier, institution_matcher):
+        endpoint.transport = StubTransport(handler)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=5, help="how many times to load and store each fixture kind")
+    parser.add_argument('--allocations', action='store_true', help="trace peak allocations per phase (slower)")
+    parser.add_argument('--output', type=str, help="write the summary as json to this path")
+    parser.add_argument('--baseline', type=str, help="summary json from an earlier run to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.15, help="allowed works/sec drop vs the baseline")
+    parser.add_argument('--max-scaling', type=float, default=2.0, help="allowed store time per author, authors_5000 vs authors_1000")
+    parsed_args = parser.parse_args()
+
+    stub_model_endpoints()
+
+    try:
+        ids_by_kind = insert_fixtures()
+        rounds = [run_round(ids_by_kind, parsed_args.allocations) for _ in range(parsed_args.rounds)]
+    finally:
+        db.session.rollback()
+
+    summary = summarize(rounds)
+    for kind, kind_summary in summary.items():
+        logger.info(f'{kind}: {kind_summary}')
+    scaling = author_scaling(summary)
+    logger.info(f'store time per author, authors_5000 vs authors_1000: {scaling}')
+
+    if parsed_args.output:
+        with open(parsed_args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if parsed_args.baseline:
+        with open(parsed_args.baseline) as f:
+            baseline = json.load(f)
+        if found := regressions(summary, baseline, parsed_args.max_regression):
+            for regression in found:
+                logger.error(f'regression: {regression}')
+            sys.exit(1)
+
+    if scaling is not None and scaling > parsed_args.max_scaling:
+        logger.error(f'store time per author grows {scaling}x from 1000 to 5000 authors, max is {parsed_args.max_scaling}')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import argparse
+from time import sleep, time
+
+from app import logger
+from models.related_works import RELATED_WORKS_INDEX_PATH, RelatedWorksIndex
+
+
+def run_refresher(index, refresh_seconds, rebuild_seconds, batch_size, keep_versions):
+    """
+    The single job keeping the related works index fresh: rebuilds it every
+    rebuild_seconds and in between publishes the postings of changed concepts
+    every refresh_seconds, for the workers to pick up.
+    """
+    while True:
+        loop_start = time()
+        version = index.current_version()
+        if version is None or (version == index.version and time() - index.built_at >= rebuild_seconds):
+            version = index.build(batch_size=batch_size, keep_versions=keep_versions)
+        if version != index.version:
+            index.load(version)
+            index.drop_published_before_build()
+            continue
+
+        index.publish_changed_concepts()
+        sleep(max(0, refresh_seconds - (time() - loop_start)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', nargs="?", type=str, default=RELATED_WORKS_INDEX_PATH,
+                        help="directory for the index, defaults to RELATED_WORKS_INDEX_PATH")
+    parser.add_argument('--top-k', nargs="?", type=int, default=1000, help="how many papers to keep per concept")
+    parser.add_argument('--batch-size', nargs="?", type=int, default=500, help="how many concepts to fetch per query")
+    parser.add_argument('--keep-versions', nargs="?", type=int, default=2, help="how many builds to keep on disk")
+    parser.add_argument('--refresh', action='store_true',
+                        help="keep running: publish changed concepts for the workers and rebuild periodically")
+    parser.add_argument('--refresh-seconds', nargs="?", type=int, default=600,
+                        help="with --refresh, how often to publish changed concepts")
+    parser.add_argument('--rebuild-hours', nargs="?", type=float, default=24,
+                        help="with --refresh, how often to rebuild the index")
+    parsed_args = parser.parse_args()
+
+    if not parsed_args.path:
+        parser.error("--path or RELATED_WORKS_INDEX_PATH is required")
+
+    related_works_index = RelatedWorksIndex(parsed_args.path, top_k=parsed_args.top_k)
+    if parsed_args.refresh:
+        logger.info(f'refreshing the related works index at {parsed_args.path}')
+        run_refresher(
+            related_works_index,
+            refresh_seconds=parsed_args.refresh_seconds,
+            rebuild_seconds=parsed_args.rebuild_hours * 3600,
+            batch_size=parsed_args.batch_size,
+            keep_versions=parsed_args.keep_versions
+        )
+    else:
+        related_works_index.build(batch_size=parsed_args.batch_size, keep_versions=parsed_args.keep_versions)
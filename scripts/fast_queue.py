@@ -1,20 +1,25 @@
 import argparse
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue, Full
+from threading import Event, Thread
 from time import sleep, time
 
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk, BulkIndexError
 from redis import Redis
 from sqlalchemy import orm, text, insert, delete
 from sqlalchemy.orm import selectinload
 
 import models
-from app import ELASTIC_URL, logger
 from app import REDIS_QUEUE_URL
 from app import db
 from app import logger
+from es_client import bulk_index, get_es_client
+from metrics import step_metrics
+from query_profiler import query_profiler
 from models import REDIS_WORK_QUEUE
+from models.minimum_dict_cache import minimum_dict_cache
+from models.work import as_work_openalex_id
+from models.work_metrics import attach_work_metrics
 from scripts.works_query import base_fast_queue_works_query
 from util import elapsed
 
@@ -25,6 +30,39 @@ from util import elapsed
 
 _redis = Redis.from_url(REDIS_QUEUE_URL)
 
+# ids leased from the redis work queue get pushed back this far, so they're picked
+# up again if this process dies before acking them
+WORK_STORE_LEASE_SECONDS = 600
+
+# lease up to ARGV[1] ids scored at or before now (ARGV[2]) by moving them to the lease deadline (ARGV[3])
+_lease_work_store_ids = _redis.register_script("""
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[2], 'LIMIT', 0, ARGV[1])
+for _, id in ipairs(ids) do
+    redis.call('ZADD', KEYS[1], ARGV[3], id)
+end
+return ids
+""")
+
+# re-score ids at ARGV[1] if they still have the lease deadline they were given, ARGV[2..] is id, deadline pairs
+_ack_work_store_ids = _redis.register_script("""
+local acked = 0
+for i = 2, #ARGV, 2 do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score and tonumber(score) == tonumber(ARGV[i + 1]) then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+        acked = acked + 1
+    end
+end
+return acked
+""")
+
+# work id -> lease deadline, for ids leased by this process and not acked yet
+_work_store_leases = {}
+
+# how many finished chunks may wait between two pipeline stages
+PIPELINE_QUEUE_SIZE = 1
+_PIPELINE_DONE = object()
+
 
 def run(**kwargs):
     entity_type = kwargs.get("entity")
@@ -36,12 +74,18 @@ def run(**kwargs):
     else:
         queue_table = f"queue.{entity_type.lower()}_store"
 
+    profile_queries = kwargs.get('profile_queries')
+    if profile_queries:
+        query_profiler.enable()
+    if kwargs.get('count_queries'):
+        step_metrics.enable_db_query_counts()
+
     if ids := kwargs.get('id'):
         if objects := get_objects(entity_type, ids):
             logger.info(f'found objects: {[str(obj) for obj in objects]}')
             bulk_actions = []
             with ThreadPoolExecutor(max_workers=10) as executor:
-                future_to_obj = {executor.submit(o.store): o for o in objects}
+                future_to_obj = {executor.submit(profiled_store, o): o for o in objects}
                 for future in as_completed(future_to_obj):
                     o = future_to_obj[future]
                     try:
@@ -53,9 +97,24 @@ def run(**kwargs):
                 show_difference(bulk_actions)
             index_and_merge_object_records(bulk_actions)
             db.session.commit()
+            if profile_queries:
+                query_profiler.take().write_report(profile_queries)
         else:
             logger.warn(f'found no objects with ids {ids}')
+    elif kwargs.get('pipeline') and method_name == 'store':
+        run_pipeline(
+            entity_type,
+            queue_table,
+            chunk=kwargs.get('chunk'),
+            limit=kwargs.get('limit'),
+            log_store_time=entity_type == 'work' and not queue_table_override,
+            show_differences=kwargs.get('show_difference'),
+            profile_queries=profile_queries
+        )
     else:
+        if kwargs.get('pipeline'):
+            logger.warn(f'--pipeline only applies to the store method, running {method_name} serially')
+
         objects_updated = 0
         limit = kwargs.get('limit')
         chunk = kwargs.get('chunk')
@@ -75,7 +134,8 @@ def run(**kwargs):
 
                     method_name = method_name.replace("update_once_", "")
                     method_to_run = getattr(obj, method_name)
-                    record_actions = method_to_run()
+                    with step_metrics.step(method_name, log=False), query_profiler.profile(obj, method_name):
+                        record_actions = method_to_run()
                     if method_name == "store" and record_actions:
                         for bulk_action in record_actions:
                             bulk_actions.append(bulk_action)
@@ -90,12 +150,16 @@ def run(**kwargs):
                 db.session.commit()  # fail loudly for now
                 logger.info(f'commit took {elapsed(start_time, 4)}s')
 
+                failed_ids = set()
                 if method_name == "store" and bulk_actions:
                     logger.info('indexing')
                     start_time = time()
-                    index_and_merge_object_records(bulk_actions)
+                    failed_ids = index_and_merge_object_records(bulk_actions)
                     logger.info(f'indexing took {elapsed(start_time, 4)}s')
 
+                if queue_table == 'queue.work_store':
+                    ack_work_store_ids(object_ids, failed_ids)
+
                 if entity_type == 'work' and method_name == 'store' and not queue_table_override:
                     log_work_store_time(loop_start, time(), chunk)
                 elif queue_table == 'queue.work_authors_changed_store':
@@ -108,11 +172,168 @@ def run(**kwargs):
                 objects_updated += len(objects)
 
                 logger.info(f'processed chunk of {chunk} objects in {elapsed(loop_start, 2)} seconds')
+                logger.info(f'step metrics: {step_metrics.chunk_summary()}')
+                logger.info(f'minimum dict cache: {minimum_dict_cache.stats()}')
+                step_metrics.flush()
+                if profile_queries:
+                    query_profiler.take().write_report(profile_queries)
             else:
                 logger.info('nothing ready in the queue, waiting 5 seconds...')
                 sleep(5)
 
 
+def run_pipeline(entity_type, queue_table, chunk, limit=None, log_store_time=False, show_differences=False,
+                 profile_queries=None):
+    """
+    Store queue chunks with three overlapping stages connected by bounded queues:
+
+    serialize: pop ids, load objects and run store() (the to_dict / hash work)
+    commit: commit the session the chunk was loaded in
+    index: bulk index the chunk and mark its ids done in the queue
+
+    So chunk N+1 is serialized while chunk N commits and chunk N-1 is indexed.
+    Sessions aren't thread-safe, so each chunk gets its own session in the
+    serialize thread, which is handed to the commit thread and never touched
+    by the serialize thread again. The chunk's step metrics and query profile
+    are taken there too and travel with it, so the index stage logs that
+    chunk's numbers and not the one being serialized.
+    """
+    commit_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    index_queue = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    commit_finished = Event()
+    index_finished = Event()
+    stop = Event()
+    errors = []
+
+    def serialize_stage():
+        objects_updated = 0
+        total_count = 0
+
+        try:
+            while not stop.is_set() and (limit is None or objects_updated < limit):
+                loop_start = time()
+                if not (object_ids := fetch_queue_chunk_ids(queue_table, chunk)):
+                    logger.info('nothing ready in the queue, waiting 5 seconds...')
+                    sleep(5)
+                    continue
+
+                objects = get_objects(entity_type, object_ids)
+                bulk_actions = []
+
+                start_time = time()
+                for obj in objects:
+                    total_count += 1
+                    with step_metrics.step('store', log=False):
+                        record_actions = profiled_store(obj)
+                    if record_actions:
+                        bulk_actions += [action for action in record_actions if action]
+                logger.info(f'stored {len(objects)} objects (#{total_count} so far) in {elapsed(start_time, 4)}s')
+
+                if show_differences:
+                    show_difference(bulk_actions)
+
+                chunk_metrics = step_metrics.chunk_summary()
+                chunk_profile = query_profiler.take() if profile_queries else None
+
+                # detach this chunk's session so the next chunk gets a fresh one
+                chunk_session = db.session()
+                db.session.registry.clear()
+
+                item = (loop_start, object_ids, chunk_session, bulk_actions, chunk_metrics, chunk_profile)
+                if not _put_stage_item(commit_queue, item, commit_finished):
+                    # the commit stage is gone, nothing else will close this chunk's session
+                    chunk_session.close()
+                objects_updated += len(objects)
+        finally:
+            # roll back and close a chunk that failed before it was handed off
+            db.session.remove()
+
+    def commit_stage():
+        while (item := commit_queue.get()) is not _PIPELINE_DONE:
+            loop_start, object_ids, chunk_session, bulk_actions, chunk_metrics, chunk_profile = item
+            start_time = time()
+            try:
+                chunk_session.commit()  # fail loudly for now
+            finally:
+                chunk_session.close()
+            logger.info(f'commit took {elapsed(start_time, 4)}s')
+            _put_stage_item(index_queue, (loop_start, object_ids, bulk_actions, chunk_metrics, chunk_profile), index_finished)
+
+    def index_stage():
+        while (item := index_queue.get()) is not _PIPELINE_DONE:
+            loop_start, object_ids, bulk_actions, chunk_metrics, chunk_profile = item
+            failed_ids = set()
+            if bulk_actions:
+                start_time = time()
+                failed_ids = index_and_merge_object_records(bulk_actions)
+                logger.info(f'indexing took {elapsed(start_time, 4)}s')
+
+            if queue_table == 'queue.work_store':
+                ack_work_store_ids(object_ids, failed_ids)
+
+            if log_store_time:
+                log_work_store_time(loop_start, time(), chunk)
+            elif queue_table == 'queue.work_authors_changed_store':
+                remove_object_ids_from_queue(queue_table, object_ids)
+                # push to back of redis queue, ensures the work gets added to fast queue!
+                _redis.zadd(REDIS_WORK_QUEUE, {work_id: time() for work_id in object_ids})
+            else:
+                update_object_ids_in_queue(queue_table, object_ids)
+
+            logger.info(f'processed chunk of {len(object_ids)} objects in {elapsed(loop_start, 2)} seconds')
+            logger.info(f'step metrics: {chunk_metrics}')
+            logger.info(f'minimum dict cache: {minimum_dict_cache.stats()}')
+            step_metrics.flush()
+            if chunk_profile:
+                chunk_profile.write_report(profile_queries)
+
+    def run_stage(stage, out_queue, out_finished, finished):
+        try:
+            stage()
+        except Exception as e:
+            logger.exception(f'pipeline stage {stage.__name__} failed: {e}')
+            errors.append(e)
+            stop.set()
+        finally:
+            finished.set()
+            if out_queue is not None:
+                _put_stage_item(out_queue, _PIPELINE_DONE, out_finished)
+
+    threads = [
+        Thread(target=run_stage, args=(serialize_stage, commit_queue, commit_finished, Event())),
+        Thread(target=run_stage, args=(commit_stage, index_queue, index_finished, commit_finished)),
+        Thread(target=run_stage, args=(index_stage, None, None, index_finished)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # chunks handed off to a commit stage that died before taking them
+    while not commit_queue.empty():
+        if (item := commit_queue.get_nowait()) is not _PIPELINE_DONE:
+            item[2].close()
+
+    if errors:
+        raise errors[0]
+
+
+def profiled_store(obj):
+    with query_profiler.profile(obj, 'store'):
+        return obj.store()
+
+
+def _put_stage_item(stage_queue, item, consumer_finished):
+    # don't block forever on a full queue if the consuming stage has died
+    while not consumer_finished.is_set():
+        try:
+            stage_queue.put(item, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
+
+
 def log_work_store_time(started, finished, chunk_size):
     text_query = f"""
         insert into log.work_store_batch (started, finished, batch_size)
@@ -127,18 +348,20 @@ def log_work_store_time(started, finished, chunk_size):
 
 
 def index_and_merge_object_records(bulk_actions):
-    es = Elasticsearch([ELASTIC_URL], timeout=30)
-    try:
-        bulk(es, bulk_actions)
-    except BulkIndexError as e:
-        for error in e.errors:
-            # check if the error is due to a 'not_found' status when trying to delete
-            operation, result = next(iter(error.items()))
-            if operation == 'delete' and result.get('status') == 404:
-                # ignore document not found errors, possibly already deleted
-                logger.info(f"ignoring bulk index error document not found: {error}")
-            else:
-                logger.warn(f"bulk index error occurred: {error}")
+    """Bulk index the actions and return the _ids of the documents that failed."""
+    failed_ids = set()
+    for ok, item in bulk_index(bulk_actions):
+        if ok:
+            continue
+        # check if the error is due to a 'not_found' status when trying to delete
+        operation, result = next(iter(item.items()))
+        if operation == 'delete' and result.get('status') == 404:
+            # ignore document not found errors, possibly already deleted
+            logger.info(f"ignoring bulk index error document not found: {item}")
+        else:
+            logger.warn(f"bulk index error occurred: {item}")
+            failed_ids.add(result.get('_id'))
+    return failed_ids
 
 
 def fetch_queue_chunk_ids(queue_table, chunk_size):
@@ -153,21 +376,38 @@ def fetch_queue_chunk_ids_from_redis(queue_table, chunk_size):
         return []
 
     logger.info(f'getting {chunk_size} ids from the queue')
-    overall_start_time = time()
-    zpop_result = _redis.zpopmin(REDIS_WORK_QUEUE, chunk_size)
-    logger.info(f'popped ids from the queue in {elapsed(overall_start_time, 4)}s')
-
-    chunk = [int(t[0]) for t in zpop_result] if zpop_result else []
-    logger.info(f"popped ids: {chunk}")
-    if chunk:
-        zadd_start_time = time()
-        _redis.zadd(REDIS_WORK_QUEUE, {work_id: time() for work_id in chunk})
-        logger.info(f'pushed ids to back of the queue in {elapsed(zadd_start_time, 4)}s')
-
-    logger.info(f'got {len(chunk)} ids from the queue in {elapsed(overall_start_time, 4)}s')
+    start_time = time()
+    now = time()
+    lease_deadline = now + WORK_STORE_LEASE_SECONDS
+    leased = _lease_work_store_ids(keys=[REDIS_WORK_QUEUE], args=[chunk_size, now, lease_deadline])
+
+    chunk = [int(work_id) for work_id in leased]
+    for work_id in chunk:
+        _work_store_leases[work_id] = lease_deadline
+
+    logger.info(f'leased {len(chunk)} ids from the queue in {elapsed(start_time, 4)}s')
+    logger.debug(f'leased ids: {chunk}')
     return chunk
 
 
+def ack_work_store_ids(object_ids, failed_ids=()):
+    """
+    Move stored ids to the back of the redis queue. Ids re-queued with a new
+    score while they were leased keep that score. Works whose documents are in
+    failed_ids aren't acked, so their leases expire and they're stored again.
+    """
+    args = [time()]
+    for object_id in object_ids:
+        lease_deadline = _work_store_leases.pop(object_id, None)
+        if lease_deadline is not None and as_work_openalex_id(object_id) not in failed_ids:
+            args += [object_id, lease_deadline]
+
+    if len(args) > 1:
+        start_time = time()
+        acked = _ack_work_store_ids(keys=[REDIS_WORK_QUEUE], args=args)
+        logger.info(f'acked {acked} of {len(object_ids)} ids in the queue in {elapsed(start_time, 4)}s')
+
+
 def fetch_queue_chunk_ids_from_pg(queue_table, chunk_size):
     order_by_clause = "finished asc nulls first, rand"
     if queue_table == "queue.work_authors_changed_store":
@@ -230,6 +470,7 @@ def get_objects(entity_type, object_ids):
     start_time = time()
     if entity_type == "work":
         objects = base_fast_queue_works_query().filter(models.Work.paper_id.in_(object_ids)).all()
+        attach_work_metrics(objects)
     elif entity_type == "author":
         objects = db.session.query(models.Author).options(
             selectinload(models.Author.counts),
@@ -328,7 +569,7 @@ def get_objects(entity_type, object_ids):
 
 
 def show_difference(bulk_actions):
-    es = Elasticsearch([ELASTIC_URL], timeout=30)
+    es = get_es_client()
     for action in bulk_actions:
         if action.get("op_type") == "delete":
             continue
@@ -375,6 +616,9 @@ if __name__ == "__main__":
         '--chunk', "-ch", nargs="?", default=100, type=int, help="how many objects to take off the queue at once"
     )
     parser.add_argument('--show-difference', "-sd", action="store_true", help="show the difference between the old and new records")
+    parser.add_argument('--pipeline', action="store_true", help="overlap serializing, committing and indexing of consecutive chunks (store only)")
+    parser.add_argument('--profile-queries', type=str, nargs="?", help="count SQL statements per object and method, writing a report to this path after each chunk")
+    parser.add_argument('--count-queries', action="store_true", help="count DB queries per step in the step metrics")
 
     parsed_args = parser.parse_args()
     run(**vars(parsed_args))
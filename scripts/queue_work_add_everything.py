@@ -1,6 +1,7 @@
 import argparse
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep, time, mktime, gmtime
 from timeit import default_timer as timer
 
@@ -12,7 +13,11 @@ from tenacity import retry, wait_fixed, stop_after_attempt, retry_if_exception_t
 
 import models
 from app import REDIS_QUEUE_URL, db, logger
+from metrics import step_metrics
+from query_profiler import query_profiler
 from models import REDIS_WORK_QUEUE
+from models.institution import affiliation_string_cache
+from models.work import MODEL_BATCH_SIZE, MODEL_BATCH_CONCURRENCY, prefetch_work_tags
 from scripts.works_query import base_slow_queue_works_query
 from util import elapsed, work_has_null_author_ids
 
@@ -27,6 +32,14 @@ class QueueWorkAddEverything:
         partial_update = kwargs.get("partial", False)
         queue_name = self.queue_name(partial_update)
         skip_redis_queue = kwargs.get("skip_redis_queue", False)
+        model_batch_size = kwargs.get("model_batch_size") or MODEL_BATCH_SIZE
+        model_concurrency = kwargs.get("model_concurrency") or MODEL_BATCH_CONCURRENCY
+        parallelism = kwargs.get("parallel") or 1
+        profile_queries = kwargs.get("profile_queries")
+        if profile_queries:
+            query_profiler.enable()
+        if kwargs.get("count_queries"):
+            step_metrics.enable_db_query_counts()
 
         if limit is None:
             limit = float("inf")
@@ -49,6 +62,7 @@ class QueueWorkAddEverything:
                 logger.info(f"enqueued {single_id} in redis work_store")
         else:
             num_updated = 0
+            executor = ThreadPoolExecutor(max_workers=parallelism) if parallelism > 1 else None
 
             while num_updated < limit:
                 start_time = time()
@@ -61,29 +75,47 @@ class QueueWorkAddEverything:
                     sleep(60)
                     continue
 
-                works = QueueWorkAddEverything.fetch_works(work_ids)
-
-                self.add_everything_works(works, rows, partial_update)
-
-                db.session.execute(
-                    text(f'''
-                        delete from queue.{queue_name} q
-                        where q.work_id = any(:work_ids)
-                    ''').bindparams(work_ids=work_ids)
-                )
+                group_errors = []
+                if executor:
+                    redis_queue_ids, group_errors = self.add_everything_works_parallel(
+                        executor, rows, queue_name, partial_update, parallelism, model_batch_size, model_concurrency
+                    )
+                else:
+                    works = QueueWorkAddEverything.fetch_works(work_ids)
+                    with step_metrics.step('add_everything_works', log=False):
+                        self.add_everything_works(works, rows, partial_update, model_batch_size, model_concurrency)
+                    self.delete_from_queue(queue_name, work_ids)
 
-                logger.info('committing postgres changes')
-                commit_start_time = time()
-                db.session.commit()
-                logger.info(f'commit took {elapsed(commit_start_time, 2)} seconds')
+                    logger.info('committing postgres changes')
+                    commit_start_time = time()
+                    db.session.commit()
+                    logger.info(f'commit took {elapsed(commit_start_time, 2)} seconds')
+                    redis_queue_ids = None
 
                 if skip_redis_queue:
                     logger.info('skipping redis fast queue priority')
+                elif redis_queue_ids is not None:
+                    self.prioritize_ids_in_redis_fast_queue(redis_queue_ids)
                 else:
                     self.prioritize_in_redis_fast_queue(works)
 
+                if group_errors:
+                    # the other groups are committed and prioritized, these stay started in the queue
+                    raise group_errors[0]
+
                 num_updated += chunk_size
                 logger.info(f'processed {len(rows)} Works in {elapsed(start_time, 2)} seconds')
+                logger.info(f'affiliation string cache: {affiliation_string_cache.stats()}')
+                logger.info(f'add_everything step metrics: {step_metrics.chunk_summary()}')
+                step_metrics.flush()
+                if profile_queries:
+                    query_profiler.take().write_report(profile_queries)
+
+    @staticmethod
+    def prioritize_in_redis_fast_queue(works):
+        QueueWorkAddEverything.prioritize_ids_in_redis_fast_queue(
+            [work.paper_id for work in works if not work_has_null_author_ids(work)]
+        )
 
     @staticmethod
     @retry(
@@ -92,21 +124,23 @@ class QueueWorkAddEverything:
         retry=retry_if_exception_type(ConnectionError),
         before_sleep=before_sleep_log(logger, logging.WARNING)
     )
-    def prioritize_in_redis_fast_queue(works):
+    def prioritize_ids_in_redis_fast_queue(work_ids):
         redis_queue_time = time()
-        redis_queue_mapping = {
-            work.paper_id: mktime(gmtime(0))
-            for work in works if not work_has_null_author_ids(work)
-        }
+        redis_queue_mapping = {work_id: mktime(gmtime(0)) for work_id in work_ids}
         if redis_queue_mapping:
             _redis.zadd(REDIS_WORK_QUEUE, redis_queue_mapping)
         logger.info(f'enqueueing works in redis work_store took {elapsed(redis_queue_time, 2)} seconds')
 
     @staticmethod
-    def add_everything_works(works, rows, partial_update):
+    def add_everything_works(works, rows, partial_update, model_batch_size=MODEL_BATCH_SIZE,
+                             model_concurrency=MODEL_BATCH_CONCURRENCY):
+        if not partial_update:
+            QueueWorkAddEverything.add_everything_works_batch_tagged(works, model_batch_size, model_concurrency)
+            return
+
         for i, work in enumerate(works):
             logger.info(f'running add_everything on {work}')
-            if partial_update and (methods_str := rows[i][1]):
+            if methods_str := rows[i][1]:
                 method_names = re.split('\W', methods_str)
                 for method_name in method_names:
                     if not method_name:
@@ -117,13 +151,101 @@ class QueueWorkAddEverything:
                             f'method {method_name} does not exist in Work')
                         continue
                     start_time = timer()
-                    method()
+                    with query_profiler.profile(work, method_name):
+                        method()
                     end_time = timer()
                     logger.info(
                         f'finished Work.{method_name} for Work {work.paper_id} in {format_timespan(end_time - start_time)}')
             else:
-                work.add_everything(
-                    skip_concepts_and_related_works=partial_update)
+                with query_profiler.profile(work, 'add_everything'):
+                    work.add_everything(skip_concepts_and_related_works=True)
+
+    @staticmethod
+    def delete_from_queue(queue_name, work_ids):
+        db.session.execute(
+            text(f'''
+                delete from queue.{queue_name} q
+                where q.work_id = any(:work_ids)
+            ''').bindparams(work_ids=work_ids)
+        )
+
+    @staticmethod
+    def add_everything_works_parallel(executor, rows, queue_name, partial_update, parallelism, model_batch_size,
+                                      model_concurrency):
+        """
+        Split the chunk into groups and run add_everything_works on each group in a
+        pool thread with its own scoped session. Each group commits together with
+        the delete of its own queue rows, so a group never holds its transaction
+        open waiting on the others: one group's insert waiting on another's
+        uncommitted affiliation string row would otherwise hang the chunk.
+        Returns the ids to prioritize in the redis queue from the committed
+        groups and the errors of the failed ones, which were rolled back.
+        """
+        def run_group(group_rows):
+            start_time = time()
+            group_ids = [row[0] for row in group_rows]
+            try:
+                works = QueueWorkAddEverything.fetch_works(group_ids)
+                # fetch_works doesn't keep the queue order, the partial update methods are per row
+                rows_by_id = {row[0]: row for row in group_rows}
+                works_rows = [rows_by_id[work.paper_id] for work in works]
+                with step_metrics.step('add_everything_works', log=False):
+                    QueueWorkAddEverything.add_everything_works(
+                        works, works_rows, partial_update, model_batch_size, model_concurrency
+                    )
+                redis_queue_ids = [work.paper_id for work in works if not work_has_null_author_ids(work)]
+                QueueWorkAddEverything.delete_from_queue(queue_name, group_ids)
+                db.session.commit()
+            finally:
+                db.session.remove()
+
+            return redis_queue_ids, len(works), elapsed(start_time, 2)
+
+        start_time = time()
+        groups = [rows[i::parallelism] for i in range(parallelism) if rows[i::parallelism]]
+        futures = [step_metrics.submit(executor, run_group, group_rows) for group_rows in groups]
+
+        results = []
+        errors = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.exception(f'add_everything group failed and was rolled back: {e}')
+                errors.append(e)
+
+        group_seconds = [seconds for _, _, seconds in results]
+        logger.info(
+            f'add_everything on {sum(num_works for _, num_works, _ in results)} works in {len(results)} of '
+            f'{len(groups)} groups took {elapsed(start_time, 2)} seconds, {round(sum(group_seconds), 2)} seconds '
+            f'of group time, slowest group {max(group_seconds, default=0)} seconds')
+
+        redis_queue_ids = [work_id for group_ids, _, _ in results for work_id in group_ids]
+        return redis_queue_ids, errors
+
+    @staticmethod
+    def add_everything_works_batch_tagged(works, model_batch_size, model_concurrency):
+        # add_everything in three passes so the concept and topic model calls
+        # for the whole chunk go out in batches instead of one work at a time
+        tagged_works = []
+        for work in works:
+            logger.info(f'running add_everything on {work}')
+            with query_profiler.profile(work, 'add_everything_before_tagging'):
+                if work.add_everything_before_tagging():
+                    tagged_works.append(work)
+
+        with step_metrics.step('prefetch_work_tags'):
+            prefetched = prefetch_work_tags(tagged_works, batch_size=model_batch_size, max_workers=model_concurrency)
+
+        for work in tagged_works:
+            work_results = prefetched.get(work.paper_id, {})
+            with query_profiler.profile(work, 'add_concepts_topics_and_related_works'):
+                work.add_concepts_topics_and_related_works(
+                    concept_result=work_results.get('concept_result'),
+                    topic_result=work_results.get('topic_result'),
+                )
+            with query_profiler.profile(work, 'add_everything_after_tagging'):
+                work.add_everything_after_tagging()
 
     @staticmethod
     def queue_name(partial_update):
@@ -195,6 +317,26 @@ if __name__ == "__main__":
         '--partial', dest='partial', default=False, action='store_true',
         help="skip concept tagging and related work assignment"
     )
+    parser.add_argument(
+        '--model-batch-size', nargs="?", type=int, default=MODEL_BATCH_SIZE,
+        help="how many works to send to the concept and topic models per request"
+    )
+    parser.add_argument(
+        '--model-concurrency', nargs="?", type=int, default=MODEL_BATCH_CONCURRENCY,
+        help="how many concept and topic model requests to have in flight at once"
+    )
+    parser.add_argument(
+        '--parallel', nargs="?", type=int, default=1,
+        help="how many groups of each chunk to run add_everything on at once, each committed in its own db session"
+    )
+    parser.add_argument(
+        '--profile-queries', nargs="?", type=str,
+        help="count SQL statements per work and method, writing a report to this path after each chunk"
+    )
+    parser.add_argument(
+        '--count-queries', action='store_true',
+        help="count DB queries per step in the step metrics"
+    )
     parser.add_argument(
         '--skip-redis-queue', action='store_true',
         help="if set, will skip the step that prioritizes the work in the redis fast queue"
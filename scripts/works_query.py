@@ -3,6 +3,7 @@ from sqlalchemy.orm import selectinload
 
 import models
 from app import db
+from models.work_store_fingerprint import WORK_STORE_FINGERPRINTS
 
 
 def base_slow_queue_works_query():
@@ -106,7 +107,7 @@ def base_slow_queue_works_query():
 
 
 def base_fast_queue_works_query():
-    return db.session.query(models.Work).options(
+    query = db.session.query(models.Work).options(
             selectinload(models.Work.records).selectinload(models.Record.journals).selectinload(models.Source.merged_into_source).lazyload(models.Source.merged_into_source).selectinload(models.Source.publisher_entity).selectinload(models.Publisher.self_and_ancestors).raiseload('*'),
             selectinload(models.Work.records).selectinload(models.Record.journals).selectinload(models.Source.merged_into_source).lazyload(models.Source.merged_into_source).selectinload(models.Source.publisher_entity).raiseload('*'),
             selectinload(models.Work.records).selectinload(models.Record.journals).selectinload(models.Source.merged_into_source).lazyload(models.Source.merged_into_source).selectinload(models.Source.institution).raiseload('*'),
@@ -162,14 +163,10 @@ def base_fast_queue_works_query():
             selectinload(models.Work.retraction_watch),
             selectinload(models.Work.funders).selectinload(models.WorkFunder.funder).raiseload('*'),
             selectinload(models.Work.funders).raiseload('*'),
-            selectinload(models.Work.counts),
-            selectinload(models.Work.citation_count_2year),
             selectinload(models.Work.counts_by_year).raiseload('*'),
             selectinload(models.Work.abstract),
             selectinload(models.Work.extra_ids).raiseload('*'),
             selectinload(models.Work.related_works).raiseload('*'),
-            selectinload(models.Work.work_fwci).raiseload('*'),
-            selectinload(models.Work.work_citations_norm_percentile).raiseload('*'),
             selectinload(models.Work.affiliations).selectinload(models.Affiliation.author).selectinload(models.Author.orcids).raiseload('*'),
             selectinload(models.Work.affiliations).selectinload(models.Affiliation.author).raiseload('*'),
             selectinload(models.Work.affiliations).selectinload(models.Affiliation.institution).selectinload(models.Institution.ror).raiseload('*'),
@@ -192,4 +189,9 @@ def base_fast_queue_works_query():
             selectinload(models.Work.datasets).selectinload(models.WorkRelatedVersion.related_dataset).raiseload('*'),
             selectinload(models.Work.fulltext),
             orm.Load(models.Work).raiseload('*')
-        )
\ No newline at end of file
+        )
+
+    if WORK_STORE_FINGERPRINTS:
+        query = query.options(selectinload(models.Work.store_fingerprint).raiseload('*'))
+
+    return query
\ No newline at end of file
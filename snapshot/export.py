@@ -6,8 +6,9 @@
 #   $ bash ./snapshot/export_merge_ids.sh
 #
 # 3. run this script to creates the new contents of s3://openalex/data/ in a local directory ${data_dir}
-#   $ python3 -m snapshot.export
+#   $ python3 -m snapshot.export --entity institutions --entity sources
 #   "dumping entity rows to local data dir ${data_dir}"
+#   if it stops, run it again with --data-dir ${data_dir} to pick up from the last checkpoints
 #
 # 4. update release notes
 #   date the current release notes
@@ -26,18 +27,17 @@
 #   check result at: https://openalex.s3.amazonaws.com/browse.html
 
 
+import argparse
 from datetime import datetime
+import glob
 import gzip
 import json
+import mmap
 import multiprocessing as mp
 import os
+import shutil
 import time
 
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import Search
-import redis
-
-from app import ELASTIC_URL
 from app import (
     AWARDS_INDEX,
     AUTHORS_INDEX,
@@ -51,20 +51,15 @@ from app import (
     SUBFIELDS_INDEX,
     TOPICS_INDEX
 )
+from es_client import get_es_client
 
 data_dir = os.path.join(os.path.expanduser('~'), 'data', datetime.now().strftime("%Y_%m_%d"))
-print(f"data directory is {data_dir}")
-
-# Configure Elasticsearch client with longer timeout
-es = Elasticsearch(
-    [ELASTIC_URL],
-    timeout=60,
-    max_retries=3,
-    retry_on_timeout=True
-)
 
-# Configure redis client
-r = redis.Redis(host='localhost', port=6379, db=2)
+# checkpoints and dedup bitmaps, kept outside ~/data so they don't get synced to s3
+state_dir = os.path.join(os.path.expanduser('~'), '.snapshot_export_state', os.path.basename(data_dir))
+
+# Elasticsearch client with longer timeout, shared per process
+es = get_es_client(timeout=60)
 
 entities_to_indices = {
     "awards": AWARDS_INDEX,
@@ -78,6 +73,187 @@ entities_to_indices = {
     "subfields": SUBFIELDS_INDEX,
 }
 
+# entities whose ids aren't https://openalex.org/<letter><integer> are exported in one slice
+single_slice_entities = ["domains", "fields", "subfields"]
+
+excluded_source_fields = ['_source', 'embeddings', 'fulltext', 'abstract', 'vector_embedding', 'version', '@version', '@timestamp']
+
+page_size = 1000
+max_file_size = 5 * 1024 ** 3  # 5GB uncompressed
+checkpoint_pages = 50
+pit_keep_alive = '10m'
+
+# one bit per integer id. the file is sparse, so only pages holding ids use disk
+bitmap_capacity_bits = 2 ** 34
+bitmap_lock_stripes = 64
+
+# set in each pool process by init_export_process
+bitmap = None
+
+
+class IdBitmap:
+    """
+    Ids already exported for an entity, shared by all export processes through a
+    memory-mapped file. Replaces a redis set: no round trip per record, and the
+    file survives a crash along with the checkpoints.
+    Test-and-set runs under one of a few striped locks, picked by byte.
+    """
+    def __init__(self, path, locks, capacity_bits=bitmap_capacity_bits):
+        self.path = path
+        self.locks = locks
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.truncate(capacity_bits // 8)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def _position(self, record_id):
+        byte, bit = divmod(record_id, 8)
+        if byte >= len(self._map):
+            raise ValueError(f"id {record_id} is beyond the bitmap capacity of {len(self._map) * 8} ids")
+        return byte, 1 << bit
+
+    def add(self, record_id):
+        """Sets the bit for record_id. Returns False if it was already set."""
+        byte, mask = self._position(record_id)
+        with self.locks[byte % len(self.locks)]:
+            value = self._map[byte]
+            if value & mask:
+                return False
+            self._map[byte] = value | mask
+            return True
+
+    def discard(self, record_id):
+        byte, mask = self._position(record_id)
+        with self.locks[byte % len(self.locks)]:
+            self._map[byte] &= ~mask & 0xff
+
+    def flush(self):
+        self._map.flush()
+
+
+def init_export_process(bitmap_path, locks):
+    global bitmap
+    bitmap = IdBitmap(bitmap_path, locks)
+
+
+def bitmap_path(entity_type):
+    return os.path.join(state_dir, entity_type, 'record_ids.bitmap')
+
+
+def prefix_letter(entity_type):
+    return "G" if entity_type == "awards" else entity_type[0].upper()
+
+
+def integer_id(openalex_id, letter):
+    short_id = openalex_id.rsplit('/', 1)[-1]
+    if short_id[:1].upper() == letter:
+        short_id = short_id[1:]
+    try:
+        return int(short_id)
+    except ValueError:
+        return None
+
+
+def id_slices(entity_type):
+    """
+    (gte, lt) ranges on the id keyword, one per leading digit. Unlike an ES
+    sliced search these split the same way every time, so a slice can resume
+    in a new point in time with a range query.
+    """
+    if entity_type in single_slice_entities:
+        return [(None, None)]
+    id_prefix = f"https://openalex.org/{prefix_letter(entity_type)}"
+    # ':' sorts right after '9'
+    return [(f"{id_prefix}{digit}", f"{id_prefix}{chr(ord(str(digit)) + 1)}") for digit in range(1, 10)]
+
+
+def unit_dir(entity_type, d):
+    return os.path.join(state_dir, entity_type, f"updated_date={d}")
+
+
+def checkpoint_path(entity_type, d, slice_number):
+    return os.path.join(unit_dir(entity_type, d), f"slice_{str(slice_number).zfill(2)}.json")
+
+
+def claims_path(entity_type, d, slice_number):
+    # ids this slice set in the bitmap since its last checkpoint, to release the unwritten ones after a crash
+    return os.path.join(unit_dir(entity_type, d), f"slice_{str(slice_number).zfill(2)}.claims")
+
+
+def raw_part_path(entity_type, d, slice_number, part_file_number):
+    return os.path.join(
+        data_dir, entity_type, f"updated_date={d}",
+        f"part_{str(slice_number).zfill(2)}_{str(part_file_number).zfill(3)}.json"
+    )
+
+
+def load_checkpoint(entity_type, d, slice_number):
+    try:
+        with open(checkpoint_path(entity_type, d, slice_number)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"part_file_number": 0, "offset": 0, "count": 0, "last_id": None, "done": False}
+
+
+def save_checkpoint(entity_type, d, slice_number, checkpoint, part_file=None, claims_file=None):
+    # everything the checkpoint points at has to be on disk before the checkpoint is
+    if part_file is not None:
+        part_file.flush()
+        os.fsync(part_file.fileno())
+    bitmap.flush()
+
+    path = checkpoint_path(entity_type, d, slice_number)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(f'{path}.tmp', path)
+
+    if claims_file is not None:
+        claims_file.truncate(0)
+    elif os.path.exists(claims_path(entity_type, d, slice_number)):
+        os.remove(claims_path(entity_type, d, slice_number))
+
+
+def recover_slice(entity_type, d, slice_number):
+    """
+    Make an unfinished slice consistent before export starts again: keep the
+    complete lines written after its checkpoint, drop a partial last line, and
+    release bitmap bits it claimed for records that never made it to the file.
+    """
+    checkpoint = load_checkpoint(entity_type, d, slice_number)
+    claims_file_path = claims_path(entity_type, d, slice_number)
+    part_path = raw_part_path(entity_type, d, slice_number, checkpoint["part_file_number"])
+    if checkpoint["done"] or not (os.path.exists(part_path) or os.path.exists(claims_file_path)):
+        return
+
+    letter = prefix_letter(entity_type)
+    written_ids = set()
+    if os.path.exists(part_path):
+        with open(part_path, 'r+b') as f:
+            f.seek(checkpoint["offset"])
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                openalex_id = json.loads(line)["id"]
+                written_ids.add(integer_id(openalex_id, letter))
+                checkpoint["offset"] += len(line)
+                checkpoint["count"] += 1
+                checkpoint["last_id"] = openalex_id
+            f.truncate(checkpoint["offset"])
+
+    for record_id in written_ids:
+        bitmap.add(record_id)
+    if os.path.exists(claims_file_path):
+        with open(claims_file_path) as f:
+            claimed_ids = {int(line) for line in f if line.strip()}
+        for record_id in claimed_ids - written_ids:
+            bitmap.discard(record_id)
+
+    print(f"recovered {entity_type} {d} slice {slice_number}: {len(written_ids)} records after the last checkpoint")
+    save_checkpoint(entity_type, d, slice_number, checkpoint)
+
 
 def get_distinct_updated_dates(index_name):
     print(f"get distinct changed dates for {index_name}")
@@ -111,115 +287,193 @@ def get_distinct_updated_dates(index_name):
     return dates
 
 
-def create_search_query(index_name, d, search_after=None):
-    page_size = 1000
-    s = Search(using=es, index=index_name).query("term", created_date=d)
-    s = s.sort(*["id"])
-    s = s.source(excludes=['_source', 'embeddings', 'fulltext', 'abstract', 'vector_embedding', 'version', '@version', '@timestamp'])
-    if search_after:
-        s = s.extra(size=page_size, search_after=search_after)
-    else:
-        s = s.extra(size=page_size)
-    s = s.params(preference=d)
-    return s
-
-
-def export_date(args):
-    index_name, entity_type, d = args
-    max_file_size = 5 * 1024 ** 3  # 5GB uncompressed
-    count = 0
-    prefix_letter = "G" if entity_type == "awards" else entity_type[0].upper()
-    index_id_prefix = f"https://openalex.org/{prefix_letter}"
-    date_dir = os.path.join(data_dir, entity_type, f"updated_date={d}")
-
-    part_file_number = 0
-    part_file = None  # Initialize as None
-    total_size = 0
-    s = create_search_query(index_name, d)
-    response = s.execute()
-
-    while len(response.hits) > 0:
-        if part_file is None:  # Only create dir and file if there are hits
-            os.makedirs(date_dir, exist_ok=True)
-            part_file = gzip.open(f'{date_dir}/part_{str(part_file_number).zfill(3)}.gz', 'wt')
-
-        for hit in response:
-            record_id = hit.id
-            # Skip records without an ID
-            if record_id is None:
-                print(f"Skipping record without ID in {entity_type} for date {d}")
-                continue
-            # convert to integer
-            try:
-                record_id = int(record_id.replace(index_id_prefix, ""))
-            except ValueError:
-                if entity_type not in ["domains", "fields", "subfields"]:
-                    print(f"Skipping record {record_id}. Not an integer.")
+def slice_query(d, gte, lt, after_id):
+    id_range = {}
+    if after_id:
+        id_range["gt"] = after_id
+    elif gte:
+        id_range["gte"] = gte
+    if lt:
+        id_range["lt"] = lt
+
+    filters = [{"term": {"created_date": d}}]
+    if id_range:
+        filters.append({"range": {"id": id_range}})
+    return {"bool": {"filter": filters}}
+
+
+def prepare_record(entity_type, record, record_id):
+    # handle truncated authors
+    if entity_type == "works" and record.get("authorships") and record.get('authorships_full'):
+        record["authorships"] = record["authorships_full"]
+        del record["authorships_full"]
+        if record.get("is_authors_truncated"):
+            del record["is_authors_truncated"]
+
+    # handle abstract inverted index
+    if (
+            entity_type == "works"
+            and record.get("abstract_inverted_index")
+    ):
+        try:
+            record["abstract_inverted_index"] = json.loads(
+                record["abstract_inverted_index"]
+            )
+            record["abstract_inverted_index"] = record["abstract_inverted_index"].get("InvertedIndex")
+        except json.JSONDecodeError as e:
+            print(f"ERROR: Failed to parse abstract_inverted_index for record {record_id} (ID: {record.get('id')})")
+            print(f"JSON Error: {e}")
+            print(f"First 1000 chars of problematic JSON: {record.get('abstract_inverted_index', '')[:1000]}")
+            # Skip the abstract inverted index for this record
+            record["abstract_inverted_index"] = None
+
+    return record
+
+
+def export_slice(args):
+    """
+    Export one id slice of one date partition to uncompressed part files,
+    starting from its checkpoint. Checkpoints are written every
+    checkpoint_pages pages and when a part file is full.
+    """
+    index_name, entity_type, d, slice_number = args
+    checkpoint = load_checkpoint(entity_type, d, slice_number)
+    if checkpoint["done"]:
+        return checkpoint["count"]
+
+    letter = prefix_letter(entity_type)
+    gte, lt = id_slices(entity_type)[slice_number]
+    claims_file_path = claims_path(entity_type, d, slice_number)
+    os.makedirs(os.path.dirname(claims_file_path), exist_ok=True)
+
+    part_file = None
+    pages_since_checkpoint = 0
+    search_after = None
+    pit_id = es.open_point_in_time(index=index_name, keep_alive=pit_keep_alive)["id"]
+
+    try:
+        with open(claims_file_path, 'a') as claims_file:
+            while True:
+                response = es.search(
+                    pit={"id": pit_id, "keep_alive": pit_keep_alive},
+                    query=slice_query(d, gte, lt, checkpoint["last_id"] if search_after is None else None),
+                    sort=[{"id": "asc"}],
+                    size=page_size,
+                    search_after=search_after,
+                    source_excludes=excluded_source_fields,
+                )
+                pit_id = response.get("pit_id", pit_id)
+                hits = response["hits"]["hits"]
+                if not hits:
+                    break
+                search_after = hits[-1]["sort"]
+
+                lines = []
+                claimed_ids = []
+                for hit in hits:
+                    record = hit["_source"]
+                    openalex_id = record.get("id")
+                    # Skip records without an ID
+                    if openalex_id is None:
+                        print(f"Skipping record without ID in {entity_type} for date {d}")
+                        continue
+                    record_id = integer_id(openalex_id, letter)
+                    if record_id is None:
+                        print(f"Skipping record {openalex_id}. Not an integer.")
+                        continue
+                    if not bitmap.add(record_id):
+                        with open(f'duplicate_record_ids_{entity_type}.csv', 'a') as f:
+                            f.write(f"{entity_type[0].upper()}{record_id}\n")
+                        print(f"Skipping record {record_id}. Already in dataset.")
+                        continue
+                    claimed_ids.append(record_id)
+                    lines.append((openalex_id, json.dumps(prepare_record(entity_type, record, record_id)) + '\n'))
+
+                if not lines:
                     continue
-            if r.sadd('record_ids', record_id):
-                count += 1
-                record = hit.to_dict()
-
-                # handle truncated authors
-                if entity_type == "works" and record.get("authorships") and record.get('authorships_full'):
-                    record["authorships"] = record["authorships_full"]
-                    del record["authorships_full"]
-                    if record.get("is_authors_truncated"):
-                        del record["is_authors_truncated"]
-
-                # handle abstract inverted index
-                if (
-                        entity_type == "works"
-                        and record.get("abstract_inverted_index")
-                ):
-                    try:
-                        record["abstract_inverted_index"] = json.loads(
-                            record["abstract_inverted_index"]
-                        )
-                        record["abstract_inverted_index"] = record["abstract_inverted_index"].get("InvertedIndex")
-                    except json.JSONDecodeError as e:
-                        print(f"ERROR: Failed to parse abstract_inverted_index for record {record_id} (ID: {hit.id})")
-                        print(f"JSON Error: {e}")
-                        print(f"First 1000 chars of problematic JSON: {record.get('abstract_inverted_index', '')[:1000]}")
-                        # Skip the abstract inverted index for this record
-                        record["abstract_inverted_index"] = None
-
-                line = json.dumps(record) + '\n'
-                line_size = len(line.encode('utf-8'))
-
-                # If this line will make the file exceed the max size, close the current file and open a new one
-                if total_size + line_size > max_file_size:
-                    part_file.close()
-                    part_file_number += 1
-                    part_file = gzip.open(f'{date_dir}/part_{str(part_file_number).zfill(3)}.gz', 'wt')
-                    total_size = 0
-
-                if count % 10000 == 0:
-                    print(f"{entity_type} {d} {count}")
-
-                part_file.write(line)
-                total_size += line_size
-            else:
-                with open(f'duplicate_record_ids_{entity_type}.csv', 'a') as f:
-                    f.write(f"{entity_type[0].upper()}{record_id}\n")
-                print(f"Skipping record {record_id}. Already in dataset.")
 
-        # Get the last document's sort value and use it for the search_after parameter
-        last_hit_sort = response.hits.hits[-1]['sort']
-        s = create_search_query(index_name, d, search_after=last_hit_sort)
-        response = s.execute()
-
-    if part_file is not None:  # If file was created, close it
-        part_file.close()
-
-
-def export_entity(index_name, entity_type):
+                # start a new part file between pages, so a checkpoint never splits a page
+                page_size_bytes = sum(len(line.encode('utf-8')) for _, line in lines)
+                if part_file is not None and checkpoint["offset"] + page_size_bytes > max_file_size:
+                    checkpoint["part_file_number"] += 1
+                    checkpoint["offset"] = 0
+                    save_checkpoint(entity_type, d, slice_number, checkpoint, part_file, claims_file)
+                    part_file.close()
+                    part_file = None
+                    pages_since_checkpoint = 0
+
+                if part_file is None:
+                    part_path = raw_part_path(entity_type, d, slice_number, checkpoint["part_file_number"])
+                    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+                    part_file = open(part_path, 'a', encoding='utf-8')
+
+                claims_file.write(''.join(f"{record_id}\n" for record_id in claimed_ids))
+                claims_file.flush()
+
+                for openalex_id, line in lines:
+                    part_file.write(line)
+                    checkpoint["offset"] += len(line.encode('utf-8'))
+                    checkpoint["count"] += 1
+                    checkpoint["last_id"] = openalex_id
+                    if checkpoint["count"] % 10000 == 0:
+                        print(f"{entity_type} {d} slice {slice_number} {checkpoint['count']}")
+                part_file.flush()
+
+                pages_since_checkpoint += 1
+                if pages_since_checkpoint >= checkpoint_pages:
+                    save_checkpoint(entity_type, d, slice_number, checkpoint, part_file, claims_file)
+                    pages_since_checkpoint = 0
+
+            checkpoint["done"] = True
+            save_checkpoint(entity_type, d, slice_number, checkpoint, part_file, claims_file)
+        os.remove(claims_file_path)
+    finally:
+        if part_file is not None:
+            part_file.close()
+        es.close_point_in_time(id=pit_id)
+
+    return checkpoint["count"]
+
+
+def compress_part(args):
+    raw_path, compress_level = args
+    gz_path = f"{raw_path[:-len('.json')]}.gz"
+    # a .gz without a .tmp suffix is complete, the raw file just wasn't removed yet
+    if not os.path.exists(gz_path):
+        with open(raw_path, 'rb') as raw_file, gzip.open(f'{gz_path}.tmp', 'wb', compresslevel=compress_level) as gz_file:
+            shutil.copyfileobj(raw_file, gz_file, 16 * 1024 * 1024)
+        os.replace(f'{gz_path}.tmp', gz_path)
+    os.remove(raw_path)
+    return gz_path
+
+
+def compress_entity(entity_type, compress_level, processes):
+    raw_paths = sorted(glob.glob(os.path.join(data_dir, entity_type, "updated_date=*", "part_*.json")))
+    print(f"compressing {len(raw_paths)} {entity_type} part files at level {compress_level}")
+    with mp.Pool(processes) as p:
+        _ = list(p.imap_unordered(compress_part, ((raw_path, compress_level) for raw_path in raw_paths)))
+
+
+def export_entity(index_name, entity_type, processes=12, compress_level=6):
     distinct_updated_dates = get_distinct_updated_dates(index_name)
+    num_slices = len(id_slices(entity_type))
+
+    locks = [mp.Lock() for _ in range(bitmap_lock_stripes)]
+    init_export_process(bitmap_path(entity_type), locks)
+    for d in distinct_updated_dates:
+        for slice_number in range(num_slices):
+            recover_slice(entity_type, d, slice_number)
 
-    args_for_export = ((index_name, entity_type, d) for d in distinct_updated_dates)
+    args_for_export = (
+        (index_name, entity_type, d, slice_number)
+        for d in distinct_updated_dates
+        for slice_number in range(num_slices)
+    )
+    with mp.Pool(processes, initializer=init_export_process, initargs=(bitmap_path(entity_type), locks)) as p:
+        count = sum(p.imap_unordered(export_slice, args_for_export))
+    print(f"exported {count} {entity_type}")
 
-    with mp.Pool(12) as p:
-        _ = list(p.imap_unordered(export_date, args_for_export))
+    compress_entity(entity_type, compress_level, processes)
 
 
 def make_manifests():
@@ -264,16 +518,22 @@ def make_manifests():
 
 
 if __name__ == "__main__":
-    # for entity, index in entities_to_indices.items():
-    #     start_time = time.time()
-    #     r.flushdb()
-    #     export_entity(index, entity)
-    #     end_time = time.time()
-    #     print(f"Total time: {end_time - start_time} seconds")
-    start_time = time.time()
-    r.flushdb()
-    export_entity(INSTITUTIONS_INDEX, "institutions")
-    end_time = time.time()
-    print(f"Total time: {end_time - start_time} seconds")
-    r.flushdb()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entity', choices=list(entities_to_indices.keys()), action='append',
+                        help="entity to export, can be repeated (default institutions)")
+    parser.add_argument('--data-dir', type=str, help="resume the run that writes to this directory")
+    parser.add_argument('--processes', type=int, default=12, help="export and compression processes")
+    parser.add_argument('--compress-level', type=int, default=6, help="gzip level for the part files")
+    parsed_args = parser.parse_args()
+
+    if parsed_args.data_dir:
+        data_dir = parsed_args.data_dir
+        state_dir = os.path.join(os.path.expanduser('~'), '.snapshot_export_state', os.path.basename(data_dir))
+    print(f"data directory is {data_dir}")
+
+    for entity in parsed_args.entity or ["institutions"]:
+        start_time = time.time()
+        export_entity(entities_to_indices[entity], entity, parsed_args.processes, parsed_args.compress_level)
+        end_time = time.time()
+        print(f"Total time: {end_time - start_time} seconds")
     make_manifests()
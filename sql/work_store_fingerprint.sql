@@ -0,0 +1,12 @@
+/*
+Fingerprints of the store inputs for each work, used by Work.handle_indexing
+to skip serializing works that haven't changed since they were last stored.
+Enable with WORK_STORE_FINGERPRINTS=True after creating the table.
+*/
+
+CREATE TABLE IF NOT EXISTS mid.work_store_fingerprint (
+    paper_id bigint PRIMARY KEY,
+    fingerprint text,
+    json_entity_hash text,
+    updated timestamp without time zone
+);
@@ -39,17 +39,66 @@ def fetch_top_1k_titles():
 TOP_TITLES = fetch_top_1k_titles()
 
 
+# "md5" reproduces the existing json_entity_hash values. "blake2b" is faster but
+# changes every hash, so switching re-stores each entity once.
+ENTITY_HASH_MODE = os.getenv("ENTITY_HASH_MODE", "md5")
+VOLATILE_ENTITY_KEYS = ("updated_date", "updated", "@timestamp")
+_canonical_json_encoder = json.JSONEncoder(sort_keys=True)
+
+
 def entity_md5(entity_repr):
     if isinstance(entity_repr, int):
         return text_md5(str(entity_repr))
     if isinstance(entity_repr, dict):
-        entity_copy = entity_repr.copy()
-        entity_copy.pop("updated_date", None)
-        entity_copy.pop("updated", None)
-        entity_copy.pop("@timestamp", None)
+        return canonical_hash(entity_repr)
+
+
+def canonical_hash(entity, mode=None):
+    """
+    Hash of a dict without its volatile keys. The dict isn't copied and the whole
+    JSON document is never built: top-level values are encoded and fed to the
+    digest one at a time.
+    In md5 mode the digest equals md5(json.dumps(entity, sort_keys=True)) minus
+    the volatile keys. blake2b mode hashes top-level strings (fulltext, abstract)
+    as raw utf-8 instead of JSON escaping them.
+    """
+    mode = mode or ENTITY_HASH_MODE
+    keys = [key for key in entity if key not in VOLATILE_ENTITY_KEYS]
+
+    if not all(isinstance(key, str) for key in keys):
+        # json.dumps would convert these keys to strings, let it
+        entity_copy = {key: entity[key] for key in keys}
         entity_str = json.dumps(entity_copy, sort_keys=True)
+        if mode == "blake2b":
+            return hashlib.blake2b(entity_str.encode("utf-8"), digest_size=16).hexdigest()
         return text_md5(entity_str)
 
+    keys.sort()
+    encode = _canonical_json_encoder.encode
+
+    if mode == "blake2b":
+        h = hashlib.blake2b(digest_size=16)
+        for key in keys:
+            for part in (key, entity[key]):
+                if isinstance(part, str):
+                    encoded = part.encode("utf-8", "surrogatepass")
+                    h.update(b"s%d:" % len(encoded))
+                else:
+                    encoded = encode(part).encode("utf-8")
+                    h.update(b"j%d:" % len(encoded))
+                h.update(encoded)
+        return h.hexdigest()
+
+    h = hashlib.md5(b"{")
+    for i, key in enumerate(keys):
+        if i:
+            h.update(b", ")
+        h.update(encode(key).encode("utf-8"))
+        h.update(b": ")
+        h.update(encode(entity[key]).encode("utf-8"))
+    h.update(b"}")
+    return h.hexdigest()
+
 
 def text_md5(text):
     return hashlib.md5(text.encode("utf-8")).hexdigest()